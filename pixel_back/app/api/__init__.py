@@ -3,5 +3,9 @@ API package for the Pixel Canvas project.
 """
 
 from .snapshots import router
+from .canvas import router as canvas_router
+from .timelapse import router as timelapse_router
+from .users import router as users_router
+from .moderation import router as moderation_router
 
-__all__ = ["router"]
\ No newline at end of file
+__all__ = ["router", "canvas_router", "timelapse_router", "users_router", "moderation_router"]
\ No newline at end of file
@@ -0,0 +1,488 @@
+"""
+API endpoints for querying the canvas state, including past states.
+"""
+
+import asyncio
+import base64
+import json
+from datetime import datetime, timedelta, timezone
+import numpy as np
+from fastapi import APIRouter, Depends, Header, HTTPException, Response
+from fastapi.responses import StreamingResponse
+from app.canvas_registry import CanvasConfig, list_canvas_configs
+from app.config import HISTORY_FINAL_AFTER, HISTORY_RECENT_MAX_AGE, PYRAMID_MAX_AGE
+from app.deps import get_db_session, get_read_db_session, get_redis_connection, require_admin, require_canvas
+from app.redis_store.canvas import CanvasStore
+from app.schemas.canvas import CanvasResizeRequest, CanvasResyncRequest
+from app.schemas.events import PixelBatchEvent
+from app.services.canvas_service import CanvasService, pixel_batch_message, track_placements
+from app.services.geometry_service import expand_canvas
+from app.services.heatmap_service import downsample_heatmap, get_heatmap, heatmap_to_rgb
+from app.services.hash_tree_service import get_hash_tree, verify_canvas
+from app.websocket.manager import publish_canvas_message
+from app.services.history_service import get_history_service, HistoricalFrame
+from app.services.last_writer_service import get_pixel_info, get_region_info
+from app.services.log_archive import get_last_log_id_before
+from app.services.pyramid_service import get_pyramid
+from app.services.spectator_service import spectator_hub
+from app.utils.logger import logger
+from app.utils.utils import rgb_array_to_png, root_hash
+
+router = APIRouter(prefix="/api/v1/canvas", tags=["canvas"])
+
+HISTORY_FORMATS = ("png", "dataurl")
+# 单次区域读取的像素上限，避免一次请求读取整个超大画布
+MAX_REGION_PIXELS = 4_000_000
+# 批量查询像素作者的区域像素上限
+MAX_PIXEL_INFO_PIXELS = 128 * 128
+HEATMAP_FORMATS = ("png", "json")
+# 未指定缩放倍数时，热力图缩小到不超过该格数
+MAX_HEATMAP_CELLS = 256 * 256
+
+
+async def _render_historical_frame(historical: HistoricalFrame, fmt: str, immutable: bool):
+    """Encode a reconstructed frame in the requested format."""
+    loop = asyncio.get_event_loop()
+    png_bytes = await loop.run_in_executor(None, rgb_array_to_png, historical.frame)
+    headers = {
+        "X-Log-Id": str(historical.log_id),
+        "X-Keyframe-Snapshot-Id": str(historical.keyframe_snapshot_id or ""),
+        # 只有不会再有新日志写入的历史时刻才能被永久缓存，其余只短暂缓存
+        "Cache-Control": "public, max-age=31536000, immutable" if immutable else f"public, max-age={HISTORY_RECENT_MAX_AGE}",
+    }
+
+    if fmt == "dataurl":
+        png_base64 = base64.b64encode(png_bytes).decode('utf-8')
+        return {
+            "log_id": historical.log_id,
+            "keyframe_snapshot_id": historical.keyframe_snapshot_id,
+            "data_url": f"data:image/png;base64,{png_base64}",
+        }
+    return Response(content=png_bytes, media_type="image/png", headers=headers)
+
+
+async def _get_canvas_at(canvas: CanvasConfig, log_id: int, fmt: str, immutable: bool = None):
+    if fmt not in HISTORY_FORMATS:
+        raise HTTPException(status_code=400, detail=f"Unsupported format, expected one of {HISTORY_FORMATS}")
+    if log_id < 0:
+        raise HTTPException(status_code=400, detail="log_id must not be negative")
+
+    async with get_read_db_session(min_log_id=log_id) as db:
+        try:
+            historical = await get_history_service(canvas.id).reconstruct(db, log_id)
+        except Exception as e:
+            logger.error(f"Error reconstructing canvas at log ID {log_id}: {str(e)}", exc_info=True)
+            raise HTTPException(status_code=500, detail=f"Error reconstructing canvas: {str(e)}")
+
+    if immutable is None:
+        # 更小的日志ID仍可能在进行中的事务里提交；与按时间查询一样，
+        # 只有不晚于 HISTORY_FINAL_AFTER 之前最后一条日志的ID才视为已定
+        async with get_db_session() as db:
+            settled_log_id = await get_last_log_id_before(
+                db, datetime.utcnow() - timedelta(seconds=HISTORY_FINAL_AFTER)
+            )
+        immutable = log_id <= settled_log_id
+    return await _render_historical_frame(historical, fmt, immutable=immutable)
+
+
+@router.get("/list")
+async def list_canvases():
+    """
+    List the canvases served by this deployment.
+    """
+    return [
+        {"id": canvas.id, "width": canvas.width, "height": canvas.height, "version": canvas.version}
+        for canvas in list_canvas_configs()
+    ]
+
+
+@router.get("/region")
+async def get_canvas_region(
+    x: int,
+    y: int,
+    width: int,
+    height: int,
+    canvas: CanvasConfig = Depends(require_canvas),
+):
+    """
+    Get a rectangular region of the live canvas as a PNG image.
+
+    Only the Redis shards overlapping the region are read.
+
+    Args:
+        x, y: Top-left corner of the region
+        width, height: Size of the region
+        canvas_id: Canvas ID, the default canvas when omitted
+
+    Returns:
+        Response: PNG image of the region
+    """
+    if width <= 0 or height <= 0 or width * height > MAX_REGION_PIXELS:
+        raise HTTPException(status_code=400, detail=f"Region must contain 1 to {MAX_REGION_PIXELS} pixels")
+
+    async with get_redis_connection() as redis_conn:
+        try:
+            region = await CanvasStore(redis_conn, canvas.id).get_region(x, y, width, height)
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=str(e))
+
+    png_bytes = await asyncio.get_event_loop().run_in_executor(None, rgb_array_to_png, region)
+    return Response(content=png_bytes, media_type="image/png", headers={"Cache-Control": "no-cache"})
+
+
+@router.get("/overview/{level}")
+async def get_canvas_overview(
+    level: int,
+    canvas: CanvasConfig = Depends(require_canvas),
+    if_none_match: str = Header(None),
+):
+    """
+    Get the live canvas downsampled by 2**level as a PNG image, for zoomed-out viewers.
+
+    Args:
+        level: Pyramid level, from 1 (half size) to PYRAMID_LEVELS
+        canvas_id: Canvas ID, the default canvas when omitted
+
+    Returns:
+        Response: PNG image of the level, or 304 if the ETag still matches
+    """
+    pyramid = get_pyramid(canvas.id)
+    try:
+        digest, png_bytes = await pyramid.get_png(level)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+    height, width = pyramid.level_shape(level)
+    headers = {
+        "ETag": f'"{canvas.id}-{level}-{digest}"',
+        "Cache-Control": f"public, max-age={PYRAMID_MAX_AGE}",
+        "X-Overview-Scale": str(1 << level),
+        "X-Overview-Size": f"{width}x{height}",
+    }
+    if if_none_match == headers["ETag"]:
+        return Response(status_code=304, headers=headers)
+    return Response(content=png_bytes, media_type="image/png", headers=headers)
+
+
+@router.get("/heatmap")
+async def get_canvas_heatmap(
+    format: str = "png",
+    scale: int = None,
+    canvas: CanvasConfig = Depends(require_canvas),
+):
+    """
+    Get the recent placement activity of the canvas.
+
+    Each cell counts the placements in HEATMAP_CELL_SIZE x HEATMAP_CELL_SIZE
+    pixels, scaled by a weight halving every HEATMAP_HALF_LIFE seconds.
+
+    Args:
+        format: "png" for an image colored on a logarithmic scale, "json" for the counters
+        scale: Cells summed into one along each side, by default the smallest
+            power of two giving at most MAX_HEATMAP_CELLS cells; smaller
+            scales are raised to that one
+
+    Returns:
+        Response: PNG image, or a JSON object with the counters in row-major order
+    """
+    if format not in HEATMAP_FORMATS:
+        raise HTTPException(status_code=400, detail=f"Unsupported format, expected one of {HEATMAP_FORMATS}")
+    if scale is not None and scale < 1:
+        raise HTTPException(status_code=400, detail="scale must be at least 1")
+
+    heatmap = get_heatmap(canvas.id)
+    counts = heatmap.values()
+    # 显式指定的 scale 同样受 MAX_HEATMAP_CELLS 限制
+    minimum_scale = 1
+    while -(-counts.shape[0] // minimum_scale) * -(-counts.shape[1] // minimum_scale) > MAX_HEATMAP_CELLS:
+        minimum_scale *= 2
+    scale = minimum_scale if scale is None else max(scale, minimum_scale)
+    counts = downsample_heatmap(counts, scale)
+    cell_size = heatmap.cell_size * scale
+
+    if format == "json":
+        return {
+            "width": canvas.width,
+            "height": canvas.height,
+            "cell_size": cell_size,
+            "columns": counts.shape[1],
+            "rows": counts.shape[0],
+            "half_life": heatmap.half_life,
+            "max": float(counts.max()) if counts.size else 0.0,
+            "cells": np.round(counts, 3).ravel().tolist(),
+        }
+
+    def encode():
+        rgb, peak = heatmap_to_rgb(counts)
+        return rgb_array_to_png(rgb), peak
+
+    png_bytes, peak = await asyncio.get_event_loop().run_in_executor(None, encode)
+    headers = {
+        "Cache-Control": "no-cache",
+        "X-Heatmap-Cell-Size": str(cell_size),
+        "X-Heatmap-Max": f"{peak:.3f}",
+    }
+    return Response(content=png_bytes, media_type="image/png", headers=headers)
+
+
+@router.get("/hashes")
+async def get_canvas_hashes(canvas: CanvasConfig = Depends(require_canvas)):
+    """
+    Get the tile hashes of the live canvas.
+
+    Each tile hash is the CRC32 of the tile's row-major RGB bytes, and the
+    root the 64-bit BLAKE2b, as 16 hex digits, of the big-endian tile
+    hashes in row-major order.
+
+    Returns:
+        dict: The tile grid, the root hash and the tile hashes in row-major order
+    """
+    tree = get_hash_tree(canvas.id)
+    hashes = await tree.get_hashes()
+    return {
+        "width": tree.canvas.width,
+        "height": tree.canvas.height,
+        "tile_size": tree.tile_size,
+        "columns": tree.tile_columns,
+        "rows": tree.tile_rows,
+        "root": root_hash(hashes),
+        "tiles": hashes.ravel().tolist(),
+    }
+
+
+@router.post("/resync")
+async def resync_canvas(request: CanvasResyncRequest, canvas: CanvasConfig = Depends(require_canvas)):
+    """
+    Get only the tiles of the live canvas that differ from a client's copy.
+
+    The client sends its root hash, its tile hashes (as in /hashes), or
+    both. A matching root returns no tiles; otherwise the tiles whose
+    hashes differ are returned, or all of them when no tile hashes were
+    sent. At most MAX_REGION_PIXELS pixels are returned, with
+    ``truncated`` set when tiles were left out.
+
+    Returns:
+        dict: The live root hash and the differing tiles as PNG data URLs
+    """
+    tree = get_hash_tree(canvas.id)
+    root, stale = await tree.diff(request.root, request.tiles)
+
+    regions, pixels, truncated = [], 0, False
+    async with get_redis_connection() as redis_conn:
+        canvas_store = CanvasStore(redis_conn, canvas.id, canvas=tree.canvas)
+        for row, column in stale:
+            x, y, width, height = tree.tile_bounds(row, column)
+            if pixels + width * height > MAX_REGION_PIXELS:
+                truncated = True
+                break
+            pixels += width * height
+            regions.append((x, y, await canvas_store.get_region(x, y, width, height)))
+
+    def encode():
+        return [rgb_array_to_png(region) for _, _, region in regions]
+
+    png_tiles = await asyncio.get_event_loop().run_in_executor(None, encode)
+    return {
+        "root": root,
+        "width": tree.canvas.width,
+        "height": tree.canvas.height,
+        "truncated": truncated,
+        "tiles": [
+            {
+                "x": x,
+                "y": y,
+                "width": region.shape[1],
+                "height": region.shape[0],
+                "data_url": f"data:image/png;base64,{base64.b64encode(png_bytes).decode('utf-8')}",
+            }
+            for (x, y, region), png_bytes in zip(regions, png_tiles)
+        ],
+    }
+
+
+@router.post("/verify", dependencies=[Depends(require_admin)])
+async def verify_canvas_state(canvas: CanvasConfig = Depends(require_canvas)):
+    """
+    Check the live canvas against its latest snapshot plus the logs after it.
+
+    Requires the X-Admin-Token header. Tiles touched by placements during
+    the check are not compared.
+
+    Returns:
+        dict: The log ID checked against and the (row, column) of mismatched tiles
+    """
+    try:
+        return await verify_canvas(canvas.id)
+    except Exception as e:
+        logger.error(f"Error verifying canvas {canvas.id}: {str(e)}", exc_info=True)
+        raise HTTPException(status_code=500, detail=f"Error verifying canvas: {str(e)}")
+
+
+@router.get("/stream")
+async def stream_canvas(canvas: CanvasConfig = Depends(require_canvas), last_event_id: str = Header(None)):
+    """
+    Follow the canvas read-only as a Server-Sent Events stream.
+
+    Updates are coalesced for SPECTATOR_TICK seconds and sent as
+    ``pixel_batch``, ``region_update`` and ``canvas_resize`` events with the
+    same data as the WebSocket messages. Browsers reconnect with the
+    Last-Event-ID header and receive the missed events, or a ``resync``
+    event when the board has to be reloaded (or resynced with /resync).
+    Load the board first with /pixels or /region.
+
+    Returns:
+        StreamingResponse: A text/event-stream response
+    """
+    return StreamingResponse(
+        spectator_hub.subscribe(canvas.id, last_event_id),
+        media_type="text/event-stream",
+        headers={
+            # 禁止缓存与改写，并关闭 nginx 等反向代理的响应缓冲
+            "Cache-Control": "no-cache, no-store, no-transform",
+            "X-Accel-Buffering": "no",
+        },
+    )
+
+
+@router.get("/pixel/{x}/{y}")
+async def get_pixel(x: int, y: int, canvas: CanvasConfig = Depends(require_canvas)):
+    """
+    Get the current color of a pixel and who placed it.
+
+    Args:
+        x, y: Pixel coordinates
+        canvas_id: Canvas ID, the default canvas when omitted
+
+    Returns:
+        dict: color, log_id, user_id and created_at of the last placement
+    """
+    try:
+        return await get_pixel_info(x, y, canvas.id)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+
+@router.get("/pixels")
+async def get_pixels(
+    x: int,
+    y: int,
+    width: int,
+    height: int,
+    canvas: CanvasConfig = Depends(require_canvas),
+):
+    """
+    Get the colors and authors of the pixels in a rectangle.
+
+    Args:
+        x, y: Top-left corner of the region
+        width, height: Size of the region
+        canvas_id: Canvas ID, the default canvas when omitted
+
+    Returns:
+        dict: Row-major "colors" and "log_ids" lists and the referenced "logs" keyed by log ID
+    """
+    if width <= 0 or height <= 0 or width * height > MAX_PIXEL_INFO_PIXELS:
+        raise HTTPException(status_code=400, detail=f"Region must contain 1 to {MAX_PIXEL_INFO_PIXELS} pixels")
+
+    try:
+        return await get_region_info(x, y, width, height, canvas.id)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+
+@router.post("/pixels/batch", dependencies=[Depends(require_admin)])
+async def place_pixel_batch(batch: PixelBatchEvent, canvas: CanvasConfig = Depends(require_canvas)):
+    """
+    Place a batch of pixels as one unit, for admin and template tools.
+
+    Requires the X-Admin-Token header. The valid pixels are written with one
+    Redis pipeline and one multi-row insert and announced to WebSocket
+    clients as one "pixel_batch" message.
+
+    Args:
+        batch: The placements, up to PIXEL_BATCH_MAX_SIZE
+        canvas_id: Canvas ID, the default canvas when omitted
+
+    Returns:
+        dict: The result of every pixel, in batch order
+    """
+    async with get_redis_connection() as redis_conn:
+        canvas_store = CanvasStore(redis_conn, canvas.id)
+        try:
+            async with get_db_session() as db:
+                results, applied = await CanvasService(canvas_store, db).process_pixel_batch(batch)
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=str(e))
+
+        if applied:
+            await track_placements(canvas_store, len(applied), max(r.log_id for r in results if r.ok))
+            await publish_canvas_message(redis_conn, json.dumps(pixel_batch_message(applied)), canvas.id)
+
+    return {"applied": len(applied), "results": results}
+
+
+@router.post("/resize", dependencies=[Depends(require_admin)])
+async def resize_canvas(request: CanvasResizeRequest, canvas: CanvasConfig = Depends(require_canvas)):
+    """
+    Expand a canvas to the right and/or bottom while it stays live.
+
+    Requires the X-Admin-Token header. Connected clients receive a
+    "canvas_resize" message and fetch the added area; the request returns
+    once placements made during the switch have been moved to the new size.
+
+    Args:
+        request: The new width and height, not smaller than the current ones
+        canvas_id: Canvas ID, the default canvas when omitted
+
+    Returns:
+        dict: The new size and geometry version
+    """
+    try:
+        return await expand_canvas(canvas.id, request.width, request.height)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except RuntimeError as e:
+        raise HTTPException(status_code=409, detail=str(e))
+    except Exception as e:
+        logger.error(f"Error resizing canvas {canvas.id}: {str(e)}", exc_info=True)
+        raise HTTPException(status_code=500, detail=f"Error resizing canvas: {str(e)}")
+
+
+@router.get("/at/{log_id}")
+async def get_canvas_at_log_id(log_id: int, format: str = "png", canvas: CanvasConfig = Depends(require_canvas)):
+    """
+    Get the canvas as it was right after the given pixel log was applied.
+
+    Args:
+        log_id: Pixel log ID
+        format: "png" for a PNG image, "dataurl" for a JSON object with a data URL
+        canvas_id: Canvas ID, the default canvas when omitted
+
+    Returns:
+        Response: The reconstructed canvas
+    """
+    return await _get_canvas_at(canvas, log_id, format)
+
+
+@router.get("/at/time/{timestamp}")
+async def get_canvas_at_time(timestamp: datetime, format: str = "png", canvas: CanvasConfig = Depends(require_canvas)):
+    """
+    Get the canvas as it was at the given time (ISO 8601 or Unix timestamp).
+
+    Args:
+        timestamp: Point in time, in UTC
+        format: "png" for a PNG image, "dataurl" for a JSON object with a data URL
+        canvas_id: Canvas ID, the default canvas when omitted
+
+    Returns:
+        Response: The reconstructed canvas
+    """
+    if timestamp.tzinfo is not None:
+        # pixel_logs.created_at 存储的是不带时区的 UTC 时间
+        timestamp = timestamp.astimezone(timezone.utc).replace(tzinfo=None)
+    # 在主库上解析日志ID：延迟的副本会给出偏早的ID，而该结果可能被永久缓存
+    async with get_db_session() as db:
+        log_id = await get_last_log_id_before(db, timestamp)
+    # 刚过去的时刻仍可能有进行中的落子写入，只有足够早的时刻才能被永久缓存
+    final = timestamp < datetime.utcnow() - timedelta(seconds=HISTORY_FINAL_AFTER)
+    return await _get_canvas_at(canvas, log_id, format, immutable=final)
@@ -0,0 +1,52 @@
+"""
+Admin API endpoints for cleaning up griefed regions of the canvas.
+"""
+
+from fastapi import APIRouter, Depends, HTTPException
+from app.canvas_registry import CanvasConfig
+from app.deps import require_admin, require_canvas
+from app.schemas.moderation import RegionFillRequest, RegionRevertRequest
+from app.services.moderation_service import fill_region, revert_region
+from app.utils.logger import logger
+
+router = APIRouter(prefix="/api/v1/moderation", tags=["moderation"], dependencies=[Depends(require_admin)])
+
+
+@router.post("/region/revert")
+async def revert_canvas_region(request: RegionRevertRequest, canvas: CanvasConfig = Depends(require_canvas)):
+    """
+    Revert a rectangle (optionally masked) to its state at a past log ID or snapshot.
+
+    Requires the X-Admin-Token header.
+
+    Returns:
+        dict: The number of changed pixels, of pixels skipped because they were placed
+            meanwhile, and the range of log IDs written
+    """
+    try:
+        return await revert_region(canvas, request)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except Exception as e:
+        logger.error(f"Error reverting region: {str(e)}", exc_info=True)
+        raise HTTPException(status_code=500, detail=f"Error reverting region: {str(e)}")
+
+
+@router.post("/region/fill")
+async def fill_canvas_region(request: RegionFillRequest, canvas: CanvasConfig = Depends(require_canvas)):
+    """
+    Fill a rectangle (optionally masked) with one color, e.g. to wipe it.
+
+    Requires the X-Admin-Token header.
+
+    Returns:
+        dict: The number of changed pixels, of pixels skipped because they were placed
+            meanwhile, and the range of log IDs written
+    """
+    try:
+        return await fill_region(canvas, request)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except Exception as e:
+        logger.error(f"Error filling region: {str(e)}", exc_info=True)
+        raise HTTPException(status_code=500, detail=f"Error filling region: {str(e)}")
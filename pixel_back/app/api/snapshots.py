@@ -2,48 +2,43 @@
 API endpoints for handling canvas snapshots.
 """
 
-import os
-import json
+import asyncio
 import base64
-from fastapi import APIRouter, HTTPException, Response
+from fastapi import APIRouter, Depends, HTTPException, Response
+from app.canvas_registry import CanvasConfig
 from app.db.crud import get_latest_snapshot, get_pixel_logs_after_id
-from app.deps import get_db_session
-from app.config import SNAPSHOT_DIRECTORY
+from app.deps import get_read_db_session, require_canvas
+from app.services.history_service import load_snapshot_frame, snapshot_size
+from app.services.snapshot_store import snapshot_store
 from app.utils.logger import logger
-from app.utils.utils import png_to_color_array
+from app.utils.utils import rgb_to_hex_colors
 
 router = APIRouter(prefix="/api/v1/snapshots", tags=["snapshots"])
 
 
 @router.get("/latest.png")
-async def get_latest_snapshot_png():
+async def get_latest_snapshot_png(canvas: CanvasConfig = Depends(require_canvas)):
     """
     Get the latest canvas snapshot as a PNG image.
     
     Returns:
         Response: PNG image of the latest canvas snapshot
     """
-    async with get_db_session() as db:
-        snapshot = await get_latest_snapshot(db)
+    async with get_read_db_session() as db:
+        snapshot = await get_latest_snapshot(db, canvas.id)
         
         if not snapshot:
             logger.warning("No snapshot found in database")
             raise HTTPException(status_code=404, detail="No snapshot found")
         
-        snapshot_file_path = os.path.join(SNAPSHOT_DIRECTORY, snapshot.data_file_path)
-        
-        if not os.path.exists(snapshot_file_path):
-            logger.warning(f"Snapshot file not found: {snapshot_file_path}")
+        if not snapshot_store.exists(snapshot.data_file_path):
+            logger.warning(f"Snapshot file not found: {snapshot.data_file_path}")
             raise HTTPException(status_code=404, detail="Snapshot file not found")
         
-        _, ext = os.path.splitext(snapshot_file_path)
-        if ext.lower() != '.png':
-            logger.warning(f"Snapshot file is not a PNG: {snapshot_file_path}")
-            raise HTTPException(status_code=400, detail="Snapshot file is not in PNG format")
-        
         try:
-            with open(snapshot_file_path, 'rb') as f:
-                png_bytes = f.read()
+            png_bytes = await asyncio.get_event_loop().run_in_executor(
+                None, snapshot_store.read_png, snapshot.data_file_path, snapshot_size(snapshot)
+            )
         except Exception as e:
             logger.error(f"Error reading PNG file: {str(e)}")
             raise HTTPException(status_code=500, detail=f"Error reading PNG file: {str(e)}")
@@ -53,37 +48,31 @@ async def get_latest_snapshot_png():
 
 
 @router.get("/latest/dataurl")
-async def get_latest_snapshot_dataurl():
+async def get_latest_snapshot_dataurl(canvas: CanvasConfig = Depends(require_canvas)):
     """
     Get the latest canvas snapshot as a data URL (base64 encoded PNG).
     
     Returns:
         dict: Object containing the data URL of the PNG image
     """
-    async with get_db_session() as db:
-        snapshot = await get_latest_snapshot(db)
+    async with get_read_db_session() as db:
+        snapshot = await get_latest_snapshot(db, canvas.id)
 
         if not snapshot:
             logger.warning("No snapshot found in database")
             raise HTTPException(status_code=404, detail="No snapshot found")
         
-        snapshot_file_path = os.path.join(SNAPSHOT_DIRECTORY, snapshot.data_file_path)
-
-        if not os.path.exists(snapshot_file_path):
-            logger.warning(f"Snapshot file not found: {snapshot_file_path}")
+        if not snapshot_store.exists(snapshot.data_file_path):
+            logger.warning(f"Snapshot file not found: {snapshot.data_file_path}")
             raise HTTPException(status_code=404, detail="Snapshot file not found")
         
-        _, ext = os.path.splitext(snapshot_file_path)
-        if ext.lower() != '.png':
-            logger.warning(f"Snapshot file is not a PNG: {snapshot_file_path}")
-            raise HTTPException(status_code=400, detail="Snapshot file is not in PNG format")
-        
         try:
-            with open(snapshot_file_path, 'rb') as f:
-                png_bytes = f.read()
-                # 将PNG数据转换为base64编码的data URL
-                png_base64 = base64.b64encode(png_bytes).decode('utf-8')
-                data_url = f"data:image/png;base64,{png_base64}"
+            png_bytes = await asyncio.get_event_loop().run_in_executor(
+                None, snapshot_store.read_png, snapshot.data_file_path, snapshot_size(snapshot)
+            )
+            # 将PNG数据转换为base64编码的data URL
+            png_base64 = base64.b64encode(png_bytes).decode('utf-8')
+            data_url = f"data:image/png;base64,{png_base64}"
         except Exception as e:
             logger.error(f"Error reading or encoding PNG file: {str(e)}")
             raise HTTPException(status_code=500, detail=f"Error reading or encoding PNG file: {str(e)}")
@@ -95,60 +84,50 @@ async def get_latest_snapshot_dataurl():
 
 
 @router.get("/latest")
-async def get_latest_snapshot_data():
+async def get_latest_snapshot_data(canvas: CanvasConfig = Depends(require_canvas)):
     """
     Get the latest canvas snapshot as JSON data.
     
     Returns:
         dict: Snapshot information including creation time and data file path
     """
-    async with get_db_session() as db:
-        snapshot = await get_latest_snapshot(db)
+    async with get_read_db_session() as db:
+        snapshot = await get_latest_snapshot(db, canvas.id)
         
         if not snapshot:
             logger.warning("No snapshot found in database")
             raise HTTPException(status_code=404, detail="No snapshot found")
         
-        snapshot_file_path = os.path.join(SNAPSHOT_DIRECTORY, snapshot.data_file_path)
-        
-        if not os.path.exists(snapshot_file_path):
-            logger.warning(f"Snapshot file not found: {snapshot_file_path}")
+        if not snapshot_store.exists(snapshot.data_file_path):
+            logger.warning(f"Snapshot file not found: {snapshot.data_file_path}")
             raise HTTPException(status_code=404, detail="Snapshot file not found")
         
-        _, ext = os.path.splitext(snapshot_file_path)
-        if ext.lower() == '.png':
-            try:
-                color_array = png_to_color_array(snapshot_file_path)
-            except Exception as e:
-                logger.error(f"Error converting PNG to color array: {str(e)}")
-                raise HTTPException(status_code=500, detail=f"Error converting PNG to color array: {str(e)}")
-        else:
-            try:
-                with open(snapshot_file_path, 'r') as f:
-                    color_array = json.load(f)
-            except json.JSONDecodeError as e:
-                logger.error(f"Error decoding JSON from snapshot file: {str(e)}")
-                raise HTTPException(status_code=500, detail=f"Invalid JSON in snapshot file: {str(e)}")
-            except Exception as e:
-                logger.error(f"Error reading snapshot file: {str(e)}")
-                raise HTTPException(status_code=500, detail=f"Error reading snapshot file: {str(e)}")
+        try:
+            frame = await asyncio.get_event_loop().run_in_executor(
+                None, load_snapshot_frame, snapshot
+            )
+            color_array = rgb_to_hex_colors(frame)
+        except Exception as e:
+            logger.error(f"Error reading snapshot file: {str(e)}")
+            raise HTTPException(status_code=500, detail=f"Error reading snapshot file: {str(e)}")
         
         logger.info(f"Successfully served snapshot data. Snapshot ID: {snapshot.id}")
         return {
             "id": snapshot.id,
             "created_at": snapshot.created_at,
             "last_log_id": snapshot.last_log_id,
+            "geometry_version": snapshot.geometry_version or 0,
             "data": color_array
         }
 
 @router.get("/update")
-async def get_update():
-    async with get_db_session() as db:
-        snapshot = await get_latest_snapshot(db)
+async def get_update(canvas: CanvasConfig = Depends(require_canvas)):
+    async with get_read_db_session() as db:
+        snapshot = await get_latest_snapshot(db, canvas.id)
         if not snapshot:
             logger.warning("No snapshot found in database")
             raise HTTPException(status_code=404, detail="No snapshot found")
-        result = await get_pixel_logs_after_id(db, snapshot.last_log_id if snapshot else 0)
+        result = await get_pixel_logs_after_id(db, snapshot.last_log_id if snapshot else 0, canvas.id)
         # 返回上次记录快照之后的数据
         return {
             "last_log_id": snapshot.last_log_id,
@@ -0,0 +1,69 @@
+"""
+API endpoints for exporting canvas timelapses.
+"""
+
+import os
+from fastapi import APIRouter, HTTPException
+from fastapi.responses import FileResponse
+from app.schemas.timelapse import TimelapseRequest
+from app.services.timelapse_service import (
+    get_timelapse_job,
+    get_timelapse_path,
+    start_timelapse_job,
+)
+from app.utils.logger import logger
+
+router = APIRouter(prefix="/api/v1/timelapse", tags=["timelapse"])
+
+TIMELAPSE_MEDIA_TYPES = {"gif": "image/gif", "zip": "application/zip"}
+
+
+@router.post("")
+async def create_timelapse(request: TimelapseRequest):
+    """
+    Start exporting a timelapse in the background.
+
+    Returns:
+        dict: The created job, whose status can be polled at /api/v1/timelapse/{job_id}
+    """
+    try:
+        job = await start_timelapse_job(request)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+    logger.info(f"Started timelapse job {job.id}")
+    return job
+
+
+@router.get("/{job_id}")
+async def get_timelapse_status(job_id: str):
+    """
+    Get the status of a timelapse export job.
+    """
+    job = await get_timelapse_job(job_id)
+    if not job:
+        raise HTTPException(status_code=404, detail="Timelapse job not found")
+    return job
+
+
+@router.get("/{job_id}/download")
+async def download_timelapse(job_id: str):
+    """
+    Download the output of a finished timelapse export job.
+    """
+    job = await get_timelapse_job(job_id)
+    if not job:
+        raise HTTPException(status_code=404, detail="Timelapse job not found")
+    if job.status != "done":
+        raise HTTPException(status_code=409, detail=f"Timelapse job is {job.status}")
+
+    path = get_timelapse_path(job.id, job.format)
+    if not os.path.exists(path):
+        logger.warning(f"Timelapse file not found: {path}")
+        raise HTTPException(status_code=404, detail="Timelapse file not found")
+
+    return FileResponse(
+        path,
+        media_type=TIMELAPSE_MEDIA_TYPES[job.format],
+        filename=os.path.basename(path),
+    )
@@ -0,0 +1,91 @@
+"""
+API endpoints for per-user placement statistics and leaderboards.
+"""
+
+from datetime import datetime, timezone
+from typing import Optional
+from fastapi import APIRouter, Depends, HTTPException
+from app.canvas_registry import CanvasConfig
+from app.deps import get_redis_connection, require_admin, require_canvas
+from app.redis_store.user_stats import UserStatsStore, decode_cursor, encode_cursor
+from app.services.user_stats_service import start_user_stats_rebuild
+from app.utils.logger import logger
+
+router = APIRouter(prefix="/api/v1/users", tags=["users"])
+
+MAX_LEADERBOARD_PAGE_SIZE = 200
+
+
+def _format_time(timestamp: Optional[float]) -> Optional[datetime]:
+    return datetime.fromtimestamp(timestamp, timezone.utc) if timestamp is not None else None
+
+
+@router.get("/leaderboard")
+async def get_leaderboard(
+    limit: int = 50,
+    cursor: Optional[str] = None,
+    canvas: CanvasConfig = Depends(require_canvas),
+):
+    """
+    Get the users with the most placements, one page at a time.
+
+    Args:
+        limit: Page size
+        cursor: "next_cursor" of the previous page, omitted for the first page
+        canvas_id: Canvas ID, the default canvas when omitted
+
+    Returns:
+        dict: The page entries, the total number of users and the cursor of the next page
+    """
+    if not 1 <= limit <= MAX_LEADERBOARD_PAGE_SIZE:
+        raise HTTPException(status_code=400, detail=f"limit must be between 1 and {MAX_LEADERBOARD_PAGE_SIZE}")
+
+    async with get_redis_connection() as redis_conn:
+        store = UserStatsStore(redis_conn, canvas.id)
+        try:
+            after = decode_cursor(cursor) if cursor else None
+        except ValueError:
+            raise HTTPException(status_code=400, detail="Invalid cursor")
+        entries = await store.leaderboard(after, limit)
+        total = await store.count_users()
+
+    return {
+        "total": total,
+        "entries": [
+            {
+                "rank": rank + 1,
+                "user_id": user_id,
+                "placements": placements,
+                "last_placed_at": _format_time(last_placed),
+            }
+            for rank, user_id, placements, last_placed in entries
+        ],
+        "next_cursor": encode_cursor(entries[-1][2], entries[-1][1]) if len(entries) == limit else None,
+    }
+
+
+@router.get("/{user_id}/stats")
+async def get_user_stats(user_id: str, canvas: CanvasConfig = Depends(require_canvas)):
+    """
+    Get the placement count, leaderboard rank and last placement time of a user.
+    """
+    async with get_redis_connection() as redis_conn:
+        placements, rank, last_placed = await UserStatsStore(redis_conn, canvas.id).get_user(user_id)
+    if rank is None:
+        raise HTTPException(status_code=404, detail="User has no placements")
+    return {
+        "user_id": user_id,
+        "placements": placements,
+        "rank": rank + 1,
+        "last_placed_at": _format_time(last_placed),
+    }
+
+
+@router.post("/stats/rebuild", dependencies=[Depends(require_admin)])
+async def rebuild_stats(canvas: CanvasConfig = Depends(require_canvas)):
+    """
+    Rebuild the user statistics of a canvas from the pixel logs in the background.
+    """
+    start_user_stats_rebuild(canvas.id)
+    logger.info(f"Started rebuilding user statistics of canvas {canvas.id}")
+    return {"status": "started", "canvas_id": canvas.id}
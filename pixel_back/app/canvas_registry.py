@@ -0,0 +1,177 @@
+"""
+Registry of the canvases served by this deployment.
+
+The default canvas uses CANVAS_WIDTH/CANVAS_HEIGHT and keeps the Redis keys
+used before multi-canvas support, so existing data stays valid. Additional
+canvases are declared with the CANVASES setting.
+
+The configured size is geometry version 0. Canvases can be expanded at
+runtime (see ``geometry_service``); every expansion is a new geometry
+version that applies to the logs after a given log ID, and the registry
+keeps that history so past frames are rebuilt at the size they had.
+"""
+
+import re
+from dataclasses import dataclass, replace
+from typing import Dict, Iterator, List, Optional, Tuple
+from app.config import CANVAS_WIDTH, CANVAS_HEIGHT, CANVAS_SHARD_SIZE, CANVASES
+
+DEFAULT_CANVAS_ID = "default"
+
+CANVAS_ID_PATTERN = re.compile(r"^[A-Za-z0-9_-]{1,64}$")
+
+
+@dataclass(frozen=True)
+class CanvasConfig:
+    """Geometry and Redis layout of one canvas.
+
+    A canvas with a positive ``shard_size`` is split into square regions of
+    that side, each stored under its own Redis key; the last row and column
+    of shards may be smaller. ``version`` is the geometry version, bumped by
+    every expansion.
+    """
+    id: str
+    width: int
+    height: int
+    shard_size: int = 0
+    version: int = 0
+
+    @property
+    def is_default(self) -> bool:
+        return self.id == DEFAULT_CANVAS_ID
+
+    @property
+    def sharded(self) -> bool:
+        return self.shard_size > 0 and (self.shard_size < self.width or self.shard_size < self.height)
+
+    @property
+    def shard_columns(self) -> int:
+        return -(-self.width // self.shard_size) if self.sharded else 1
+
+    @property
+    def shard_rows(self) -> int:
+        return -(-self.height // self.shard_size) if self.sharded else 1
+
+    def contains(self, x: int, y: int) -> bool:
+        return 0 <= x < self.width and 0 <= y < self.height
+
+    def shard_bounds(self, row: int, column: int) -> Tuple[int, int, int, int]:
+        """Get the (x, y, width, height) region covered by a shard."""
+        if not self.sharded:
+            return 0, 0, self.width, self.height
+        x0 = column * self.shard_size
+        y0 = row * self.shard_size
+        return x0, y0, min(self.shard_size, self.width - x0), min(self.shard_size, self.height - y0)
+
+    def shard_of(self, x: int, y: int) -> Tuple[int, int]:
+        """Get the (row, column) of the shard holding pixel (x, y)."""
+        if not self.sharded:
+            return 0, 0
+        return y // self.shard_size, x // self.shard_size
+
+    def shards(self) -> Iterator[Tuple[int, int]]:
+        for row in range(self.shard_rows):
+            for column in range(self.shard_columns):
+                yield row, column
+
+    def shards_in_region(self, x: int, y: int, width: int, height: int) -> Iterator[Tuple[int, int]]:
+        """Get the shards overlapping a region."""
+        if not self.sharded:
+            yield 0, 0
+            return
+        for row in range(y // self.shard_size, (y + height - 1) // self.shard_size + 1):
+            for column in range(x // self.shard_size, (x + width - 1) // self.shard_size + 1):
+                yield row, column
+
+
+def parse_canvases(spec: str) -> List[CanvasConfig]:
+    """Parse the CANVASES setting.
+
+    Raises:
+        ValueError: If an entry is malformed
+    """
+    canvases = []
+    for entry in filter(None, (part.strip() for part in spec.split(","))):
+        parts = entry.split(":")
+        if len(parts) not in (2, 3) or not CANVAS_ID_PATTERN.match(parts[0]):
+            raise ValueError(f"Invalid canvas definition: {entry}")
+        width, _, height = parts[1].lower().partition("x")
+        shard_size = int(parts[2]) if len(parts) == 3 else 0
+        canvases.append(CanvasConfig(parts[0], int(width), int(height), shard_size))
+    return canvases
+
+
+def _load_canvases() -> Dict[str, CanvasConfig]:
+    canvases = {DEFAULT_CANVAS_ID: CanvasConfig(DEFAULT_CANVAS_ID, CANVAS_WIDTH, CANVAS_HEIGHT, CANVAS_SHARD_SIZE)}
+    for canvas in parse_canvases(CANVASES):
+        canvases[canvas.id] = canvas
+    return canvases
+
+
+canvases: Dict[str, CanvasConfig] = _load_canvases()
+
+# 每个画布的尺寸历史：(生效前的最后一个日志ID, 版本, 宽, 高)，按版本升序
+_geometry_history: Dict[str, List[Tuple[int, int, int, int]]] = {
+    canvas.id: [(0, 0, canvas.width, canvas.height)] for canvas in canvases.values()
+}
+
+
+def get_canvas_config(canvas_id: str = DEFAULT_CANVAS_ID) -> CanvasConfig:
+    """Get a canvas by ID.
+
+    Raises:
+        KeyError: If the canvas is not configured
+    """
+    return canvases[canvas_id or DEFAULT_CANVAS_ID]
+
+
+def list_canvas_configs() -> List[CanvasConfig]:
+    return list(canvases.values())
+
+
+def set_canvas_geometry(canvas_id: str, version: int, width: int, height: int, after_log_id: int) -> CanvasConfig:
+    """Record a geometry version of a canvas, and make it current if it is the newest.
+
+    Args:
+        after_log_id: Last log ID placed on the previous geometry
+
+    Raises:
+        KeyError: If the canvas is not configured
+    """
+    canvas = canvases[canvas_id]
+    history = _geometry_history[canvas_id]
+    if all(known != version for _, known, _, _ in history):
+        history.append((after_log_id, version, width, height))
+        history.sort(key=lambda entry: entry[1])
+    if version > canvas.version:
+        canvases[canvas_id] = replace(canvas, width=width, height=height, version=version)
+    return canvases[canvas_id]
+
+
+def canvas_geometry_of_version(canvas_id: str, version: Optional[int]) -> Tuple[int, int]:
+    """Get the (width, height) of a geometry version of a canvas.
+
+    Raises:
+        KeyError: If the canvas is not configured or the version is unknown
+    """
+    canvas = canvases[canvas_id or DEFAULT_CANVAS_ID]
+    for _, known, width, height in _geometry_history[canvas.id]:
+        if known == (version or 0):
+            return width, height
+    raise KeyError(f"Unknown geometry version {version} of canvas {canvas.id}")
+
+
+def canvas_geometry_at(canvas_id: str, log_id: Optional[int]) -> Tuple[int, int]:
+    """Get the (width, height) of a canvas right after log_id was applied, or the current one for None.
+
+    Raises:
+        KeyError: If the canvas is not configured
+    """
+    canvas = canvases[canvas_id or DEFAULT_CANVAS_ID]
+    if log_id is None:
+        return canvas.width, canvas.height
+    width, height = 0, 0
+    for after_log_id, version, version_width, version_height in _geometry_history[canvas.id]:
+        if version == 0 or after_log_id < log_id:
+            width, height = version_width, version_height
+    return width, height
@@ -1,40 +1,263 @@
+import asyncio
+
 from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.future import select
-from app.db.models import PixelLog, CanvasSnapshot
+from app.db.models import PixelLog, CanvasSnapshot, CanvasGeometry
 from app.schemas.events import PixelUpdateEvent
+from sqlalchemy import delete, func, insert, text
 from datetime import datetime
-from typing import List
+from typing import AsyncIterator, List, Optional
+from app.canvas_registry import DEFAULT_CANVAS_ID
 
 
-async def create_pixel_log(db: AsyncSession, event: PixelUpdateEvent) -> PixelLog:
+async def create_pixel_log(db: AsyncSession, event: PixelUpdateEvent, canvas_id: str = DEFAULT_CANVAS_ID) -> PixelLog:
     """Create a new pixel log entry."""
     db_log = PixelLog(
+        canvas_id=canvas_id,
         user_id=event.user_id,
         x=event.x,
         y=event.y,
         color=event.color,
-        created_at=event.timestamp or datetime.utcnow()
+        # 使用服务器时间：客户端时间不可信，按时间查找日志依赖其与ID大致同序
+        created_at=datetime.utcnow()
     )
     db.add(db_log)
     await db.flush()  # 刷新以获取ID，但不提交事务
     return db_log
 
 
-async def get_pixel_logs_after_id(db: AsyncSession, pixel_log_id: int) -> List[PixelLog]:
-    """Get pixel logs with IDs greater than the specified ID."""
+# asyncpg 单条语句最多 32767 个参数，每行 6 列
+PIXEL_LOG_INSERT_CHUNK_SIZE = 5000
+
+
+async def _insert_pixel_log_rows(db: AsyncSession, rows: List[dict]) -> List[int]:
+    """Insert pixel log rows with multi-row inserts and return their IDs in row order.
+
+    Each statement returns the IDs with their pixels, and rows are mapped to
+    IDs by pixel. A pixel repeated in the rows starts a new statement, so
+    its placements get increasing IDs in row order.
+    """
+    log_ids = []
+    start = 0
+    while start < len(rows):
+        pixels = set()
+        end = start
+        while end < len(rows) and end - start < PIXEL_LOG_INSERT_CHUNK_SIZE:
+            pixel = (rows[end]["x"], rows[end]["y"])
+            if pixel in pixels:
+                break
+            pixels.add(pixel)
+            end += 1
+        result = await db.execute(
+            insert(PixelLog).values(rows[start:end]).returning(PixelLog.id, PixelLog.x, PixelLog.y)
+        )
+        id_by_pixel = {(x, y): log_id for log_id, x, y in result.all()}
+        log_ids.extend(id_by_pixel[(row["x"], row["y"])] for row in rows[start:end])
+        start = end
+    return log_ids
+
+
+async def create_pixel_logs(
+    db: AsyncSession, events: List[PixelUpdateEvent], canvas_id: str = DEFAULT_CANVAS_ID
+) -> List[int]:
+    """Create pixel log entries with multi-row inserts, stamped with the server time.
+
+    Returns:
+        The IDs of the new entries, in the order of ``events``
+    """
+    now = datetime.utcnow()
+    return await _insert_pixel_log_rows(db, [
+        {
+            "canvas_id": canvas_id,
+            "user_id": event.user_id,
+            "x": event.x,
+            "y": event.y,
+            "color": event.color,
+            "created_at": now,
+        }
+        for event in events
+    ])
+
+
+async def create_pixel_logs_bulk(
+    db: AsyncSession,
+    xs: List[int],
+    ys: List[int],
+    colors: List[str],
+    user_id: Optional[str],
+    created_at: datetime,
+    canvas_id: str = DEFAULT_CANVAS_ID,
+) -> List[int]:
+    """Create pixel log entries sharing one author and time, e.g. for a region rewrite.
+
+    Returns:
+        The IDs of the new entries, in input order
+    """
+    return await _insert_pixel_log_rows(db, [
+        {"canvas_id": canvas_id, "user_id": user_id, "x": x, "y": y, "color": color, "created_at": created_at}
+        for x, y, color in zip(xs, ys, colors)
+    ])
+
+
+async def get_pixel_logs_after_id(
+    db: AsyncSession, pixel_log_id: int, canvas_id: str = DEFAULT_CANVAS_ID
+) -> List[PixelLog]:
+    """Get pixel logs of a canvas with IDs greater than the specified ID."""
     result = await db.execute(
         select(PixelLog)
-        .where(PixelLog.id > pixel_log_id)
+        .where(PixelLog.canvas_id == canvas_id, PixelLog.id > pixel_log_id)
         .order_by(PixelLog.id)
     )
     return list(result.scalars().all())
 
 
-async def get_latest_snapshot(db: AsyncSession) -> CanvasSnapshot:
-    """Get the latest canvas snapshot."""
+async def get_pixel_logs_chunk(
+    db: AsyncSession,
+    after_id: int,
+    up_to_id: Optional[int] = None,
+    limit: int = 10000,
+    canvas_id: Optional[str] = DEFAULT_CANVAS_ID,
+) -> list:
+    """Get at most ``limit`` pixel logs with after_id < id <= up_to_id in id order.
+
+    Logs of every canvas are returned when canvas_id is None.
+    """
+    query = (
+        select(
+            PixelLog.id, PixelLog.x, PixelLog.y, PixelLog.color,
+            PixelLog.user_id, PixelLog.created_at, PixelLog.canvas_id,
+        )
+        .where(PixelLog.id > after_id)
+        .order_by(PixelLog.id)
+        .limit(limit)
+    )
+    if up_to_id is not None:
+        query = query.where(PixelLog.id <= up_to_id)
+    if canvas_id is not None:
+        query = query.where(PixelLog.canvas_id == canvas_id)
+    result = await db.execute(query)
+    return result.all()
+
+
+async def iter_pixel_logs(
+    db: AsyncSession,
+    after_id: int,
+    up_to_id: Optional[int] = None,
+    chunk_size: int = 10000,
+    canvas_id: Optional[str] = DEFAULT_CANVAS_ID,
+) -> AsyncIterator[list]:
+    """Stream pixel logs with after_id < id <= up_to_id in id order, chunk by chunk.
+
+    Uses keyset pagination on the primary key so that each chunk is a cheap
+    index range scan and only one chunk is held in memory at a time. Logs of
+    every canvas are returned when canvas_id is None.
+    """
+    last_id = after_id
+    while True:
+        rows = await get_pixel_logs_chunk(db, last_id, up_to_id, chunk_size, canvas_id)
+        if not rows:
+            return
+        yield rows
+        if len(rows) < chunk_size:
+            return
+        last_id = rows[-1].id
+
+
+async def count_pixel_logs_after_id(
+    db: AsyncSession, pixel_log_id: int, canvas_id: str = DEFAULT_CANVAS_ID
+) -> int:
+    """Count pixel logs of a canvas with IDs greater than the specified ID."""
+    result = await db.execute(
+        select(func.count()).where(PixelLog.canvas_id == canvas_id, PixelLog.id > pixel_log_id)
+    )
+    return result.scalar() or 0
+
+
+async def delete_pixel_logs_in_range(db: AsyncSession, after_id: int, up_to_id: int) -> int:
+    """Delete pixel logs with after_id < id <= up_to_id and return the number deleted."""
+    result = await db.execute(
+        delete(PixelLog).where(PixelLog.id > after_id, PixelLog.id <= up_to_id)
+    )
+    return result.rowcount or 0
+
+
+async def delete_pixel_logs_by_ids(db: AsyncSession, log_ids: List[int]) -> int:
+    """Delete pixel logs by ID and return the number deleted."""
+    if not log_ids:
+        return 0
+    result = await db.execute(delete(PixelLog).where(PixelLog.id.in_(log_ids)))
+    return result.rowcount or 0
+
+
+async def get_max_pixel_log_id(db: AsyncSession) -> int:
+    """Get the largest pixel log ID, or 0 if there are no logs."""
+    result = await db.execute(select(func.max(PixelLog.id)))
+    return result.scalar() or 0
+
+
+async def get_last_pixel_log_id_before(db: AsyncSession, timestamp: datetime) -> int:
+    """Get the ID of the last pixel log created at or before the given time, or 0."""
+    result = await db.execute(
+        select(func.max(PixelLog.id)).where(PixelLog.created_at <= timestamp)
+    )
+    return result.scalar() or 0
+
+
+async def get_pixel_logs_by_ids(db: AsyncSession, log_ids: List[int]) -> List[PixelLog]:
+    """Get pixel logs by ID, skipping IDs that no longer exist."""
+    if not log_ids:
+        return []
+    result = await db.execute(select(PixelLog).where(PixelLog.id.in_(log_ids)))
+    return list(result.scalars().all())
+
+
+async def get_last_pixel_log_at(
+    db: AsyncSession, x: int, y: int, canvas_id: str = DEFAULT_CANVAS_ID
+) -> Optional[PixelLog]:
+    """Get the latest pixel log at (x, y) of a canvas."""
+    result = await db.execute(
+        select(PixelLog)
+        .where(PixelLog.canvas_id == canvas_id, PixelLog.x == x, PixelLog.y == y)
+        .order_by(PixelLog.id.desc())
+        .limit(1)
+    )
+    return result.scalars().first()
+
+
+async def get_snapshot_by_id(db: AsyncSession, snapshot_id: int) -> Optional[CanvasSnapshot]:
+    """Get a canvas snapshot by ID."""
+    result = await db.execute(select(CanvasSnapshot).where(CanvasSnapshot.id == snapshot_id))
+    return result.scalars().first()
+
+
+async def list_snapshots(db: AsyncSession, canvas_id: Optional[str] = None) -> List[CanvasSnapshot]:
+    """Get the snapshots of a canvas (or of every canvas) ordered by the last log ID they include."""
+    query = select(CanvasSnapshot).order_by(CanvasSnapshot.last_log_id, CanvasSnapshot.id)
+    if canvas_id is not None:
+        query = query.where(CanvasSnapshot.canvas_id == canvas_id)
+    result = await db.execute(query)
+    return list(result.scalars().all())
+
+
+async def get_oldest_snapshot(db: AsyncSession, canvas_id: str = DEFAULT_CANVAS_ID) -> Optional[CanvasSnapshot]:
+    """Get the retained snapshot of a canvas that includes the fewest logs."""
+    result = await db.execute(
+        select(CanvasSnapshot)
+        .where(CanvasSnapshot.canvas_id == canvas_id)
+        .order_by(CanvasSnapshot.last_log_id, CanvasSnapshot.id)
+        .limit(1)
+    )
+    return result.scalars().first()
+
+
+async def get_latest_snapshot(db: AsyncSession, canvas_id: str = DEFAULT_CANVAS_ID) -> CanvasSnapshot:
+    """Get the latest snapshot of a canvas."""
     try:
         result = await db.execute(
-            select(CanvasSnapshot).order_by(CanvasSnapshot.created_at.desc()).limit(1)
+            select(CanvasSnapshot)
+            .where(CanvasSnapshot.canvas_id == canvas_id)
+            .order_by(CanvasSnapshot.created_at.desc())
+            .limit(1)
         )
         return result.scalars().first()
     except Exception as e:
@@ -43,13 +266,68 @@ async def get_latest_snapshot(db: AsyncSession) -> CanvasSnapshot:
         return None
 
 
-async def create_snapshot(db: AsyncSession, last_log_id: int, file_path: str) -> CanvasSnapshot:
+async def create_snapshot(
+    db: AsyncSession, last_log_id: int, file_path: str, canvas_id: str = DEFAULT_CANVAS_ID,
+    geometry_version: int = 0,
+) -> CanvasSnapshot:
     """Create a new canvas snapshot."""
     snapshot = CanvasSnapshot(
+        canvas_id=canvas_id,
         last_log_id=last_log_id,
         data_file_path=file_path,
-        created_at=datetime.utcnow()
+        created_at=datetime.utcnow(),
+        geometry_version=geometry_version,
     )
     db.add(snapshot)
     await db.flush()  # 刷新以获取ID，但不提交事务
-    return snapshot
\ No newline at end of file
+    return snapshot
+
+
+async def delete_snapshots(db: AsyncSession, snapshot_ids: List[int]) -> int:
+    """Delete canvas snapshot rows by ID and return the number deleted."""
+    if not snapshot_ids:
+        return 0
+    result = await db.execute(delete(CanvasSnapshot).where(CanvasSnapshot.id.in_(snapshot_ids)))
+    return result.rowcount or 0
+
+
+async def create_canvas_geometry(
+    db: AsyncSession, canvas_id: str, version: int, width: int, height: int, after_log_id: int
+) -> CanvasGeometry:
+    """Record a new geometry version of a canvas."""
+    geometry = CanvasGeometry(
+        canvas_id=canvas_id,
+        version=version,
+        width=width,
+        height=height,
+        after_log_id=after_log_id,
+        created_at=datetime.utcnow(),
+    )
+    db.add(geometry)
+    await db.flush()
+    return geometry
+
+
+async def list_canvas_geometries(db: AsyncSession) -> List[CanvasGeometry]:
+    """Get the geometry versions of every canvas, oldest first."""
+    result = await db.execute(select(CanvasGeometry).order_by(CanvasGeometry.canvas_id, CanvasGeometry.version))
+    return list(result.scalars().all())
+
+
+async def wait_for_concurrent_transactions(db: AsyncSession, poll_interval: float = 0.1) -> float:
+    """Wait until every transaction in progress when called has committed or rolled back.
+
+    Only PostgreSQL exposes the running transactions; on other databases
+    this returns at once.
+
+    Returns:
+        The number of seconds waited
+    """
+    if db.bind.dialect.name != "postgresql":
+        return 0.0
+    start = asyncio.get_event_loop().time()
+    # 此刻之前分配的事务ID都小于 xmax；最老的运行中事务不小于它时，这些事务都已结束
+    xmax = await db.scalar(text("SELECT pg_snapshot_xmax(pg_current_snapshot())::text::numeric"))
+    while await db.scalar(text("SELECT pg_snapshot_xmin(pg_current_snapshot())::text::numeric")) < xmax:
+        await asyncio.sleep(poll_interval)
+    return asyncio.get_event_loop().time() - start
@@ -0,0 +1,99 @@
+"""
+Idempotent schema upgrades of existing databases.
+
+The tables of the first release are created outside the app; the columns
+and indexes added since then are listed here and applied at startup by
+``upgrade_schema``. Every statement is a no-op once applied. Tables added
+since then are created by entries without a table name, which always run;
+other statements for tables that do not exist yet are skipped.
+
+Index builds run ``CONCURRENTLY`` on an autocommit connection, so that a
+large pixel_logs keeps taking inserts while they run. A failed concurrent
+build leaves an invalid index behind, which ``IF NOT EXISTS`` would then
+skip; such indexes are dropped and built again. Partitioned tables do not
+support concurrent builds, and get their indexes from
+``PARTITIONED_PIXEL_LOGS_DDL`` instead.
+"""
+
+from typing import List, Optional, Tuple
+
+from sqlalchemy import text
+from sqlalchemy.ext.asyncio import AsyncConnection
+
+from app.utils.logger import logger
+
+# 启动时持有的会话级咨询锁，避免多个 worker 同时升级
+SCHEMA_UPGRADE_LOCK = 7_202_030
+
+# (表名或 None, 索引名或 None, 语句)，按顺序执行；表名为 None 的语句总是执行
+SCHEMA_UPGRADES: List[Tuple[Optional[str], Optional[str], str]] = [
+    # 多画布
+    ("pixel_logs", None, "ALTER TABLE pixel_logs ADD COLUMN IF NOT EXISTS canvas_id VARCHAR DEFAULT 'default'"),
+    ("pixel_logs", "ix_pixel_logs_canvas_id",
+     "CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_pixel_logs_canvas_id ON pixel_logs (canvas_id)"),
+    ("pixel_logs", "ix_pixel_logs_canvas_id_id",
+     "CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_pixel_logs_canvas_id_id ON pixel_logs (canvas_id, id)"),
+    ("pixel_logs", "ix_pixel_logs_canvas_id_x_y_id",
+     "CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_pixel_logs_canvas_id_x_y_id ON pixel_logs (canvas_id, x, y, id)"),
+    ("pixel_logs", "ix_pixel_logs_created_at",
+     "CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_pixel_logs_created_at ON pixel_logs (created_at)"),
+    ("canvas_snapshots", None,
+     "ALTER TABLE canvas_snapshots ADD COLUMN IF NOT EXISTS canvas_id VARCHAR DEFAULT 'default'"),
+    ("canvas_snapshots", "ix_canvas_snapshots_canvas_id",
+     "CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_canvas_snapshots_canvas_id ON canvas_snapshots (canvas_id)"),
+    # 画布扩展
+    ("canvas_snapshots", None,
+     "ALTER TABLE canvas_snapshots ADD COLUMN IF NOT EXISTS geometry_version INTEGER DEFAULT 0"),
+    (None, None,
+     "CREATE TABLE IF NOT EXISTS canvas_geometries (id BIGSERIAL PRIMARY KEY, "
+     "canvas_id VARCHAR DEFAULT 'default', version INTEGER, width INTEGER, height INTEGER, "
+     "after_log_id BIGINT, created_at TIMESTAMP)"),
+    ("canvas_geometries", "ix_canvas_geometries_canvas_id",
+     "CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_canvas_geometries_canvas_id ON canvas_geometries (canvas_id)"),
+    ("canvas_geometries", "ix_canvas_geometries_canvas_id_version",
+     "CREATE UNIQUE INDEX CONCURRENTLY IF NOT EXISTS ix_canvas_geometries_canvas_id_version "
+     "ON canvas_geometries (canvas_id, version)"),
+]
+
+
+async def _relation_kind(conn: AsyncConnection, name: str) -> Optional[str]:
+    result = await conn.execute(text("SELECT relkind FROM pg_class WHERE oid = to_regclass(:name)"), {"name": name})
+    kind = result.scalar()
+    # asyncpg 将 "char" 类型返回为 bytes
+    return kind.decode() if isinstance(kind, bytes) else kind
+
+
+async def _drop_invalid_index(conn: AsyncConnection, index: str):
+    result = await conn.execute(
+        text("SELECT NOT indisvalid FROM pg_index WHERE indexrelid = to_regclass(:name)"), {"name": index}
+    )
+    if result.scalar():
+        logger.warning(f"Dropping invalid index {index} left by an interrupted build")
+        await conn.execute(text(f"DROP INDEX CONCURRENTLY IF EXISTS {index}"))
+
+
+async def upgrade_schema(conn: AsyncConnection) -> int:
+    """Apply the schema upgrades; call at startup.
+
+    ``conn`` must be in autocommit mode (see ``get_autocommit_connection``).
+
+    Returns:
+        The number of statements executed
+    """
+    await conn.execute(text("SELECT pg_advisory_lock(:key)"), {"key": SCHEMA_UPGRADE_LOCK})
+    try:
+        executed = 0
+        for table, index, statement in SCHEMA_UPGRADES:
+            kind = None if table is None else await _relation_kind(conn, table)
+            if table is not None and kind is None:
+                continue
+            if index is not None:
+                if kind == "p":
+                    # 分区表的索引由建表语句创建
+                    continue
+                await _drop_invalid_index(conn, index)
+            await conn.execute(text(statement))
+            executed += 1
+        return executed
+    finally:
+        await conn.execute(text("SELECT pg_advisory_unlock(:key)"), {"key": SCHEMA_UPGRADE_LOCK})
@@ -1,6 +1,7 @@
-from sqlalchemy import Column, Integer, String, DateTime, BigInteger
+from sqlalchemy import Column, Integer, String, DateTime, BigInteger, Index
 from sqlalchemy.ext.declarative import declarative_base
 from datetime import datetime
+from app.canvas_registry import DEFAULT_CANVAS_ID
 
 Base = declarative_base()
 
@@ -10,11 +11,18 @@ class PixelLog(Base):
     __tablename__ = "pixel_logs"
 
     id = Column(BigInteger, primary_key=True, index=True, autoincrement=True)
+    canvas_id = Column(String, default=DEFAULT_CANVAS_ID, server_default=DEFAULT_CANVAS_ID, index=True)
     user_id = Column(String, index=True)
     x = Column(Integer)
     y = Column(Integer)
     color = Column(String)
-    created_at = Column(DateTime, default=datetime.utcnow)
+    created_at = Column(DateTime, default=datetime.utcnow, index=True)
+
+    __table_args__ = (
+        Index("ix_pixel_logs_canvas_id_id", "canvas_id", "id"),
+        # 查询某个像素的最后写入者
+        Index("ix_pixel_logs_canvas_id_x_y_id", "canvas_id", "x", "y", "id"),
+    )
 
 
 class CanvasSnapshot(Base):
@@ -22,6 +30,30 @@ class CanvasSnapshot(Base):
     __tablename__ = "canvas_snapshots"
 
     id = Column(BigInteger, primary_key=True, index=True, autoincrement=True)
+    canvas_id = Column(String, default=DEFAULT_CANVAS_ID, server_default=DEFAULT_CANVAS_ID, index=True)
     created_at = Column(DateTime, default=datetime.utcnow)
     last_log_id = Column(BigInteger)
-    data_file_path = Column(String)
\ No newline at end of file
+    data_file_path = Column(String)
+    # 快照所对应的画布尺寸版本
+    geometry_version = Column(Integer, default=0, server_default="0")
+
+
+class CanvasGeometry(Base):
+    """Model for the geometry versions of a canvas.
+
+    Version 0 is the configured size and has no row. A version applies to
+    the pixel logs with IDs above ``after_log_id``.
+    """
+    __tablename__ = "canvas_geometries"
+
+    id = Column(BigInteger, primary_key=True, index=True, autoincrement=True)
+    canvas_id = Column(String, default=DEFAULT_CANVAS_ID, server_default=DEFAULT_CANVAS_ID, index=True)
+    version = Column(Integer)
+    width = Column(Integer)
+    height = Column(Integer)
+    after_log_id = Column(BigInteger)
+    created_at = Column(DateTime, default=datetime.utcnow)
+
+    __table_args__ = (
+        Index("ix_canvas_geometries_canvas_id_version", "canvas_id", "version", unique=True),
+    )
\ No newline at end of file
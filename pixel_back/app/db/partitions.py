@@ -0,0 +1,196 @@
+"""
+Range partitioning of pixel_logs by ID.
+
+When PIXEL_LOG_PARTITION_SIZE is set, pixel_logs is expected to be a
+partitioned table whose partitions are named ``pixel_logs_p<n>`` and hold the
+IDs in [n * size, (n + 1) * size). Partitions are created ahead of the
+current maximum ID, and fully archived ones can be dropped instead of being
+deleted row by row, which keeps the hot table and its indexes small and
+avoids vacuum work.
+
+On a fresh database, ``prepare_pixel_logs`` creates pixel_logs as a
+partitioned table at startup. An existing unpartitioned table is left alone
+(partition maintenance is skipped with an error in the log) and has to be
+migrated offline, e.g.:
+
+    ALTER TABLE pixel_logs RENAME TO pixel_logs_old;
+    -- start the app once so that it creates the partitioned table and its partitions
+    INSERT INTO pixel_logs (id, canvas_id, user_id, x, y, color, created_at)
+        SELECT id, canvas_id, user_id, x, y, color, created_at FROM pixel_logs_old;
+    SELECT setval('pixel_logs_id_seq', (SELECT max(id) FROM pixel_logs));
+
+Archived partitions are detached outside the archival transaction, with
+``DETACH PARTITION ... CONCURRENTLY`` so that inserts are not blocked. That
+form is not allowed while a default partition exists; the partitions are
+then detached one by one in short transactions with a lock timeout.
+"""
+
+import re
+from typing import List, Optional, Tuple, Union
+from sqlalchemy import text
+from sqlalchemy.ext.asyncio import AsyncConnection, AsyncSession
+from app.config import PIXEL_LOG_PARTITION_SIZE
+from app.utils.logger import logger
+
+PARTITION_NAME_PATTERN = re.compile(r"^pixel_logs_p(\d+)$")
+# 建表时持有的事务级咨询锁，避免多个 worker 同时建表
+PIXEL_LOGS_SETUP_LOCK = 7_202_026
+# 非并发分离分区时等待表锁的上限，超时后下次维护再试
+DETACH_LOCK_TIMEOUT = "5s"
+
+PARTITIONED_PIXEL_LOGS_DDL = [
+    "CREATE SEQUENCE IF NOT EXISTS pixel_logs_id_seq",
+    """
+    CREATE TABLE IF NOT EXISTS pixel_logs (
+        id BIGINT NOT NULL DEFAULT nextval('pixel_logs_id_seq'),
+        canvas_id VARCHAR DEFAULT 'default',
+        user_id VARCHAR,
+        x INTEGER,
+        y INTEGER,
+        color VARCHAR,
+        created_at TIMESTAMP WITHOUT TIME ZONE,
+        PRIMARY KEY (id)
+    ) PARTITION BY RANGE (id)
+    """,
+    "CREATE INDEX IF NOT EXISTS ix_pixel_logs_user_id ON pixel_logs (user_id)",
+    "CREATE INDEX IF NOT EXISTS ix_pixel_logs_created_at ON pixel_logs (created_at)",
+    "CREATE INDEX IF NOT EXISTS ix_pixel_logs_canvas_id ON pixel_logs (canvas_id)",
+    "CREATE INDEX IF NOT EXISTS ix_pixel_logs_canvas_id_id ON pixel_logs (canvas_id, id)",
+    "CREATE INDEX IF NOT EXISTS ix_pixel_logs_canvas_id_x_y_id ON pixel_logs (canvas_id, x, y, id)",
+    # 兜底分区，避免预建分区用尽时插入失败
+    "CREATE TABLE IF NOT EXISTS pixel_logs_default PARTITION OF pixel_logs DEFAULT",
+]
+
+
+def partitioning_enabled() -> bool:
+    return PIXEL_LOG_PARTITION_SIZE > 0
+
+
+def partition_bounds(index: int) -> Tuple[int, int]:
+    """Get the [start, end) ID range of a partition."""
+    return index * PIXEL_LOG_PARTITION_SIZE, (index + 1) * PIXEL_LOG_PARTITION_SIZE
+
+
+async def create_partitioned_pixel_logs(db: AsyncSession):
+    """Create pixel_logs as a partitioned table if it does not exist yet."""
+    for statement in PARTITIONED_PIXEL_LOGS_DDL:
+        await db.execute(text(statement))
+
+
+async def get_pixel_logs_kind(db: Union[AsyncSession, AsyncConnection]) -> Optional[str]:
+    """Get the pg_class relkind of pixel_logs: "p" if partitioned, "r" if not, None if missing."""
+    result = await db.execute(text("SELECT relkind FROM pg_class WHERE oid = to_regclass('pixel_logs')"))
+    kind = result.scalar()
+    # asyncpg 将 "char" 类型返回为 bytes
+    return kind.decode() if isinstance(kind, bytes) else kind
+
+
+async def prepare_pixel_logs(db: AsyncSession) -> bool:
+    """Create pixel_logs as a partitioned table on a fresh database; call at startup.
+
+    Returns:
+        Whether pixel_logs is partitioned
+    """
+    if not partitioning_enabled():
+        return False
+    await db.execute(text("SELECT pg_advisory_xact_lock(:key)"), {"key": PIXEL_LOGS_SETUP_LOCK})
+    kind = await get_pixel_logs_kind(db)
+    if kind is None:
+        await create_partitioned_pixel_logs(db)
+        await ensure_pixel_log_partitions(db)
+        logger.info("Created pixel_logs as a partitioned table")
+        return True
+    if kind != "p":
+        logger.error(
+            "PIXEL_LOG_PARTITION_SIZE is set but pixel_logs is not partitioned; "
+            "migrate it as described in app/db/partitions.py"
+        )
+        return False
+    return True
+
+
+async def list_pixel_log_partitions(db: Union[AsyncSession, AsyncConnection]) -> List[int]:
+    """Get the indexes of the existing ``pixel_logs_p<n>`` partitions in ascending order."""
+    result = await db.execute(text(
+        """
+        SELECT child.relname
+        FROM pg_inherits
+        JOIN pg_class parent ON parent.oid = pg_inherits.inhparent
+        JOIN pg_class child ON child.oid = pg_inherits.inhrelid
+        WHERE parent.relname = 'pixel_logs'
+        """
+    ))
+    indexes = []
+    for (name,) in result.all():
+        match = PARTITION_NAME_PATTERN.match(name)
+        if match:
+            indexes.append(int(match.group(1)))
+    return sorted(indexes)
+
+
+async def ensure_pixel_log_partitions(db: AsyncSession, lookahead: int = 2):
+    """Create the partitions for the current ID range and ``lookahead`` ranges after it."""
+    if not partitioning_enabled() or await get_pixel_logs_kind(db) != "p":
+        return
+    result = await db.execute(text("SELECT COALESCE(max(id), 0) FROM pixel_logs"))
+    current = result.scalar() // PIXEL_LOG_PARTITION_SIZE
+    existing = set(await list_pixel_log_partitions(db))
+    for index in range(current, current + lookahead + 1):
+        if index in existing:
+            continue
+        start, end = partition_bounds(index)
+        try:
+            await db.execute(text(
+                f"CREATE TABLE IF NOT EXISTS pixel_logs_p{index} "
+                f"PARTITION OF pixel_logs FOR VALUES FROM ({start}) TO ({end})"
+            ))
+            logger.info(f"Created pixel_logs partition p{index} for IDs [{start}, {end})")
+        except Exception as e:
+            # 通常是兜底分区中已经存在该范围的数据
+            logger.error(f"Failed to create pixel_logs partition p{index}: {e}")
+            raise
+
+
+async def has_default_pixel_log_partition(db: Union[AsyncSession, AsyncConnection]) -> bool:
+    result = await db.execute(text(
+        "SELECT partdefid <> 0 FROM pg_partitioned_table WHERE partrelid = to_regclass('pixel_logs')"
+    ))
+    return bool(result.scalar())
+
+
+async def drop_pixel_log_partitions_up_to(conn: AsyncConnection, up_to_id: int) -> List[int]:
+    """Detach and drop every partition whose whole ID range is <= up_to_id.
+
+    ``conn`` must be in autocommit mode (see ``get_autocommit_connection``):
+    each statement commits on its own, and the concurrent detach cannot run
+    in a transaction block.
+
+    Returns:
+        The indexes of the dropped partitions
+    """
+    dropped = []
+    concurrently = not await has_default_pixel_log_partition(conn)
+    if concurrently:
+        # 被中断的并发分离会把分区留在 detach pending 状态，需先 FINALIZE
+        result = await conn.execute(text(
+            "SELECT inhrelid::regclass::text FROM pg_inherits "
+            "WHERE inhparent = to_regclass('pixel_logs') AND inhdetachpending"
+        ))
+        for (name,) in result.all():
+            await conn.execute(text(f"ALTER TABLE pixel_logs DETACH PARTITION {name} FINALIZE"))
+    for index in await list_pixel_log_partitions(conn):
+        _, end = partition_bounds(index)
+        if end - 1 > up_to_id:
+            break
+        if concurrently:
+            await conn.execute(text(f"ALTER TABLE pixel_logs DETACH PARTITION pixel_logs_p{index} CONCURRENTLY"))
+        else:
+            # 存在兜底分区时不允许并发分离：语句自成一个短事务，拿不到锁就放弃
+            await conn.execute(text(f"SET lock_timeout = '{DETACH_LOCK_TIMEOUT}'"))
+            try:
+                await conn.execute(text(f"ALTER TABLE pixel_logs DETACH PARTITION pixel_logs_p{index}"))
+            finally:
+                await conn.execute(text("RESET lock_timeout"))
+        await conn.execute(text(f"DROP TABLE pixel_logs_p{index}"))
+        dropped.append(index)
+    return dropped
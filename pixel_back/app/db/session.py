@@ -1,6 +1,6 @@
 from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession
 from sqlalchemy.orm import sessionmaker
-from app.config import DATABASE_URL
+from app.config import DATABASE_URL, DATABASE_READ_URL, DATABASE_READ_POOL_SIZE
 
 # Create async engine
 engine = create_async_engine(DATABASE_URL, echo=True, future=True)
@@ -8,4 +8,15 @@ engine = create_async_engine(DATABASE_URL, echo=True, future=True)
 # Create async session
 async_session = sessionmaker(
     engine, class_=AsyncSession, expire_on_commit=False
-)
\ No newline at end of file
+)
+
+# Optional read-only engine for a streaming replica
+read_engine = None
+async_read_session = None
+if DATABASE_READ_URL:
+    read_engine = create_async_engine(
+        DATABASE_READ_URL, echo=False, future=True, pool_size=DATABASE_READ_POOL_SIZE, pool_pre_ping=True
+    )
+    async_read_session = sessionmaker(
+        read_engine, class_=AsyncSession, expire_on_commit=False
+    )
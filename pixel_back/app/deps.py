@@ -1,24 +1,57 @@
 from redis import asyncio as aioredis
 from redis.asyncio import ConnectionPool
 from sqlalchemy.ext.asyncio import AsyncSession
-from app.config import REDIS_HOST, REDIS_PORT, REDIS_DB, REDIS_PASSWORD, REDIS_POOL_SIZE, DATABASE_URL,SNAPSHOT_THRESHOLD
-from app.db.session import async_session
-from app.db.crud import get_latest_snapshot, get_pixel_logs_after_id
+from app.config import REDIS_HOST, REDIS_PORT, REDIS_DB, REDIS_PASSWORD, REDIS_POOL_SIZE, DATABASE_URL,SNAPSHOT_THRESHOLD, ADMIN_TOKEN
+from app.config import READ_REPLICA_CHECK_INTERVAL, READ_REPLICA_MAX_LAG_LOGS
+from app.db.session import async_session, async_read_session
+from app.utils.logger import logger
+from app.db.crud import get_latest_snapshot, count_pixel_logs_after_id
+from app.canvas_registry import CanvasConfig, DEFAULT_CANVAS_ID, get_canvas_config
+from fastapi import Header, HTTPException
 from app.db.models import PixelLog
 from sqlalchemy.future import select
 from sqlalchemy import func
 from contextlib import asynccontextmanager
+import secrets
+import time
+import uuid
+from typing import Optional
 
 # Global Redis connection pool
 redis_pool = None
+# Pool for binary values, without response decoding
+binary_redis_pool = None
 
 # Redis key for pixel logs counter
 PIXEL_LOGS_COUNTER_KEY = "pixel_logs_since_last_snapshot"
+# Redis key of the highest pixel log ID committed on the primary
+LAST_COMMITTED_LOG_ID_KEY = "pixel_logs_last_committed_id"
+
+# 仅在新值更大时写入，避免并发提交使其回退
+_SET_IF_GREATER_SCRIPT = """
+local current = tonumber(redis.call('GET', KEYS[1]) or '0')
+local value = tonumber(ARGV[1])
+if value > current then
+    redis.call('SET', KEYS[1], ARGV[1])
+end
+return 0
+"""
+
+
+def pixel_logs_counter_key(canvas_id: str = DEFAULT_CANVAS_ID) -> str:
+    """Get the Redis key of a canvas's pixel logs counter."""
+    return PIXEL_LOGS_COUNTER_KEY if canvas_id == DEFAULT_CANVAS_ID else f"{PIXEL_LOGS_COUNTER_KEY}:{canvas_id}"
 
 
 def create_redis_pool():
     """Create a global Redis connection pool."""
-    global redis_pool
+    global redis_pool, binary_redis_pool
+    if binary_redis_pool is None:
+        binary_redis_pool = ConnectionPool.from_url(
+            f"redis://{REDIS_HOST}:{REDIS_PORT}/{REDIS_DB}",
+            password=REDIS_PASSWORD,
+            max_connections=REDIS_POOL_SIZE
+        )
     if redis_pool is None:
         redis_pool = ConnectionPool.from_url(
             f"redis://{REDIS_HOST}:{REDIS_PORT}/{REDIS_DB}",
@@ -41,6 +74,59 @@ async def get_redis_connection():
         await redis_conn.close()
 
 
+@asynccontextmanager
+async def get_binary_redis_connection():
+    """Get a Redis connection that returns raw bytes, for binary values."""
+    redis_conn = aioredis.Redis(connection_pool=binary_redis_pool)
+    try:
+        yield redis_conn
+    finally:
+        await redis_conn.close()
+
+
+@asynccontextmanager
+async def job_lock(name: str, ttl: int):
+    """Try to take a cluster-wide lock for a periodic background job.
+
+    Yields True if this worker holds the lock, so that jobs scheduled in every
+    uvicorn worker run only once. The lock expires after ``ttl`` seconds in
+    case the holder dies.
+
+    用法示例:
+    async with job_lock("log_archive", 600) as acquired:
+        if acquired:
+            ...
+    """
+    key = f"job_lock:{name}"
+    token = uuid.uuid4().hex
+    async with get_redis_connection() as redis_conn:
+        acquired = await redis_conn.set(key, token, nx=True, ex=ttl)
+    try:
+        yield bool(acquired)
+    finally:
+        if acquired:
+            async with get_redis_connection() as redis_conn:
+                # 仅在锁仍属于自己时释放
+                if await redis_conn.get(key) == token:
+                    await redis_conn.delete(key)
+
+
+def require_canvas(canvas_id: str = DEFAULT_CANVAS_ID) -> CanvasConfig:
+    """FastAPI dependency resolving the ``canvas_id`` query parameter, 404 for unknown canvases."""
+    try:
+        return get_canvas_config(canvas_id)
+    except KeyError:
+        raise HTTPException(status_code=404, detail=f"Canvas {canvas_id} not found")
+
+
+def require_admin(x_admin_token: str = Header(default="")):
+    """FastAPI dependency checking the X-Admin-Token header against ADMIN_TOKEN."""
+    if not ADMIN_TOKEN:
+        raise HTTPException(status_code=403, detail="Admin endpoints are disabled")
+    if not secrets.compare_digest(x_admin_token.encode(), ADMIN_TOKEN.encode()):
+        raise HTTPException(status_code=401, detail="Invalid admin token")
+
+
 @asynccontextmanager
 async def get_db_session() -> AsyncSession:
     """提供一个带自动事务管理的数据库会话上下文管理器。
@@ -66,35 +152,112 @@ async def get_db_session() -> AsyncSession:
         await session.close()
 
 
-async def initialize_pixel_logs_counter(db: AsyncSession) -> int:
+@asynccontextmanager
+async def get_autocommit_connection():
+    """提供一个不在事务块中的主库连接，每条语句单独提交。
+
+    For statements PostgreSQL refuses inside a transaction block, such as
+    ``DETACH PARTITION ... CONCURRENTLY``.
+    """
+    async with async_session.kw["bind"].connect() as conn:
+        yield await conn.execution_options(isolation_level="AUTOCOMMIT")
+
+
+async def record_committed_log_id(log_id: int):
+    """Record that pixel logs up to ``log_id`` are committed on the primary."""
+    async with get_redis_connection() as redis_conn:
+        await redis_conn.eval(_SET_IF_GREATER_SCRIPT, 1, LAST_COMMITTED_LOG_ID_KEY, log_id)
+
+
+async def get_last_committed_log_id() -> int:
+    """Get the highest pixel log ID known to be committed on the primary."""
+    async with get_redis_connection() as redis_conn:
+        log_id = await redis_conn.get(LAST_COMMITTED_LOG_ID_KEY)
+    return int(log_id) if log_id is not None else 0
+
+
+# 副本已应用的最大日志ID，按 READ_REPLICA_CHECK_INTERVAL 缓存；None 表示副本不可用
+_replica_position = {"log_id": None, "checked_at": 0.0}
+
+
+async def _get_replica_log_id() -> Optional[int]:
+    if time.monotonic() - _replica_position["checked_at"] >= READ_REPLICA_CHECK_INTERVAL:
+        _replica_position["checked_at"] = time.monotonic()
+        session = async_read_session()
+        try:
+            log_id = await session.scalar(select(func.max(PixelLog.id)))
+            _replica_position["log_id"] = log_id or 0
+        except Exception as e:
+            logger.warning(f"Read replica is unavailable, reading from the primary: {str(e)}")
+            _replica_position["log_id"] = None
+        finally:
+            await session.close()
+    return _replica_position["log_id"]
+
+
+async def _replica_is_fresh(min_log_id: Optional[int]) -> bool:
+    replica_log_id = await _get_replica_log_id()
+    if replica_log_id is None:
+        return False
+    required = await get_last_committed_log_id() - READ_REPLICA_MAX_LAG_LOGS
+    if min_log_id is not None:
+        required = max(required, min_log_id)
+    return replica_log_id >= required
+
+
+@asynccontextmanager
+async def get_read_db_session(min_log_id: Optional[int] = None) -> AsyncSession:
+    """提供一个只读数据库会话，配置了只读副本时优先使用副本。
+
+    The replica is used only while it is at most READ_REPLICA_MAX_LAG_LOGS
+    pixel logs behind the last log committed on the primary, and has applied
+    ``min_log_id`` when given; otherwise, or when DATABASE_READ_URL is not
+    set, the session is on the primary. Nothing must be written through it.
+
+    用法示例:
+    async with get_read_db_session() as db_session:
+        snapshot = await get_latest_snapshot(db_session)
+    """
+    if async_read_session is None or not await _replica_is_fresh(min_log_id):
+        async with get_db_session() as session:
+            yield session
+    else:
+        session = async_read_session()
+        try:
+            async with session.begin():
+                yield session
+        finally:
+            await session.close()
+
+
+async def initialize_pixel_logs_counter(db: AsyncSession, canvas_id: str = DEFAULT_CANVAS_ID) -> int:
     """Initialize the pixel logs counter by counting logs since the last snapshot.
     
     Returns:
         The number of pixel logs since the last snapshot.
     """
     # Get the latest snapshot
-    latest_snapshot = await get_latest_snapshot(db)
-    result = await get_pixel_logs_after_id(db, latest_snapshot.last_log_id if latest_snapshot else 0)
+    latest_snapshot = await get_latest_snapshot(db, canvas_id)
+    count = await count_pixel_logs_after_id(db, latest_snapshot.last_log_id if latest_snapshot else 0, canvas_id)
     
     # Store the count in Redis
     async with get_redis_connection() as redis_conn:
-        count = len(result)
-        await redis_conn.set(PIXEL_LOGS_COUNTER_KEY, count)
+        await redis_conn.set(pixel_logs_counter_key(canvas_id), count)
     
     return count
 
 
-async def increment_pixel_logs_counter():
-    """Increment the pixel logs counter by 1."""
+async def increment_pixel_logs_counter(canvas_id: str = DEFAULT_CANVAS_ID, amount: int = 1):
+    """Increment the pixel logs counter by ``amount``."""
     async with get_redis_connection() as redis_conn:
-        count = await redis_conn.incr(PIXEL_LOGS_COUNTER_KEY)
+        count = await redis_conn.incrby(pixel_logs_counter_key(canvas_id), amount)
     return count
 
 
-async def get_pixel_logs_count():
+async def get_pixel_logs_count(canvas_id: str = DEFAULT_CANVAS_ID):
     """Get the current pixel logs count since last snapshot."""
     async with get_redis_connection() as redis_conn:
-        count = await redis_conn.get(PIXEL_LOGS_COUNTER_KEY)
+        count = await redis_conn.get(pixel_logs_counter_key(canvas_id))
     return int(count) if count is not None else 0
 
 
@@ -111,7 +274,7 @@ def should_create_snapshot(threshold: int = SNAPSHOT_THRESHOLD) -> bool:
     raise RuntimeError("should_create_snapshot should be called as async_should_create_snapshot")
 
 
-async def async_should_create_snapshot(threshold: int = SNAPSHOT_THRESHOLD) -> bool:
+async def async_should_create_snapshot(threshold: int = SNAPSHOT_THRESHOLD, canvas_id: str = DEFAULT_CANVAS_ID) -> bool:
     """Async check if a snapshot should be created based on the pixel logs count.
     
     Args:
@@ -120,11 +283,11 @@ async def async_should_create_snapshot(threshold: int = SNAPSHOT_THRESHOLD) -> b
     Returns:
         True if a snapshot should be created, False otherwise.
     """
-    count = await get_pixel_logs_count()
+    count = await get_pixel_logs_count(canvas_id)
     return count >= threshold
 
 
-async def reset_pixel_logs_counter():
+async def reset_pixel_logs_counter(canvas_id: str = DEFAULT_CANVAS_ID):
     """Reset the pixel logs counter to 0 after creating a snapshot."""
     async with get_redis_connection() as redis_conn:
-        await redis_conn.set(PIXEL_LOGS_COUNTER_KEY, 0)
\ No newline at end of file
+        await redis_conn.set(pixel_logs_counter_key(canvas_id), 0)
\ No newline at end of file
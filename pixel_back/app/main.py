@@ -7,10 +7,43 @@ import uvicorn
 from fastapi import FastAPI
 from app.websocket.endpoints import router as websocket_router
 from app.api.snapshots import router as snapshots_router
-from app.config import CANVAS_WIDTH, CANVAS_HEIGHT
-from app.deps import create_redis_pool, initialize_pixel_logs_counter, get_db_session
+from app.api.canvas import router as canvas_router
+from app.api.timelapse import router as timelapse_router
+from app.api.users import router as users_router
+from app.api.moderation import router as moderation_router
+from app.canvas_registry import DEFAULT_CANVAS_ID, get_canvas_config, list_canvas_configs
+from app.config import (
+    CANVAS_BACKEND,
+    CANVAS_MMAP_SYNC_INTERVAL,
+    CANVAS_VERIFY_INTERVAL,
+    HEATMAP_MERGE_INTERVAL,
+    LOG_ARCHIVE_INTERVAL,
+    SNAPSHOT_GC_INTERVAL,
+    WS_HEARTBEAT_INTERVAL,
+    WS_IDLE_TIMEOUT,
+)
+from app.db.migrations import upgrade_schema
+from app.db.partitions import prepare_pixel_logs
+from app.deps import (
+    create_redis_pool,
+    get_autocommit_connection,
+    get_db_session,
+    get_read_db_session,
+    initialize_pixel_logs_counter,
+)
 import app.deps as deps
 from app.services.canvas_initializer import initialize_canvas_at_startup
+from app.services.geometry_service import handle_resize_message, load_canvas_geometries
+from app.services.log_archive import log_maintenance_loop
+from app.services.last_writer_service import ensure_last_writer_indexes
+from app.services.user_stats_service import ensure_user_stats
+from app.services.snapshot_store import snapshot_gc_loop
+from app.services.pyramid_service import handle_canvas_message
+from app.services.hash_tree_service import canvas_verify_loop, handle_hash_tree_message
+from app.services.spectator_service import spectator_hub
+from app.services.heatmap_service import handle_heatmap_message, heatmap_merge_loop, load_heatmaps
+from app.redis_store.mmap_canvas import mmap_sync_loop, sync_mapped_canvases
+from app.websocket.endpoints import manager
 import asyncio
 
 # Create FastAPI app
@@ -23,6 +56,10 @@ app = FastAPI(
 # Include routers
 app.include_router(websocket_router)
 app.include_router(snapshots_router)
+app.include_router(canvas_router)
+app.include_router(timelapse_router)
+app.include_router(users_router)
+app.include_router(moderation_router)
 
 
 @app.on_event("startup")
@@ -31,38 +68,107 @@ async def startup_event():
     # Create Redis connection pool
     create_redis_pool()
     print("Redis connection pool created")
-    
-    # Initialize pixel logs counter
+
+    # Create pixel_logs as a partitioned table on a fresh database when partitioning is enabled
     async with get_db_session() as db:
-        await initialize_pixel_logs_counter(db)
+        await prepare_pixel_logs(db)
+
+    # Add the columns and indexes introduced since the first release to existing tables
+    async with get_autocommit_connection() as conn:
+        await upgrade_schema(conn)
     
+    # Initialize pixel logs counters
+    async with get_read_db_session() as db:
+        for canvas in list_canvas_configs():
+            await initialize_pixel_logs_counter(db, canvas.id)
+    
+    # Apply the canvas expansions recorded in the database
+    await load_canvas_geometries()
+
     # Initialize canvas
     await initialize_canvas_at_startup()
     print("Canvas initialization completed")
 
+    # Build the last-writer index of canvases that do not have one
+    await ensure_last_writer_indexes()
+
+    # Build the user statistics of canvases that never had them
+    await ensure_user_stats()
+
+    # Restore the activity heatmaps from the other workers or the last snapshot
+    await load_heatmaps()
+
+    # Switch to expanded canvases, keep the overview pyramids, hash trees and heatmaps
+    # current and feed the spectator streams from the canvas update channels
+    manager.add_listener(handle_resize_message)
+    manager.add_listener(handle_canvas_message)
+    manager.add_listener(handle_hash_tree_message)
+    manager.add_listener(handle_heatmap_message)
+    manager.add_listener(spectator_hub.handle_message)
+    await manager.init_redis()
+
+    # Send the coalesced canvas updates to spectators
+    asyncio.create_task(spectator_hub.run())
+
+    # Ping WebSocket clients and reap idle and half-open connections
+    if WS_HEARTBEAT_INTERVAL > 0:
+        asyncio.create_task(manager.heartbeat_loop())
+
+    # Start pixel log partitioning and archival
+    if LOG_ARCHIVE_INTERVAL > 0:
+        asyncio.create_task(log_maintenance_loop())
+
+    # Merge the workers' heatmaps through Redis
+    if HEATMAP_MERGE_INTERVAL > 0:
+        asyncio.create_task(heatmap_merge_loop())
+
+    # Periodically check the live canvases against snapshots and logs
+    if CANVAS_VERIFY_INTERVAL > 0:
+        asyncio.create_task(canvas_verify_loop())
+
+    # Start snapshot retention and garbage collection
+    if SNAPSHOT_GC_INTERVAL > 0:
+        asyncio.create_task(snapshot_gc_loop())
+
+    # Write the memory-mapped canvas files back to disk
+    if CANVAS_BACKEND == "mmap" and CANVAS_MMAP_SYNC_INTERVAL > 0:
+        asyncio.create_task(mmap_sync_loop())
+
 
 @app.on_event("shutdown")
 async def shutdown_event():
     """Clean up application on shutdown."""
+    await manager.close()
+    if CANVAS_BACKEND == "mmap":
+        sync_mapped_canvases()
     if deps.redis_pool:
         await deps.redis_pool.disconnect()
+    if deps.binary_redis_pool:
+        await deps.binary_redis_pool.disconnect()
     print("Redis connection pool disconnected")
 
 
 @app.get("/")
 async def root():
     """Root endpoint."""
+    default_canvas = get_canvas_config(DEFAULT_CANVAS_ID)
     return {
         "message": "Welcome to the Pixel Canvas API",
-        "canvas_size": f"{CANVAS_WIDTH}x{CANVAS_HEIGHT}"
+        "canvas_size": f"{default_canvas.width}x{default_canvas.height}",
+        "canvases": [canvas.id for canvas in list_canvas_configs()]
     }
 
 
 @app.get("/health")
 async def health_check():
     """Health check endpoint."""
-    return {"status": "healthy"}
+    return {"status": "healthy", "websocket": manager.stats(), "spectators": spectator_hub.stats()}
 
 
 if __name__ == "__main__":
-    uvicorn.run("app.main:app", host="0.0.0.0", port=8000, reload=True)
\ No newline at end of file
+    # 关闭 per-message deflate：每个连接的 zlib 上下文约占 100 KB 内存；
+    # 协议层 ping 关闭不回复 JSON ping 的旧版前端的死连接
+    uvicorn.run(
+        "app.main:app", host="0.0.0.0", port=8000, reload=True, ws_per_message_deflate=False,
+        ws_ping_interval=WS_HEARTBEAT_INTERVAL or None, ws_ping_timeout=WS_IDLE_TIMEOUT,
+    )
\ No newline at end of file
@@ -1,57 +1,388 @@
 import json
-from typing import Optional
+from typing import List, Optional, Tuple
+import numpy as np
 from redis import asyncio as aioredis
-from app.config import CANVAS_WIDTH, CANVAS_HEIGHT
+from app.canvas_registry import CanvasConfig, DEFAULT_CANVAS_ID, get_canvas_config
+from app.config import CANVAS_BACKEND
+from app.redis_store.canvas_backend import CanvasBackend
+from app.redis_store.mmap_canvas import MmapCanvasBackend
+from app.utils.logger import logger
+from app.utils.utils import hex_colors_to_rgb, rgb_to_hex_colors
 
 
+# 按连续区间写入：ARGV 为 (起始下标, 拼接的 "#RRGGBB" 颜色串) 对
+_SET_RUNS_SCRIPT = """
+for i = 1, #ARGV, 2 do
+    local start = tonumber(ARGV[i])
+    local colors = ARGV[i + 1]
+    for j = 0, #colors / 7 - 1 do
+        redis.call('LSET', KEYS[1], start + j, string.sub(colors, j * 7 + 1, j * 7 + 7))
+    end
+end
+return 1
+"""
+
+# 按连续区间比较并写入：ARGV 为 (起始下标, 新颜色串, 期望的当前颜色串) 三元组，
+# 仅当像素仍为期望颜色时写入；返回每个像素是否写入的 "1"/"0" 串
+_COMPARE_AND_SET_RUNS_SCRIPT = """
+local written = {}
+for i = 1, #ARGV, 3 do
+    local start = tonumber(ARGV[i])
+    local colors = ARGV[i + 1]
+    local expected = ARGV[i + 2]
+    for j = 0, #colors / 7 - 1 do
+        local current = redis.call('LINDEX', KEYS[1], start + j)
+        if current and string.upper(current) == string.sub(expected, j * 7 + 1, j * 7 + 7) then
+            redis.call('LSET', KEYS[1], start + j, string.sub(colors, j * 7 + 1, j * 7 + 7))
+            written[#written + 1] = '1'
+        else
+            written[#written + 1] = '0'
+        end
+    end
+end
+return table.concat(written)
+"""
+
+# 每次脚本调用写入的像素数上限
+_RUN_CHUNK_PIXELS = 50000
+
+CANVAS_BACKENDS = ("redis", "mmap")
+if CANVAS_BACKEND not in CANVAS_BACKENDS:
+    raise ValueError(f"Invalid CANVAS_BACKEND {CANVAS_BACKEND!r}, expected one of {CANVAS_BACKENDS}")
+
+
+def canvas_base_key(canvas_id: str, version: int = 0) -> str:
+    """Get the Redis key (or key prefix for sharded canvases) of a canvas geometry version."""
+    key = "canvas" if canvas_id == DEFAULT_CANVAS_ID else f"canvas:{canvas_id}"
+    # 扩展后的尺寸使用新的键，旧布局在迁移完成前保持不变
+    return key if version == 0 else f"{key}:v{version}"
+
+
+class RedisCanvasBackend(CanvasBackend):
+    """Redis backend for canvas operations.
+
+    Each canvas is stored as Redis lists of hex colors in row-major order. A
+    sharded canvas uses one list per shard, keyed ``canvas:<id>:<row>:<col>``;
+    multi-shard operations use non-transactional pipelines. The keys carry no
+    hash tags and some commands touch several shards, so the layout assumes a
+    single Redis instance rather than a Redis Cluster.
+    """
+
+    def __init__(self, redis: aioredis.Redis, canvas: CanvasConfig):
+        super().__init__(canvas)
+        self.redis = redis
+        self.canvas_key = canvas_base_key(canvas.id, canvas.version)
+
+    def shard_key(self, row: int, column: int) -> str:
+        if not self.canvas.sharded:
+            return self.canvas_key
+        return f"{self.canvas_key}:{row}:{column}"
+
+    def _locate(self, x: int, y: int) -> Tuple[str, int]:
+        """Get the shard key and list index of pixel (x, y)."""
+        row, column = self.canvas.shard_of(x, y)
+        x0, y0, width, _ = self.canvas.shard_bounds(row, column)
+        return self.shard_key(row, column), (y - y0) * width + (x - x0)
+
+    async def exists(self) -> bool:
+        """Check whether every shard of the canvas exists."""
+        pipe = self.redis.pipeline(transaction=False)
+        for row, column in self.canvas.shards():
+            pipe.exists(self.shard_key(row, column))
+        return all(await pipe.execute())
+
+    def _queue_shard_write(self, pipe, key: str, colors: List[str]):
+        pipe.delete(key)
+        for i in range(0, len(colors), 1000):
+            pipe.rpush(key, *colors[i:i+1000])
+
+    async def initialize_canvas(self):
+        # Check if canvas already exists
+        if not await self.exists():
+            # Create empty canvas (all pixels are white by default), shard by shard
+            for row, column in self.canvas.shards():
+                _, _, width, height = self.canvas.shard_bounds(row, column)
+                # Use pipeline for better performance
+                pipe = self.redis.pipeline(transaction=False)
+                self._queue_shard_write(pipe, self.shard_key(row, column), ["#FFFFFF"] * (width * height))
+                await pipe.execute()
+
+    async def set_frame(self, frame: np.ndarray):
+        for row, column in self.canvas.shards():
+            x0, y0, width, height = self.canvas.shard_bounds(row, column)
+            colors = rgb_to_hex_colors(frame[y0:y0 + height, x0:x0 + width])
+            pipe = self.redis.pipeline(transaction=False)
+            self._queue_shard_write(pipe, self.shard_key(row, column), colors)
+            await pipe.execute()
+
+    async def get_pixel(self, x: int, y: int) -> str:
+        key, index = self._locate(x, y)
+        color = await self.redis.lindex(key, index)
+        return color or "#FFFFFF"
+
+    async def set_pixel(self, x: int, y: int, color: str) -> bool:
+        key, index = self._locate(x, y)
+        result = await self.redis.lset(key, index, color)
+        return result
+
+    async def set_pixels(self, xs: List[int], ys: List[int], colors: List[str]):
+        """Set many pixels with one pipelined round trip, applied in order."""
+        pipe = self.redis.pipeline(transaction=False)
+        for x, y, color in zip(xs, ys, colors):
+            key, index = self._locate(x, y)
+            pipe.lset(key, index, color)
+        await pipe.execute()
+
+    def _region_runs(self, x: int, y: int, mask: np.ndarray):
+        """Group the masked pixels of a region into runs of consecutive list indexes.
+
+        Yields:
+            (shard key, runs) with at most _RUN_CHUNK_PIXELS pixels per item,
+            each run being (list index, region row, first column, end column)
+        """
+        height, width = mask.shape
+        for row, column in self.canvas.shards_in_region(x, y, width, height):
+            sx, sy, shard_width, shard_height = self.canvas.shard_bounds(row, column)
+            left, right = max(x, sx), min(x + width, sx + shard_width)
+            top, bottom = max(y, sy), min(y + height, sy + shard_height)
+            part_mask = mask[top - y:bottom - y, left - x:right - x]
+            if not part_mask.any():
+                continue
+            key = self.shard_key(row, column)
+            runs, pending = [], 0
+            for line in range(part_mask.shape[0]):
+                # 找出该行中连续被选中的区间
+                padded = np.concatenate(([False], part_mask[line], [False]))
+                edges = np.flatnonzero(padded[1:] != padded[:-1])
+                for start, end in zip(edges[::2], edges[1::2]):
+                    index = (top + line - sy) * shard_width + (left - sx) + int(start)
+                    runs.append((index, top + line - y, left - x + int(start), left - x + int(end)))
+                    pending += int(end - start)
+                    if pending >= _RUN_CHUNK_PIXELS:
+                        yield key, runs
+                        runs, pending = [], 0
+            if runs:
+                yield key, runs
+
+    async def set_region(self, x: int, y: int, region: np.ndarray, mask: np.ndarray) -> int:
+        """Write the masked pixels of a region.
+
+        Masked pixels are grouped into runs of consecutive list indexes and
+        written by a script, one call per shard (and chunk of pixels), all in
+        a single pipeline.
+        """
+        colors = np.array(rgb_to_hex_colors(region), dtype=object).reshape(region.shape[:2])
+        pipe = self.redis.pipeline(transaction=False)
+        written = 0
+        for key, runs in self._region_runs(x, y, mask):
+            args = []
+            for index, line, start, end in runs:
+                args.extend((index, "".join(colors[line, start:end])))
+                written += end - start
+            pipe.eval(_SET_RUNS_SCRIPT, 1, key, *args)
+        await pipe.execute()
+        return written
+
+    async def compare_and_set_region(
+        self, x: int, y: int, region: np.ndarray, mask: np.ndarray, expected: np.ndarray
+    ) -> np.ndarray:
+        """Write the masked pixels of a region that still have their ``expected`` colors.
+
+        Each pixel is compared and written inside the same script run, so a
+        placement landing after ``expected`` was read is never overwritten.
+        """
+        colors = np.array(rgb_to_hex_colors(region), dtype=object).reshape(region.shape[:2])
+        expected_colors = np.array(rgb_to_hex_colors(expected), dtype=object).reshape(region.shape[:2])
+        pipe = self.redis.pipeline(transaction=False)
+        calls = []
+        for key, runs in self._region_runs(x, y, mask):
+            args = []
+            for index, line, start, end in runs:
+                args.extend((index, "".join(colors[line, start:end]), "".join(expected_colors[line, start:end])))
+            pipe.eval(_COMPARE_AND_SET_RUNS_SCRIPT, 1, key, *args)
+            calls.append(runs)
+        written = np.zeros(mask.shape, dtype=bool)
+        for runs, flags in zip(calls, await pipe.execute()):
+            flags = np.frombuffer(flags.encode() if isinstance(flags, str) else flags, dtype=np.uint8) == ord("1")
+            offset = 0
+            for _, line, start, end in runs:
+                written[line, start:end] = flags[offset:offset + end - start]
+                offset += end - start
+        return written
+
+    async def get_region(self, x: int, y: int, width: int, height: int) -> np.ndarray:
+        """Read a region.
+
+        Only the shards overlapping the region are read, with one LRANGE per
+        shard when the region spans the shard's full width and one per row
+        otherwise, all in a single pipeline.
+
+        Raises:
+            RuntimeError: If a shard is missing or shorter than the canvas
+                geometry says, e.g. it was deleted after an expansion
+        """
+        pipe = self.redis.pipeline(transaction=False)
+        reads = []
+        for row, column in self.canvas.shards_in_region(x, y, width, height):
+            sx, sy, shard_width, shard_height = self.canvas.shard_bounds(row, column)
+            left, right = max(x, sx), min(x + width, sx + shard_width)
+            top, bottom = max(y, sy), min(y + height, sy + shard_height)
+            key = self.shard_key(row, column)
+            if left == sx and right == sx + shard_width:
+                start = (top - sy) * shard_width
+                pipe.lrange(key, start, start + (bottom - top) * shard_width - 1)
+                reads.append((key, left, right, top, bottom))
+            else:
+                for line in range(top, bottom):
+                    start = (line - sy) * shard_width + (left - sx)
+                    pipe.lrange(key, start, start + (right - left) - 1)
+                    reads.append((key, left, right, line, line + 1))
+
+        region = np.full((height, width, 3), 255, dtype=np.uint8)
+        for (key, left, right, top, bottom), colors in zip(reads, await pipe.execute()):
+            expected = (right - left) * (bottom - top)
+            if len(colors) != expected:
+                logger.error(
+                    f"Canvas key {key} returned {len(colors)} pixels for rows {top}..{bottom - 1}, "
+                    f"expected {expected}"
+                )
+                raise RuntimeError(f"Canvas key {key} does not match canvas {self.canvas.id}'s geometry")
+            region[top - y:bottom - y, left - x:right - x] = \
+                hex_colors_to_rgb(colors, strict=False).reshape(bottom - top, right - left, 3)
+        return region
+
+    async def delete(self):
+        await self.redis.delete(*(self.shard_key(row, column) for row, column in self.canvas.shards()))
+
+    async def get_canvas(self) -> list:
+        if not self.canvas.sharded:
+            canvas_data = await self.redis.lrange(self.canvas_key, 0, -1)
+            return canvas_data
+        return await super().get_canvas()
+
 class CanvasStore:
-    """Redis store for canvas operations."""
-    
-    def __init__(self, redis: aioredis.Redis):
+    """Store for canvas operations.
+
+    The pixels live in the backend selected by CANVAS_BACKEND: Redis lists
+    (``RedisCanvasBackend``), or a memory-mapped file shared by the workers
+    of one host (``MmapCanvasBackend``). The store checks coordinates and
+    regions before handing them to the backend. ``redis`` is kept for the
+    other Redis-backed stores of the canvas even with the mmap backend.
+
+    The store follows the current geometry of the canvas, so long-lived
+    stores keep working after an expansion, unless pinned to a geometry
+    version with ``canvas``.
+    """
+
+    def __init__(self, redis: aioredis.Redis, canvas_id: str = DEFAULT_CANVAS_ID,
+                 canvas: Optional[CanvasConfig] = None):
         self.redis = redis
-        self.canvas_key = "canvas"
-        
+        self._pinned_canvas = canvas
+        self._canvas_id = canvas.id if canvas is not None else get_canvas_config(canvas_id).id
+        self._backend: Optional[CanvasBackend] = None
+
+    @property
+    def canvas_id(self) -> str:
+        return self._canvas_id
+
+    @property
+    def canvas(self) -> CanvasConfig:
+        return self._pinned_canvas or get_canvas_config(self._canvas_id)
+
+    @property
+    def backend(self) -> CanvasBackend:
+        canvas = self.canvas
+        if self._backend is None or self._backend.canvas is not canvas:
+            if CANVAS_BACKEND == "mmap":
+                self._backend = MmapCanvasBackend(canvas)
+            else:
+                self._backend = RedisCanvasBackend(self.redis, canvas)
+        return self._backend
+
+    def _check_pixel(self, x: int, y: int):
+        if not self.canvas.contains(x, y):
+            raise ValueError("Coordinates out of bounds")
+
+    def _check_region(self, x: int, y: int, width: int, height: int):
+        if width <= 0 or height <= 0 or not (
+            self.canvas.contains(x, y) and self.canvas.contains(x + width - 1, y + height - 1)
+        ):
+            raise ValueError("Region out of bounds")
+
+    async def exists(self) -> bool:
+        """Check whether the canvas exists in the backend."""
+        return await self.backend.exists()
+
     async def initialize_canvas(self):
         """Initialize canvas with default empty state.
-        
+
         Note: This method is now primarily used during application startup.
         For normal WebSocket connections, the canvas should already be initialized.
         """
-        # Check if canvas already exists
-        exists = await self.redis.exists(self.canvas_key)
-        if not exists:
-            # Create empty canvas (all pixels are black by default)
-            canvas_data = ["#FFFFFF"] * (CANVAS_WIDTH * CANVAS_HEIGHT)
-            await self.redis.delete(self.canvas_key)
-            # Use pipeline for better performance
-            pipe = self.redis.pipeline()
-            for i in range(0, len(canvas_data), 1000):
-                chunk = canvas_data[i:i+1000]
-                pipe.rpush(self.canvas_key, *chunk)
-            await pipe.execute()
-            
+        await self.backend.initialize_canvas()
+
+    async def set_frame(self, frame: np.ndarray):
+        """Replace the whole canvas with a (height, width, 3) RGB array."""
+        if frame.shape[:2] != (self.canvas.height, self.canvas.width):
+            raise ValueError("Frame size does not match the canvas")
+        await self.backend.set_frame(frame)
+
     async def get_pixel(self, x: int, y: int) -> str:
         """Get pixel color at position (x, y)."""
-        if not (0 <= x < CANVAS_WIDTH and 0 <= y < CANVAS_HEIGHT):
-            raise ValueError("Coordinates out of bounds")
-            
-        index = y * CANVAS_WIDTH + x
-        color = await self.redis.lindex(self.canvas_key, index)
-        return color or "#FFFFFF"
-        
+        self._check_pixel(x, y)
+        return await self.backend.get_pixel(x, y)
+
     async def set_pixel(self, x: int, y: int, color: str) -> bool:
         """Set pixel color at position (x, y)."""
-        if not (0 <= x < CANVAS_WIDTH and 0 <= y < CANVAS_HEIGHT):
-            raise ValueError("Coordinates out of bounds")
-            
-        index = y * CANVAS_WIDTH + x
-        result = await self.redis.lset(self.canvas_key, index, color)
-        return result
-        
+        self._check_pixel(x, y)
+        return await self.backend.set_pixel(x, y, color)
+
+    async def set_pixels(self, xs: List[int], ys: List[int], colors: List[str]):
+        """Set many pixels at once, applied in order."""
+        for x, y in zip(xs, ys):
+            self._check_pixel(x, y)
+        await self.backend.set_pixels(xs, ys, colors)
+
+    async def set_region(self, x: int, y: int, region: np.ndarray, mask: Optional[np.ndarray] = None) -> int:
+        """Write a (height, width, 3) RGB array at (x, y), only where ``mask`` is set.
+
+        Returns:
+            The number of pixels written
+        """
+        height, width = region.shape[:2]
+        self._check_region(x, y, width, height)
+        if mask is None:
+            mask = np.ones((height, width), dtype=bool)
+        return await self.backend.set_region(x, y, region, mask)
+
+    async def compare_and_set_region(
+        self, x: int, y: int, region: np.ndarray, mask: np.ndarray, expected: np.ndarray
+    ) -> np.ndarray:
+        """Write the pixels of ``region`` where ``mask`` is set and the canvas still holds ``expected``.
+
+        Returns:
+            The (height, width) boolean mask of the pixels written
+        """
+        height, width = region.shape[:2]
+        self._check_region(x, y, width, height)
+        return await self.backend.compare_and_set_region(x, y, region, mask, expected)
+
+    async def get_region(self, x: int, y: int, width: int, height: int) -> np.ndarray:
+        """Get a rectangular region as a (height, width, 3) RGB array."""
+        self._check_region(x, y, width, height)
+        return await self.backend.get_region(x, y, width, height)
+
+    async def get_frame(self) -> np.ndarray:
+        """Get the entire canvas as a (height, width, 3) RGB array."""
+        return await self.get_region(0, 0, self.canvas.width, self.canvas.height)
+
     async def get_canvas(self) -> list:
         """Get entire canvas data."""
-        canvas_data = await self.redis.lrange(self.canvas_key, 0, -1)
-        return canvas_data
+        return await self.backend.get_canvas()
+
+    async def delete(self):
+        """Delete the pixels of this geometry version, e.g. once an expansion has moved them."""
+        await self.backend.delete()
 
     """
     取消冷却功能
@@ -66,4 +397,4 @@ class CanvasStore:
     #     """Get cooldown timestamp for user."""
     #     key = f"{self.cooldown_key}:{user_id}"
     #     timestamp = await self.redis.get(key)
-    #     return int(timestamp) if timestamp else None
\ No newline at end of file
+    #     return int(timestamp) if timestamp else None
@@ -0,0 +1,65 @@
+from abc import ABC, abstractmethod
+from typing import List
+import numpy as np
+from app.canvas_registry import CanvasConfig
+from app.utils.utils import rgb_to_hex_colors
+
+
+class CanvasBackend(ABC):
+    """Storage of the pixels of one canvas, behind ``CanvasStore``.
+
+    ``CanvasStore`` checks coordinates and regions against the canvas before
+    calling a backend, so implementations only move pixels. Pixels are "#RRGGBB"
+    strings and regions (height, width, 3) RGB arrays.
+    """
+
+    def __init__(self, canvas: CanvasConfig):
+        self.canvas = canvas
+
+    @abstractmethod
+    async def exists(self) -> bool:
+        ...
+
+    @abstractmethod
+    async def initialize_canvas(self):
+        """Create the canvas filled with white if it does not exist."""
+        ...
+
+    @abstractmethod
+    async def set_frame(self, frame: np.ndarray):
+        ...
+
+    @abstractmethod
+    async def get_pixel(self, x: int, y: int) -> str:
+        ...
+
+    @abstractmethod
+    async def set_pixel(self, x: int, y: int, color: str) -> bool:
+        ...
+
+    @abstractmethod
+    async def set_pixels(self, xs: List[int], ys: List[int], colors: List[str]):
+        ...
+
+    @abstractmethod
+    async def set_region(self, x: int, y: int, region: np.ndarray, mask: np.ndarray) -> int:
+        ...
+
+    @abstractmethod
+    async def compare_and_set_region(
+        self, x: int, y: int, region: np.ndarray, mask: np.ndarray, expected: np.ndarray
+    ) -> np.ndarray:
+        """Atomically write the masked pixels still equal to ``expected``; return the mask of written pixels."""
+        ...
+
+    @abstractmethod
+    async def get_region(self, x: int, y: int, width: int, height: int) -> np.ndarray:
+        ...
+
+    @abstractmethod
+    async def delete(self):
+        ...
+
+    async def get_canvas(self) -> list:
+        """Get the entire canvas as a row-major list of hex colors."""
+        return rgb_to_hex_colors(await self.get_region(0, 0, self.canvas.width, self.canvas.height))
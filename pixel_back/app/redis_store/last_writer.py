@@ -0,0 +1,224 @@
+from typing import Dict, List, Optional, Tuple
+import numpy as np
+from redis import asyncio as aioredis
+from redis.exceptions import WatchError
+from app.canvas_registry import CanvasConfig, DEFAULT_CANVAS_ID, get_canvas_config
+from app.redis_store.canvas import canvas_base_key
+
+# 仅在新日志ID更大时写入，保证并发落子时索引中保留的是最后一次写入；
+# ARGV 为 (偏移, 日志ID) 对
+_SET_MANY_IF_NEWER_SCRIPT = """
+local updated = 0
+for i = 1, #ARGV, 2 do
+    local current = redis.call('BITFIELD', KEYS[1], 'GET', 'i64', ARGV[i])[1]
+    if tonumber(ARGV[i + 1]) > current then
+        redis.call('BITFIELD', KEYS[1], 'SET', 'i64', ARGV[i], ARGV[i + 1])
+        updated = updated + 1
+    end
+end
+return updated
+"""
+
+# 每次脚本调用处理的像素数
+_SCRIPT_CHUNK_SIZE = 5000
+# Lua 数值为双精度浮点数，更大的ID无法精确比较
+MAX_LOG_ID = 2 ** 53
+# 合并整个分片时 WATCH 冲突的重试次数，之后改为逐像素比较写入
+_MERGE_ATTEMPTS = 3
+# 旧版本的索引键前缀（uint32 项）
+LEGACY_KEY_PREFIX = "last_log"
+
+
+class LastWriterIndex:
+    """Redis index of the latest pixel log ID of every pixel.
+
+    Each canvas shard has a string of big-endian int64 log IDs (BITFIELD has
+    no unsigned 64-bit type) in the same row-major order as its color list,
+    keyed ``last_log64:<canvas key>``; 0 means the pixel was never written
+    or the index has not been built yet. Log IDs above MAX_LOG_ID are
+    rejected. The index is binary, so it needs a Redis client without
+    ``decode_responses``.
+    """
+
+    def __init__(self, redis: aioredis.Redis, canvas_id: str = DEFAULT_CANVAS_ID,
+                 canvas: Optional[CanvasConfig] = None):
+        self.redis = redis
+        # canvas 指定几何版本，默认为画布当前的尺寸
+        self.canvas: CanvasConfig = canvas or get_canvas_config(canvas_id)
+        self.base_key = canvas_base_key(self.canvas.id, self.canvas.version)
+        self.key_prefix = f"last_log64:{self.base_key}"
+        # EVALSHA 调用，脚本缺失时自动加载
+        self._set_many_if_newer = redis.register_script(_SET_MANY_IF_NEWER_SCRIPT)
+
+    def shard_key(self, row: int, column: int) -> str:
+        if not self.canvas.sharded:
+            return self.key_prefix
+        return f"{self.key_prefix}:{row}:{column}"
+
+    def _locate(self, x: int, y: int) -> Tuple[str, int]:
+        """Get the shard key and pixel index of (x, y)."""
+        if not self.canvas.contains(x, y):
+            raise ValueError("Coordinates out of bounds")
+        row, column = self.canvas.shard_of(x, y)
+        x0, y0, width, _ = self.canvas.shard_bounds(row, column)
+        return self.shard_key(row, column), (y - y0) * width + (x - x0)
+
+    async def exists(self) -> bool:
+        """Check whether the index has been built for every shard."""
+        pipe = self.redis.pipeline(transaction=False)
+        for row, column in self.canvas.shards():
+            pipe.exists(self.shard_key(row, column))
+        return all(await pipe.execute())
+
+    @staticmethod
+    def _check_log_id(log_id: int) -> int:
+        log_id = int(log_id)
+        if not 0 < log_id <= MAX_LOG_ID:
+            raise ValueError(f"Log ID {log_id} cannot be stored in the last-writer index")
+        return log_id
+
+    async def set(self, x: int, y: int, log_id: int):
+        """Record log_id as the latest write of (x, y), unless a newer one is already recorded.
+
+        Raises:
+            ValueError: If the coordinates are out of bounds or the log ID is not storable
+        """
+        key, index = self._locate(x, y)
+        await self._set_many_if_newer(keys=[key], args=[f"#{index}", self._check_log_id(log_id)])
+
+    async def set_many(self, xs: List[int], ys: List[int], log_ids: List[int]):
+        """Record many placements with one pipelined round trip.
+
+        Placements are grouped by shard, with one script call per shard and
+        chunk of pixels.
+
+        Raises:
+            ValueError: If coordinates are out of bounds or a log ID is not storable
+        """
+        by_key: Dict[str, List] = {}
+        for x, y, log_id in zip(xs, ys, log_ids):
+            key, index = self._locate(x, y)
+            by_key.setdefault(key, []).extend((f"#{index}", self._check_log_id(log_id)))
+        await self._run_set_scripts(by_key)
+
+    async def _run_set_scripts(self, by_key: Dict[str, List]):
+        pipe = self.redis.pipeline(transaction=False)
+        for key, args in by_key.items():
+            for i in range(0, len(args), _SCRIPT_CHUNK_SIZE * 2):
+                await self._set_many_if_newer(keys=[key], args=args[i:i + _SCRIPT_CHUNK_SIZE * 2], client=pipe)
+        await pipe.execute()
+
+    async def get(self, x: int, y: int) -> int:
+        """Get the latest log ID of (x, y), 0 if unknown."""
+        key, index = self._locate(x, y)
+        result = await self.redis.execute_command("BITFIELD", key, "GET", "i64", f"#{index}")
+        return int(result[0]) if result else 0
+
+    async def get_many(self, xs: List[int], ys: List[int]) -> List[int]:
+        """Get the latest log IDs of many pixels with one pipelined round trip, 0 if unknown."""
+        pipe = self.redis.pipeline(transaction=False)
+        for x, y in zip(xs, ys):
+            key, index = self._locate(x, y)
+            pipe.execute_command("BITFIELD", key, "GET", "i64", f"#{index}")
+        return [int(result[0]) if result else 0 for result in await pipe.execute()]
+
+    async def get_region(self, x: int, y: int, width: int, height: int) -> np.ndarray:
+        """Get the latest log IDs of a rectangular region as a (height, width) int64 array.
+
+        Reads one GETRANGE per shard when the region spans the shard's full
+        width and one per row otherwise, all in a single pipeline.
+        """
+        if width <= 0 or height <= 0 or not (
+            self.canvas.contains(x, y) and self.canvas.contains(x + width - 1, y + height - 1)
+        ):
+            raise ValueError("Region out of bounds")
+
+        pipe = self.redis.pipeline(transaction=False)
+        reads: List[Tuple[int, int, int, int]] = []
+        for row, column in self.canvas.shards_in_region(x, y, width, height):
+            sx, sy, shard_width, shard_height = self.canvas.shard_bounds(row, column)
+            left, right = max(x, sx), min(x + width, sx + shard_width)
+            top, bottom = max(y, sy), min(y + height, sy + shard_height)
+            key = self.shard_key(row, column)
+            if left == sx and right == sx + shard_width:
+                start = (top - sy) * shard_width * 8
+                pipe.getrange(key, start, start + (bottom - top) * shard_width * 8 - 1)
+                reads.append((left, right, top, bottom))
+            else:
+                for line in range(top, bottom):
+                    start = ((line - sy) * shard_width + (left - sx)) * 8
+                    pipe.getrange(key, start, start + (right - left) * 8 - 1)
+                    reads.append((left, right, line, line + 1))
+
+        region = np.zeros((height, width), dtype=np.int64)
+        for (left, right, top, bottom), data in zip(reads, await pipe.execute()):
+            # 索引字符串末尾未写入的部分按0处理
+            values = np.zeros((bottom - top) * (right - left), dtype=np.int64)
+            stored = np.frombuffer(data or b"", dtype=">i8")
+            values[:len(stored)] = stored
+            region[top - y:bottom - y, left - x:right - x] = values.reshape(bottom - top, right - left)
+        return region
+
+    async def delete(self):
+        """Delete the index of this geometry version."""
+        await self.redis.delete(*(self.shard_key(row, column) for row, column in self.canvas.shards()))
+
+    async def delete_legacy(self) -> int:
+        """Delete the uint32 index of this geometry version written by earlier releases."""
+        legacy_prefix = f"{LEGACY_KEY_PREFIX}:{self.base_key}"
+        keys = [legacy_prefix if not self.canvas.sharded else f"{legacy_prefix}:{row}:{column}"
+                for row, column in self.canvas.shards()]
+        return await self.redis.delete(*keys)
+
+    async def merge_frame(self, log_ids: np.ndarray):
+        """Merge a full (height, width) array of log IDs into the index, keeping the larger ID per pixel."""
+        if log_ids.shape != (self.canvas.height, self.canvas.width):
+            raise ValueError("Log ID array size does not match the canvas")
+        await self.merge_rows(0, log_ids)
+
+    async def merge_rows(self, y: int, log_ids: np.ndarray):
+        """Merge the log IDs of whole shard rows, a (rows, width) array starting at row ``y``.
+
+        Each shard is merged atomically: it is read and written under WATCH,
+        and if placements keep changing it, the non-zero IDs are written with
+        the per-pixel compare-and-set script instead.
+
+        Raises:
+            ValueError: If the rows are not aligned to shards or an ID is not storable
+        """
+        height = log_ids.shape[0]
+        shard_size = self.canvas.shard_size if self.canvas.sharded else self.canvas.height
+        if log_ids.shape[1] != self.canvas.width or y % shard_size or not (
+            y + height == self.canvas.height or height % shard_size == 0
+        ):
+            raise ValueError("Log ID rows are not aligned to the canvas shards")
+        if len(log_ids) and (log_ids.min() < 0 or log_ids.max() > MAX_LOG_ID):
+            raise ValueError("Log IDs cannot be stored in the last-writer index")
+        for row, column in self.canvas.shards_in_region(0, y, self.canvas.width, height):
+            x0, y0, width, shard_height = self.canvas.shard_bounds(row, column)
+            shard = log_ids[y0 - y:y0 - y + shard_height, x0:x0 + width].astype(np.int64)
+            await self._merge_shard(self.shard_key(row, column), shard)
+
+    async def _merge_shard(self, key: str, log_ids: np.ndarray):
+        async with self.redis.pipeline(transaction=True) as pipe:
+            for _ in range(_MERGE_ATTEMPTS):
+                try:
+                    await pipe.watch(key)
+                    current = np.zeros(log_ids.size, dtype=np.int64)
+                    stored = np.frombuffer(await pipe.get(key) or b"", dtype=">i8")
+                    current[:len(stored)] = stored
+                    merged = np.maximum(current, log_ids.ravel())
+                    pipe.multi()
+                    pipe.set(key, merged.astype(">i8").tobytes())
+                    await pipe.execute()
+                    return
+                except WatchError:
+                    continue
+        # 分片持续被写入：逐像素比较写入，每个脚本调用内是原子的；
+        # 键不存在时先创建，使 exists() 视其为已建立
+        await self.redis.set(key, np.zeros(log_ids.size, dtype=">i8").tobytes(), nx=True)
+        indices = np.flatnonzero(log_ids.ravel())
+        args = []
+        for index, log_id in zip(indices.tolist(), log_ids.ravel()[indices].tolist()):
+            args.extend((f"#{index}", log_id))
+        await self._run_set_scripts({key: args})
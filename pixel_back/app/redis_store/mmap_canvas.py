@@ -0,0 +1,256 @@
+"""
+Canvas backend keeping the pixels in a memory-mapped file.
+
+The file is a 16-byte header (magic, width, height) followed by the
+row-major RGB bytes of the canvas. Every uvicorn worker on the host maps the
+same file with MAP_SHARED, so a write by one worker is immediately visible to
+the others, and a restarted worker reattaches to the existing file without
+loading anything. Files are only ever created (atomically, with a hard link)
+and then written in place, never replaced, so no worker is left mapping a
+stale copy. An expansion writes the next geometry version to a new file and
+then retires the old one: writes check under the lock that their file still
+exists, so a worker still mapping the old version fails instead of writing
+pixels nobody will read.
+
+Pixels are 3 bytes and their copies are not atomic, so every access holds a
+``flock`` on ``<file>.lock``: shared for reads, exclusive for writes, plus a
+thread lock within the process, since the executor may write whole frames
+while the event loop reads. Writes reach other workers through the shared
+mapping at once; ``mmap_sync_loop`` msyncs written files every
+CANVAS_MMAP_SYNC_INTERVAL seconds (and at shutdown), which bounds what a
+host crash loses.
+
+This backend and ``local_pubsub`` take Redis off the pixel path only: job
+locks, counters, the last-writer index, user statistics and replica
+tracking still need Redis.
+"""
+
+import asyncio
+import fcntl
+import os
+import struct
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from typing import Dict, List, Optional, Set, Tuple
+
+import numpy as np
+
+from app.canvas_registry import CanvasConfig
+from app.config import CANVAS_MMAP_DIRECTORY, CANVAS_MMAP_SYNC_INTERVAL
+from app.redis_store.canvas_backend import CanvasBackend
+from app.utils.logger import logger
+from app.utils.utils import apply_pixel_updates, hex_colors_to_rgb, rgb_to_hex_colors
+
+MAGIC = b"PXCANVS1"
+HEADER = struct.Struct("<8sII")
+
+# 每个进程内按画布缓存 (文件路径, 映射)；切换到新的几何版本时释放旧映射
+_mappings: Dict[str, Tuple[str, np.memmap]] = {}
+# 按文件路径缓存的锁
+_locks: Dict[str, "CanvasFileLock"] = {}
+# 上次同步之后写入过的文件
+_written: Set[str] = set()
+
+
+class CanvasFileLock:
+    """Reader/writer lock of a canvas file across the workers of a host and the threads of a worker."""
+
+    def __init__(self, path: str):
+        self.fd = os.open(f"{path}.lock", os.O_RDWR | os.O_CREAT, 0o644)
+        self._thread_lock = threading.Lock()
+
+    @contextmanager
+    def hold(self, exclusive: bool):
+        with self._thread_lock:
+            fcntl.flock(self.fd, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+            try:
+                yield
+            finally:
+                fcntl.flock(self.fd, fcntl.LOCK_UN)
+
+    def close(self):
+        os.close(self.fd)
+
+
+def _lock_of(path: str) -> CanvasFileLock:
+    lock = _locks.get(path)
+    if lock is None:
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        lock = _locks[path] = CanvasFileLock(path)
+    return lock
+
+
+def canvas_file_path(canvas_id: str, version: int = 0) -> str:
+    """Get the path of the memory-mapped file of a canvas geometry version."""
+    name = canvas_id if version == 0 else f"{canvas_id}.v{version}"
+    return os.path.join(CANVAS_MMAP_DIRECTORY, f"{name}.canvas")
+
+
+def _read_header(path: str):
+    try:
+        with open(path, "rb") as f:
+            header = f.read(HEADER.size)
+    except FileNotFoundError:
+        return None
+    if len(header) != HEADER.size:
+        return None
+    magic, width, height = HEADER.unpack(header)
+    return (width, height) if magic == MAGIC else None
+
+
+class MmapCanvasBackend(CanvasBackend):
+    """Canvas pixels in a memory-mapped file shared by the workers of one host."""
+
+    def __init__(self, canvas: CanvasConfig):
+        super().__init__(canvas)
+        self.path = canvas_file_path(canvas.id, canvas.version)
+
+    @contextmanager
+    def _reading(self):
+        with _lock_of(self.path).hold(exclusive=False):
+            yield self._frame()
+
+    @contextmanager
+    def _writing(self):
+        with _lock_of(self.path).hold(exclusive=True):
+            if not os.path.exists(self.path):
+                raise RuntimeError(f"{self.path} does not exist; it was retired by an expansion or never created")
+            yield self._frame()
+        _written.add(self.path)
+
+    def _open(self) -> Optional[np.memmap]:
+        cached = _mappings.get(self.canvas.id)
+        if cached is not None and cached[0] == self.path:
+            return cached[1]
+        if _read_header(self.path) != (self.canvas.width, self.canvas.height):
+            return None
+        frame = np.memmap(self.path, dtype=np.uint8, mode="r+", offset=HEADER.size,
+                          shape=(self.canvas.height, self.canvas.width, 3))
+        _mappings[self.canvas.id] = (self.path, frame)
+        return frame
+
+    def _create(self) -> np.memmap:
+        """Create the file filled with white unless it exists, and map it."""
+        frame = self._open()
+        if frame is not None:
+            return frame
+        if os.path.exists(self.path):
+            raise ValueError(f"{self.path} does not hold a {self.canvas.width}x{self.canvas.height} canvas")
+        os.makedirs(CANVAS_MMAP_DIRECTORY, exist_ok=True)
+        temp_path = f"{self.path}.{uuid.uuid4().hex}.tmp"
+        try:
+            with open(temp_path, "wb") as f:
+                f.write(HEADER.pack(MAGIC, self.canvas.width, self.canvas.height))
+                row = b"\xff" * (self.canvas.width * 3)
+                for _ in range(self.canvas.height):
+                    f.write(row)
+                f.flush()
+                os.fsync(f.fileno())
+            try:
+                # 硬链接在目标已存在时失败，多个工作进程同时创建时只有一个生效
+                os.link(temp_path, self.path)
+            except FileExistsError:
+                pass
+        finally:
+            os.unlink(temp_path)
+        _lock_of(self.path)
+        return self._open()
+
+    def _frame(self) -> np.memmap:
+        frame = self._open()
+        if frame is None:
+            raise ValueError(f"Canvas {self.canvas.id} is not initialized")
+        return frame
+
+    async def exists(self) -> bool:
+        return self._open() is not None
+
+    async def initialize_canvas(self):
+        await asyncio.get_event_loop().run_in_executor(None, self._create)
+
+    def _write_frame(self, frame: np.ndarray):
+        self._create()
+        with self._writing() as mapping:
+            mapping[:] = frame
+        mapping.flush()
+
+    async def set_frame(self, frame: np.ndarray):
+        await asyncio.get_event_loop().run_in_executor(None, self._write_frame, frame)
+
+    async def delete(self):
+        # 其他工作进程已有的映射在解除前仍然有效，但其写入会在持锁检查文件时失败
+        cached = _mappings.get(self.canvas.id)
+        if cached is not None and cached[0] == self.path:
+            del _mappings[self.canvas.id]
+        with _lock_of(self.path).hold(exclusive=True):
+            if os.path.exists(self.path):
+                os.unlink(self.path)
+        _locks.pop(self.path).close()
+        _written.discard(self.path)
+
+    async def get_pixel(self, x: int, y: int) -> str:
+        with self._reading() as frame:
+            pixel = np.array(frame[y, x])
+        return rgb_to_hex_colors(pixel.reshape(1, 3))[0]
+
+    async def set_pixel(self, x: int, y: int, color: str) -> bool:
+        rgb = hex_colors_to_rgb([color])[0]
+        with self._writing() as frame:
+            frame[y, x] = rgb
+        return True
+
+    async def set_pixels(self, xs: List[int], ys: List[int], colors: List[str]):
+        rgb = hex_colors_to_rgb(colors)
+        with self._writing() as frame:
+            apply_pixel_updates(frame, np.asarray(xs), np.asarray(ys), rgb)
+
+    async def set_region(self, x: int, y: int, region: np.ndarray, mask: np.ndarray) -> int:
+        height, width = region.shape[:2]
+        with self._writing() as frame:
+            np.copyto(frame[y:y + height, x:x + width], region, where=mask[:, :, None])
+        return int(mask.sum())
+
+    async def compare_and_set_region(
+        self, x: int, y: int, region: np.ndarray, mask: np.ndarray, expected: np.ndarray
+    ) -> np.ndarray:
+        height, width = region.shape[:2]
+        with self._writing() as frame:
+            target = frame[y:y + height, x:x + width]
+            written = mask & (target == expected).all(axis=2)
+            np.copyto(target, region, where=written[:, :, None])
+        return written
+
+    async def get_region(self, x: int, y: int, width: int, height: int) -> np.ndarray:
+        # 仅需一次内存拷贝，无需解析颜色字符串；拷贝使调用方不受后续写入影响
+        with self._reading() as frame:
+            return np.array(frame[y:y + height, x:x + width])
+
+
+def sync_mapped_canvases() -> int:
+    """msync the mapped canvas files written since the last call.
+
+    Returns:
+        The number of files synced
+    """
+    synced = 0
+    for path, mapping in list(_mappings.values()):
+        if path in _written:
+            _written.discard(path)
+            mapping.flush()
+            synced += 1
+    return synced
+
+
+async def mmap_sync_loop():
+    """Background loop syncing written canvas files to disk every CANVAS_MMAP_SYNC_INTERVAL seconds."""
+    while True:
+        await asyncio.sleep(CANVAS_MMAP_SYNC_INTERVAL)
+        try:
+            start_time = time.time()
+            synced = await asyncio.get_event_loop().run_in_executor(None, sync_mapped_canvases)
+            if synced:
+                logger.debug(f"Synced {synced} canvas files in {time.time() - start_time:.2f} seconds")
+        except Exception as e:
+            logger.error(f"Error syncing canvas files: {str(e)}", exc_info=True)
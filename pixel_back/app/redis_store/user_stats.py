@@ -0,0 +1,224 @@
+import base64
+from datetime import datetime, timezone
+from typing import Dict, List, Optional, Tuple
+from redis import asyncio as aioredis
+from app.canvas_registry import DEFAULT_CANVAS_ID, get_canvas_config
+
+# 记录实时落子：跳过ID不大于下限的日志（重建时已计入），并记录已计入的最大ID。
+# KEYS: placements, last_placed, recorded, floor；ARGV 为 (用户, 日志ID, 时间戳) 三元组
+_RECORD_SCRIPT = """
+local floor = tonumber(redis.call('GET', KEYS[4]) or '0')
+local recorded = tonumber(redis.call('GET', KEYS[3]) or '0')
+for i = 1, #ARGV, 3 do
+    local log_id = tonumber(ARGV[i + 1])
+    if log_id > floor then
+        redis.call('ZINCRBY', KEYS[1], 1, ARGV[i])
+        local last = tonumber(redis.call('HGET', KEYS[2], ARGV[i]) or '0')
+        if tonumber(ARGV[i + 2]) > last then
+            redis.call('HSET', KEYS[2], ARGV[i], ARGV[i + 2])
+        end
+        if log_id > recorded then
+            recorded = log_id
+        end
+    end
+end
+redis.call('SET', KEYS[3], recorded)
+return recorded
+"""
+
+# 换入重建结果，并把下限设为此刻已实时计入的最大ID（不小于重建覆盖到的ID）。
+# KEYS: placements, last_placed, 临时 placements, 临时 last_placed, built, recorded, floor
+# ARGV: 重建覆盖到的日志ID, 构建时间
+_REPLACE_SCRIPT = """
+for i = 1, 2 do
+    if redis.call('EXISTS', KEYS[i + 2]) == 1 then
+        redis.call('RENAME', KEYS[i + 2], KEYS[i])
+    else
+        redis.call('DEL', KEYS[i])
+    end
+end
+redis.call('SET', KEYS[5], ARGV[2])
+local floor = math.max(tonumber(redis.call('GET', KEYS[6]) or '0'), tonumber(ARGV[1]))
+redis.call('SET', KEYS[7], floor)
+return floor
+"""
+
+
+def encode_cursor(placements: int, user_id: str) -> str:
+    """Encode the position after a leaderboard entry as an opaque cursor."""
+    return base64.urlsafe_b64encode(f"{placements}:{user_id}".encode()).decode().rstrip("=")
+
+
+def decode_cursor(cursor: str) -> Tuple[int, str]:
+    """Decode a cursor into (placements, user ID).
+
+    Raises:
+        ValueError: If the cursor is malformed
+    """
+    try:
+        text = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)).decode()
+        placements, _, user_id = text.partition(":")
+        return int(placements), user_id
+    except (ValueError, UnicodeDecodeError):
+        raise ValueError("Invalid cursor")
+
+
+class UserStatsStore:
+    """Redis store for per-user placement statistics of a canvas.
+
+    Placement counts live in a sorted set (which doubles as the leaderboard)
+    and last placement times, as Unix timestamps, in a hash. All keys of a
+    canvas share the ``{<canvas id>}`` hash tag, so the rebuild can swap them
+    in with RENAME on a Redis Cluster too.
+
+    Live placements are recorded with their log IDs. The highest one counted
+    is kept, and after a rebuild placements at or below the ``floor`` it set
+    are skipped, since the rebuild has counted them from the logs.
+    """
+
+    def __init__(self, redis: aioredis.Redis, canvas_id: str = DEFAULT_CANVAS_ID):
+        self.redis = redis
+        self.canvas_id = get_canvas_config(canvas_id).id
+        prefix = f"user_stats:{{{self.canvas_id}}}"
+        self.placements_key = f"{prefix}:placements"
+        self.last_placed_key = f"{prefix}:last_placed"
+        self.built_key = f"{prefix}:built"
+        self.recorded_key = f"{prefix}:recorded"
+        self.floor_key = f"{prefix}:floor"
+        self._record_script = redis.register_script(_RECORD_SCRIPT)
+        self._replace_script = redis.register_script(_REPLACE_SCRIPT)
+
+    async def record(self, user_id: Optional[str], log_id: int, placed_at: datetime):
+        """Count a placement; naive placement times are taken as UTC."""
+        await self.record_many([(user_id, log_id, placed_at)])
+
+    async def record_many(self, placements: List[Tuple[Optional[str], int, datetime]]):
+        """Count placements with one script call.
+
+        Args:
+            placements: (user ID, log ID, placement time) of each placement
+        """
+        args = []
+        for user_id, log_id, placed_at in placements:
+            if not user_id:
+                continue
+            if placed_at.tzinfo is None:
+                placed_at = placed_at.replace(tzinfo=timezone.utc)
+            args.extend((user_id, int(log_id), placed_at.timestamp()))
+        if args:
+            await self._record_script(
+                keys=[self.placements_key, self.last_placed_key, self.recorded_key, self.floor_key], args=args
+            )
+
+    async def add(self, placements: Dict[str, int], last_placed: Dict[str, float]):
+        """Add counts aggregated from the logs, bypassing the floor of live recording."""
+        pipe = self.redis.pipeline(transaction=True)
+        for user_id, count in placements.items():
+            pipe.zincrby(self.placements_key, count, user_id)
+        for user_id, placed in last_placed.items():
+            # 最后落子时间只增不减
+            pipe.eval(
+                "if tonumber(ARGV[2]) > tonumber(redis.call('HGET', KEYS[1], ARGV[1]) or '0') then "
+                "redis.call('HSET', KEYS[1], ARGV[1], ARGV[2]) end return 0",
+                1, self.last_placed_key, user_id, placed,
+            )
+        if len(pipe):
+            await pipe.execute()
+
+    async def is_built(self) -> bool:
+        return bool(await self.redis.exists(self.built_key))
+
+    async def replace(self, placements: Dict[str, int], last_placed: Dict[str, float], up_to_id: int) -> int:
+        """Atomically replace all statistics with the ones counted from the logs up to ``up_to_id``.
+
+        Returns:
+            The new floor of live recording: placements up to it that were
+            recorded live before the swap are lost, and must be added from
+            the logs after ``up_to_id``
+        """
+        temp_placements = f"{self.placements_key}:rebuild"
+        temp_last_placed = f"{self.last_placed_key}:rebuild"
+        pipe = self.redis.pipeline(transaction=False)
+        pipe.delete(temp_placements, temp_last_placed)
+        items = list(placements.items())
+        for i in range(0, len(items), 1000):
+            pipe.zadd(temp_placements, dict(items[i:i + 1000]))
+        items = list(last_placed.items())
+        for i in range(0, len(items), 1000):
+            pipe.hset(temp_last_placed, mapping=dict(items[i:i + 1000]))
+        await pipe.execute()
+
+        # 临时键与正式键位于同一槽位，整体替换
+        floor = await self._replace_script(
+            keys=[
+                self.placements_key, self.last_placed_key, temp_placements, temp_last_placed,
+                self.built_key, self.recorded_key, self.floor_key,
+            ],
+            args=[up_to_id, datetime.utcnow().isoformat()],
+        )
+        return int(floor)
+
+    async def get_user(self, user_id: str) -> Tuple[int, Optional[int], Optional[float]]:
+        """Get (placements, 0-based rank or None, last placement timestamp or None) of a user."""
+        pipe = self.redis.pipeline(transaction=False)
+        pipe.zscore(self.placements_key, user_id)
+        pipe.zrevrank(self.placements_key, user_id)
+        pipe.hget(self.last_placed_key, user_id)
+        score, rank, last_placed = await pipe.execute()
+        return (
+            int(score or 0),
+            rank,
+            float(last_placed) if last_placed is not None else None,
+        )
+
+    async def count_users(self) -> int:
+        return await self.redis.zcard(self.placements_key)
+
+    async def leaderboard(
+        self, after: Optional[Tuple[int, str]], limit: int
+    ) -> List[Tuple[int, str, int, Optional[float]]]:
+        """Get a page of the leaderboard.
+
+        Pages are positioned by the (placements, user ID) of the last entry
+        of the previous page rather than by rank, so users moving up or down
+        between pages do not shift the following pages. Users with the same
+        count are in descending byte order of their IDs, like ZREVRANGE.
+
+        Args:
+            after: (placements, user ID) of the last entry of the previous page, or None
+            limit: Page size
+
+        Returns:
+            (0-based rank, user ID, placements, last placement timestamp) tuples
+        """
+        start = 0 if after is None else await self._position_after(*after)
+        entries = await self.redis.zrevrange(self.placements_key, start, start + limit - 1, withscores=True)
+        if not entries:
+            return []
+        last_placed = await self.redis.hmget(self.last_placed_key, [user_id for user_id, _ in entries])
+        return [
+            (start + i, user_id, int(score), float(placed) if placed is not None else None)
+            for i, ((user_id, score), placed) in enumerate(zip(entries, last_placed))
+        ]
+
+    async def _position_after(self, placements: int, user_id: str) -> int:
+        """Get the rank of the first entry ordered after (placements, user_id)."""
+        pipe = self.redis.pipeline(transaction=False)
+        pipe.zscore(self.placements_key, user_id)
+        pipe.zrevrank(self.placements_key, user_id)
+        pipe.zcount(self.placements_key, f"({placements}", "+inf")
+        pipe.zcount(self.placements_key, placements, placements)
+        score, rank, above, ties = await pipe.execute()
+        if score is not None and int(score) == placements:
+            return rank + 1
+        # 游标用户的计数已变化：在同分用户中二分查找第一个 ID 更小的位置
+        low, high = above, above + ties
+        target = user_id.encode()
+        while low < high:
+            middle = (low + high) // 2
+            member = await self.redis.zrevrange(self.placements_key, middle, middle)
+            if member and member[0].encode() >= target:
+                low = middle + 1
+            else:
+                high = middle
+        return low
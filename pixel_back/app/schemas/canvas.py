@@ -0,0 +1,14 @@
+from pydantic import BaseModel
+from typing import List, Optional
+
+
+class CanvasResizeRequest(BaseModel):
+    """Model for expanding a canvas; the new size must not be smaller on either side."""
+    width: int
+    height: int
+
+
+class CanvasResyncRequest(BaseModel):
+    """Model for a differential resync: the client's root hash and/or its tile hashes in row-major order."""
+    root: Optional[str] = None
+    tiles: Optional[List[int]] = None
@@ -1,10 +1,13 @@
 from pydantic import BaseModel
-from typing import Optional
+from typing import List, Optional
 from datetime import datetime
 
 
 class PixelUpdateEvent(BaseModel):
-    """Model for pixel update events."""
+    """Model for pixel update events.
+
+    ``timestamp`` is informational; logs are stamped with the server time.
+    """
     x: int
     y: int
     color: str
@@ -12,9 +15,29 @@ class PixelUpdateEvent(BaseModel):
     timestamp: Optional[datetime] = None
 
 
+class PixelBatchEvent(BaseModel):
+    """Model for batched pixel placements, applied as one unit.
+
+    Pixels without their own ``user_id`` take the batch's; every placement
+    is stamped with the server time.
+    """
+    pixels: List[PixelUpdateEvent]
+    user_id: Optional[str] = None
+    timestamp: Optional[datetime] = None
+
+
+class PixelResult(BaseModel):
+    """Model for the outcome of one pixel of a batch."""
+    index: int
+    ok: bool
+    log_id: Optional[int] = None
+    error: Optional[str] = None
+
+
 class CanvasSnapshot(BaseModel):
     """Model for canvas snapshot metadata."""
     id: Optional[int] = None
     created_at: Optional[datetime] = None
     last_log_id: Optional[int] = None
-    data_file_path: str
\ No newline at end of file
+    data_file_path: str
+    geometry_version: int = 0
\ No newline at end of file
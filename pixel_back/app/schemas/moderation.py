@@ -0,0 +1,28 @@
+from pydantic import BaseModel
+from typing import Optional
+
+
+class RegionRequest(BaseModel):
+    """Model for a moderation operation on a rectangle of the canvas.
+
+    ``mask`` optionally restricts the operation to some pixels of the
+    rectangle: base64 of the row-major mask bits packed 8 per byte, most
+    significant bit first (NumPy ``packbits``).
+    """
+    x: int
+    y: int
+    width: int
+    height: int
+    mask: Optional[str] = None
+    user_id: Optional[str] = None  # moderator recorded on the pixel logs
+
+
+class RegionRevertRequest(RegionRequest):
+    """Model for reverting a region to a past state, given by exactly one of log_id and snapshot_id."""
+    log_id: Optional[int] = None
+    snapshot_id: Optional[int] = None
+
+
+class RegionFillRequest(RegionRequest):
+    """Model for filling a region with one color."""
+    color: str
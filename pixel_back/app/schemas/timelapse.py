@@ -0,0 +1,33 @@
+from pydantic import BaseModel
+from typing import Optional
+from datetime import datetime
+from app.canvas_registry import DEFAULT_CANVAS_ID
+
+
+class TimelapseRequest(BaseModel):
+    """Model for timelapse export requests.
+
+    Exactly one of ``step_logs`` and ``step_seconds`` may be given; when
+    neither is, frames are taken every TIMELAPSE_DEFAULT_STEP_LOGS logs.
+    """
+    canvas_id: str = DEFAULT_CANVAS_ID
+    step_logs: Optional[int] = None
+    step_seconds: Optional[float] = None
+    start_snapshot_id: Optional[int] = None
+    start_log_id: Optional[int] = None
+    end_log_id: Optional[int] = None
+    format: str = "gif"  # "gif" or "zip" (PNG frame sequence)
+    scale: int = 1  # keep every n-th pixel in both directions
+    frame_duration_ms: int = 100
+
+
+class TimelapseJob(BaseModel):
+    """Model for timelapse job status."""
+    id: str
+    status: str
+    format: str
+    frames: int = 0
+    last_log_id: Optional[int] = None
+    error: Optional[str] = None
+    created_at: Optional[datetime] = None
+    finished_at: Optional[datetime] = None
@@ -1,19 +1,38 @@
+from app.canvas_registry import CanvasConfig
 from app.redis_store.canvas import CanvasStore
-from app.db.crud import create_pixel_log, get_latest_snapshot, create_snapshot
-from app.schemas.events import PixelUpdateEvent
+from app.db.crud import create_pixel_log, create_pixel_logs, get_latest_snapshot, create_snapshot
+from app.schemas.events import PixelBatchEvent, PixelResult, PixelUpdateEvent
+from app.config import PIXEL_BATCH_MAX_SIZE
+import app.deps as deps
 from app.utils.logger import logger
-from app.config import SNAPSHOT_DIRECTORY, CANVAS_WIDTH, CANVAS_HEIGHT
 from sqlalchemy.ext.asyncio import AsyncSession
 from datetime import datetime
-import json
-import os
 import time
 import asyncio
 from concurrent.futures import ThreadPoolExecutor
-from app.utils.utils import color_array_to_png
+import numpy as np
+from app.services.snapshot_store import get_snapshot_store, mark_keyframe_live
+from app.services.last_writer_service import record_last_writer, record_last_writers
+from app.services.pyramid_service import get_pyramid
+from app.services.heatmap_service import save_heatmap_snapshot
+from app.utils.utils import is_hex_color
+from typing import List, Tuple
+from app.redis_store.user_stats import UserStatsStore
 import traceback
 
 
+def validate_pixel(canvas: CanvasConfig, event: PixelUpdateEvent):
+    """Check a pixel placement before any I/O.
+
+    Raises:
+        ValueError: If the pixel is out of bounds or its color is invalid
+    """
+    if not canvas.contains(event.x, event.y):
+        raise ValueError("Coordinates out of bounds")
+    if not is_hex_color(event.color):
+        raise ValueError("Invalid color, expected #RRGGBB")
+
+
 class CanvasService:
     """Service for handling canvas operations."""
     
@@ -31,15 +50,25 @@ class CanvasService:
             The ID of the created log entry
             
         Raises:
+            ValueError: If the placement is invalid, before anything is written
             Exception: If the update process fails
         """
+        self.validate_pixel(event)
         try:
+            # Log to database using the provided session, before Redis, so a
+            # failed insert leaves the canvas untouched
+            # Note: Transaction management is handled by the caller
+            log_entry = await create_pixel_log(self.db, event, self.redis_store.canvas_id)
+
             # Update Redis
             await self.redis_store.set_pixel(event.x, event.y, event.color)
-            
-            # Log to database using the provided session
-            # Note: Transaction management is handled by the caller
-            log_entry = await create_pixel_log(self.db, event)
+
+            # Record the author of the pixel for "who placed this" lookups
+            await record_last_writer(self.redis_store.canvas_id, event.x, event.y, log_entry.id)
+            # Bump the placement statistics of the user
+            await UserStatsStore(self.redis_store.redis, self.redis_store.canvas_id).record(
+                event.user_id, log_entry.id, log_entry.created_at
+            )
                 
             logger.info(
                 f"Pixel updated at ({event.x}, {event.y}) with color {event.color} "
@@ -52,61 +81,180 @@ class CanvasService:
             logger.error(f"Error processing pixel update: {str(e)}", exc_info=True)
             raise
             
-    async def _save_snapshot_image(self, canvas_data: list) -> str:
+    def validate_pixel(self, event: PixelUpdateEvent):
+        """Check a pixel placement of this canvas before any I/O."""
+        validate_pixel(self.redis_store.canvas, event)
+
+    async def process_pixel_batch(
+        self, batch: PixelBatchEvent, max_size: int = PIXEL_BATCH_MAX_SIZE
+    ) -> Tuple[List[PixelResult], List[PixelUpdateEvent]]:
+        """Apply a batch of pixel placements as one unit.
+
+        Invalid pixels are reported and skipped; the valid ones are written
+        with one multi-row log insert and then one Redis pipeline, in batch
+        order, so the last placement of a repeated pixel wins.
+
+        Args:
+            batch: PixelBatchEvent containing the placements
+            max_size: Largest accepted batch
+
+        Returns:
+            The result of every pixel, and the applied placements
+
+        Raises:
+            ValueError: If the batch is empty or larger than ``max_size``
+        """
+        if not batch.pixels:
+            raise ValueError("Batch contains no pixels")
+        if len(batch.pixels) > max_size:
+            raise ValueError(f"Batch contains more than {max_size} pixels")
+
+        canvas_id = self.redis_store.canvas_id
+        # 落子时间由服务器决定，忽略客户端提供的时间
+        timestamp = datetime.utcnow()
+        results = []
+        applied = []
+        for index, pixel in enumerate(batch.pixels):
+            try:
+                self.validate_pixel(pixel)
+            except ValueError as e:
+                results.append(PixelResult(index=index, ok=False, error=str(e)))
+                continue
+            results.append(PixelResult(index=index, ok=True))
+            applied.append(PixelUpdateEvent(
+                x=pixel.x,
+                y=pixel.y,
+                color=pixel.color,
+                user_id=pixel.user_id or batch.user_id,
+                timestamp=timestamp,
+            ))
+        if not applied:
+            return results, applied
+
+        try:
+            xs = [pixel.x for pixel in applied]
+            ys = [pixel.y for pixel in applied]
+
+            # One multi-row insert and one pipelined Redis write for the whole batch;
+            # the insert goes first, so a failed one leaves the canvas untouched
+            log_ids = await create_pixel_logs(self.db, applied, canvas_id)
+            await self.redis_store.set_pixels(xs, ys, [pixel.color for pixel in applied])
+
+            await record_last_writers(canvas_id, xs, ys, log_ids)
+            await UserStatsStore(self.redis_store.redis, canvas_id).record_many(
+                [(pixel.user_id, log_id, pixel.timestamp) for pixel, log_id in zip(applied, log_ids)]
+            )
+        except Exception as e:
+            logger.error(f"Error processing pixel batch: {str(e)}", exc_info=True)
+            raise
+
+        for result, log_id in zip((result for result in results if result.ok), log_ids):
+            result.log_id = log_id
+        logger.info(
+            f"Applied {len(applied)} of {len(batch.pixels)} batched pixels on canvas {canvas_id} "
+            f"by user {batch.user_id}. Log entry IDs: {log_ids[0]}..{log_ids[-1]}"
+        )
+        return results, applied
+
+    async def _save_snapshot_image(self, frame: np.ndarray, latest_filename: str = None) -> str:
         """Save snapshot image in a thread pool to avoid blocking the event loop."""
         loop = asyncio.get_event_loop()
         with ThreadPoolExecutor() as executor:
             # Run the blocking image creation in a separate thread
-            filepath = await loop.run_in_executor(
+            filename = await loop.run_in_executor(
                 executor, 
                 self._create_and_save_image,
-                canvas_data
+                frame,
+                latest_filename
             )
-            return filepath
+            return filename
     
-    def _create_and_save_image(self, canvas_data: list) -> str:
+    def _create_and_save_image(self, frame: np.ndarray, latest_filename: str = None) -> str:
         """Create and save image in a separate thread."""
-        # Ensure snapshot directory exists
-        os.makedirs(SNAPSHOT_DIRECTORY, exist_ok=True)
-        
-        # Create snapshot file
-        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-        filename = f"snapshot_{timestamp}.png"
-        filepath = os.path.join(SNAPSHOT_DIRECTORY, filename)
-
-        # Convert color array to PNG and save to file
-        color_array_to_png(canvas_data, CANVAS_WIDTH, CANVAS_HEIGHT, filepath)
-        return filepath
+        # Store the RGB frame as a keyframe or a delta of this canvas
+        store = get_snapshot_store(self.redis_store.canvas_id)
+        return store.save(frame, datetime.utcnow(), latest_filename)
     
     async def create_snapshot(self, last_log_id: int) -> str:
         """Create a snapshot of the current canvas state as a PNG image."""
         start_time = time.time()
         try:
-            logger.info("Starting snapshot creation process")
+            canvas_id = self.redis_store.canvas_id
+            logger.info(f"Starting snapshot creation process for canvas {canvas_id}")
             
             # Get canvas data from Redis directly (no need to use thread pool for async operation)
             redis_start_time = time.time()
-            canvas_data = await self.redis_store.get_canvas()
+            pyramid = get_pyramid(canvas_id)
+            pyramid.track_changes()
+            # 固定当前的尺寸版本，保证画面与记录的版本一致
+            canvas = self.redis_store.canvas
+            frame = await CanvasStore(self.redis_store.redis, canvas_id, canvas=canvas).get_frame()
             redis_time = time.time() - redis_start_time
             logger.info(f"Retrieved canvas data from Redis in {redis_time:.2f} seconds")
             
             # Save image in a separate thread to avoid blocking the event loop
             image_start_time = time.time()
-            filepath = await self._save_snapshot_image(canvas_data)
+            latest_snapshot = await get_latest_snapshot(self.db, canvas_id)
+            filename = await self._save_snapshot_image(
+                frame, latest_snapshot.data_file_path if latest_snapshot else None
+            )
+            # 在任何 worker 的快照GC中保护当前关键帧
+            await mark_keyframe_live(filename)
             image_time = time.time() - image_start_time
             logger.info(f"Saved snapshot image in {image_time:.2f} seconds")
+
+            # Regenerate this worker's overview pyramid from the same frame
+            await pyramid.rebuild_from_frame(frame)
+
+            # Keep the activity heatmap next to the snapshots
+            await save_heatmap_snapshot(canvas_id)
                 
             # Save only the filename to database (not the full path)
             # Use the provided session without explicit commit
             db_start_time = time.time()
-            snapshot = await create_snapshot(self.db, last_log_id, os.path.basename(filepath))
+            snapshot = await create_snapshot(self.db, last_log_id, filename, canvas_id, canvas.version)
             db_time = time.time() - db_start_time
             logger.info(f"Saved snapshot metadata to database in {db_time:.2f} seconds")
             
             total_time = time.time() - start_time
-            logger.info(f"Created snapshot: {filepath} in {total_time:.2f} seconds")
-            return os.path.basename(filepath)
+            logger.info(f"Created snapshot: {filename} in {total_time:.2f} seconds")
+            return filename
 
         except Exception as e:
             logger.error(f"Error creating snapshot: {str(e)}", exc_info=True)
-            raise
\ No newline at end of file
+            raise
+
+
+def pixel_batch_message(pixels: List[PixelUpdateEvent]) -> dict:
+    """Build the single broadcast frame announcing a batch of placements."""
+    return {
+        "type": "pixel_batch",
+        "data": {"pixels": [{"x": pixel.x, "y": pixel.y, "color": pixel.color} for pixel in pixels]},
+    }
+
+
+async def create_snapshot_in_background(canvas_id: str, last_log_id: int):
+    """Background task creating a snapshot with its own Redis connection and database session."""
+    try:
+        logger.info(f"Starting background snapshot creation for log ID: {last_log_id}")
+        start_time = time.time()
+        async with deps.get_redis_connection() as redis_conn, deps.get_db_session() as db_session:
+            canvas_service = CanvasService(CanvasStore(redis_conn, canvas_id), db_session)
+            snapshot = await canvas_service.create_snapshot(last_log_id)
+        elapsed_time = time.time() - start_time
+        logger.info(f"Background snapshot creation completed in {elapsed_time:.2f} seconds. Snapshot: {snapshot}")
+    except Exception as e:
+        logger.error(f"Error creating snapshot in background: {str(e)}", exc_info=True)
+
+
+async def track_placements(canvas_store: CanvasStore, count: int, last_log_id: int):
+    """Count new committed pixel logs and start a snapshot once SNAPSHOT_THRESHOLD is reached."""
+    canvas_id = canvas_store.canvas_id
+    # 记录主库已提交的日志位置，供只读副本判断延迟
+    await deps.record_committed_log_id(last_log_id)
+    await deps.increment_pixel_logs_counter(canvas_id, count)
+    # 检查是否需要创建快照
+    if await deps.async_should_create_snapshot(canvas_id=canvas_id):
+        await deps.reset_pixel_logs_counter(canvas_id)
+        # 使用后台任务创建快照，避免阻塞请求处理
+        asyncio.create_task(create_snapshot_in_background(canvas_id, last_log_id))
@@ -0,0 +1,219 @@
+"""
+Online expansion of a canvas.
+
+An expansion grows a canvas to the right and/or bottom, so the coordinates of
+every existing pixel and pixel log stay valid. It writes the pixels and the
+last-writer index of the next geometry version (new Redis keys or a new mmap
+file) next to the current ones, records the version in the database with the
+last log ID placed before it, and announces it on the canvas channel: every
+worker switches its registry entry on the ``canvas_resize`` message and
+clients fetch only the added strips.
+
+Placements that reach the old version while the workers switch are replayed
+onto the new one. After CANVAS_RESIZE_GRACE_SECONDS the old pixels are
+deleted first, which fences the old version: a worker that has not switched
+yet fails its write (LSET on a missing key, or a missing mmap file), so its
+placement's log is rolled back. The expansion then waits for the
+transactions that were open at the fence, whose writes may have reached the
+old pixels, to finish, and only then replays the logs after the copy and
+deletes the old last-writer index. The last writers are copied with
+``merge_frame``, which merges each shard atomically and keeps the larger
+log ID, so placements indexed on the new version meanwhile are kept.
+"""
+
+import asyncio
+import json
+import time
+from dataclasses import replace
+from typing import Dict
+
+import numpy as np
+
+from app.canvas_registry import CanvasConfig, get_canvas_config, set_canvas_geometry
+from app.config import CANVAS_RESIZE_GRACE_SECONDS, HISTORY_LOG_CHUNK_SIZE
+from app.db.crud import create_canvas_geometry, list_canvas_geometries, wait_for_concurrent_transactions
+from app.deps import get_binary_redis_connection, get_db_session, get_redis_connection, job_lock
+from app.redis_store.canvas import CanvasStore
+from app.redis_store.last_writer import LastWriterIndex
+from app.services.canvas_service import create_snapshot_in_background
+from app.services.history_service import rows_to_updates
+from app.services.log_archive import get_max_log_id, iter_logs
+from app.utils.logger import logger
+from app.utils.utils import fit_frame, rgb_to_hex_colors
+from app.websocket.manager import publish_canvas_message
+
+# 单个画布边长上限，防止误操作创建超大画布
+MAX_CANVAS_SIDE = 100_000
+
+
+async def load_canvas_geometries():
+    """Load the geometry versions recorded in the database into the registry; call before using the canvases."""
+    async with get_db_session() as db:
+        geometries = await list_canvas_geometries(db)
+    for geometry in geometries:
+        try:
+            canvas = set_canvas_geometry(
+                geometry.canvas_id, geometry.version, geometry.width, geometry.height, geometry.after_log_id
+            )
+        except KeyError:
+            logger.warning(f"Ignoring geometry of unknown canvas {geometry.canvas_id}")
+            continue
+        logger.info(f"Canvas {canvas.id} is {canvas.width}x{canvas.height} (geometry version {canvas.version})")
+
+
+def handle_resize_message(canvas_id: str, message: str):
+    """Pub/sub listener switching this worker to a canvas's new geometry version."""
+    # 绝大多数消息是像素更新，先做字符串判断再解析
+    if '"canvas_resize"' not in message:
+        return
+    try:
+        payload = json.loads(message)
+        if payload.get("type") != "canvas_resize":
+            return
+        data = payload["data"]
+        set_canvas_geometry(
+            canvas_id, int(data["version"]), int(data["width"]), int(data["height"]), int(data["after_log_id"])
+        )
+    except (ValueError, KeyError, TypeError) as e:
+        logger.warning(f"Ignoring malformed canvas resize message: {e}")
+
+
+def resize_message(canvas: CanvasConfig, previous: CanvasConfig, after_log_id: int) -> Dict:
+    """Build the message announcing a new geometry version to workers and clients."""
+    return {
+        "type": "canvas_resize",
+        "data": {
+            "width": canvas.width,
+            "height": canvas.height,
+            "version": canvas.version,
+            "previous_width": previous.width,
+            "previous_height": previous.height,
+            "after_log_id": after_log_id,
+        },
+    }
+
+
+async def _copy_pixels(previous: CanvasConfig, expanded: CanvasConfig):
+    async with get_redis_connection() as redis_conn:
+        frame = await CanvasStore(redis_conn, previous.id, canvas=previous).get_frame()
+        await CanvasStore(redis_conn, expanded.id, canvas=expanded).set_frame(
+            fit_frame(frame, expanded.width, expanded.height)
+        )
+
+
+async def _copy_last_writers(previous: CanvasConfig, expanded: CanvasConfig):
+    async with get_binary_redis_connection() as redis_conn:
+        log_ids = await LastWriterIndex(redis_conn, previous.id, canvas=previous).get_region(
+            0, 0, previous.width, previous.height
+        )
+        padded = np.zeros((expanded.height, expanded.width), dtype=np.int64)
+        padded[:previous.height, :previous.width] = log_ids
+        # 按分片原子合并并保留较大的ID，不会覆盖期间写入新版本的落子
+        await LastWriterIndex(redis_conn, expanded.id, canvas=expanded).merge_frame(padded)
+
+
+async def _catch_up(expanded: CanvasConfig, after_log_id: int) -> int:
+    """Replay the placements logged after the copy onto the new geometry version.
+
+    A replayed pixel is written only if its log is still the pixel's latest
+    in the last-writer index, so placements that already went to the new
+    version directly are not overwritten with older colors.
+
+    Returns:
+        The number of logs replayed
+    """
+    latest: Dict[tuple, tuple] = {}
+    async with get_db_session() as db:
+        async for rows in iter_logs(db, after_log_id, None, HISTORY_LOG_CHUNK_SIZE, canvas_id=expanded.id):
+            xs, ys, rgb, kept = rows_to_updates(rows)
+            for x, y, color, i in zip(xs.tolist(), ys.tolist(), rgb_to_hex_colors(rgb), kept.tolist()):
+                # 日志按ID升序返回，同一像素保留最后一条
+                latest[(x, y)] = (rows[i].id, color)
+    if not latest:
+        return 0
+
+    xs = [x for x, _ in latest]
+    ys = [y for _, y in latest]
+    log_ids = [log_id for log_id, _ in latest.values()]
+    async with get_binary_redis_connection() as redis_conn:
+        index = LastWriterIndex(redis_conn, expanded.id, canvas=expanded)
+        await index.set_many(xs, ys, log_ids)
+        current = await index.get_many(xs, ys)
+    replay = [(x, y, color) for (x, y), (log_id, color), newest in zip(latest, latest.values(), current)
+              if newest == log_id]
+    if replay:
+        async with get_redis_connection() as redis_conn:
+            await CanvasStore(redis_conn, expanded.id, canvas=expanded).set_pixels(
+                [x for x, _, _ in replay], [y for _, y, _ in replay], [color for _, _, color in replay]
+            )
+    return len(latest)
+
+
+async def expand_canvas(canvas_id: str, width: int, height: int) -> Dict:
+    """Grow a canvas to width x height without stopping placements.
+
+    Raises:
+        ValueError: If the new size would shrink the canvas or is too large
+        RuntimeError: If another expansion of the canvas is in progress
+    """
+    previous = get_canvas_config(canvas_id)
+    if width < previous.width or height < previous.height:
+        raise ValueError("A canvas can only grow")
+    if (width, height) == (previous.width, previous.height):
+        raise ValueError("The canvas already has this size")
+    if width > MAX_CANVAS_SIDE or height > MAX_CANVAS_SIDE:
+        raise ValueError(f"Canvas sides must be at most {MAX_CANVAS_SIDE}")
+
+    async with job_lock(f"canvas_resize:{canvas_id}", 3600) as acquired:
+        if not acquired:
+            raise RuntimeError(f"Canvas {canvas_id} is already being resized")
+        start_time = time.time()
+        # 加锁后重新读取，其他工作进程可能刚完成一次扩展
+        previous = get_canvas_config(canvas_id)
+        if width < previous.width or height < previous.height or (width, height) == (previous.width, previous.height):
+            raise ValueError("The canvas was resized meanwhile")
+        expanded = replace(previous, width=width, height=height, version=previous.version + 1)
+
+        async with get_db_session() as db:
+            copied_up_to = await get_max_log_id(db)
+        await _copy_pixels(previous, expanded)
+        await _copy_last_writers(previous, expanded)
+
+        # 记录几何版本后通知所有工作进程切换，之后的落子写入新版本
+        async with get_db_session() as db:
+            await create_canvas_geometry(db, canvas_id, expanded.version, width, height, copied_up_to)
+        set_canvas_geometry(canvas_id, expanded.version, width, height, copied_up_to)
+        async with get_redis_connection() as redis_conn:
+            await publish_canvas_message(
+                redis_conn, json.dumps(resize_message(expanded, previous, copied_up_to)), canvas_id
+            )
+
+        # 等待各工作进程切换，然后删除旧版本的像素：仍未切换的写入将失败并回滚其日志
+        await asyncio.sleep(CANVAS_RESIZE_GRACE_SECONDS)
+        async with get_redis_connection() as redis_conn:
+            await CanvasStore(redis_conn, canvas_id, canvas=previous).delete()
+        # 删除之前已写入旧版本的落子，其事务结束后日志才可见
+        async with get_db_session() as db:
+            waited = await wait_for_concurrent_transactions(db)
+        if waited > 1:
+            logger.warning(f"Waited {waited:.2f} seconds for transactions open while fencing canvas {canvas_id}")
+        replayed = await _catch_up(expanded, copied_up_to)
+
+        async with get_binary_redis_connection() as redis_conn:
+            await LastWriterIndex(redis_conn, canvas_id, canvas=previous).delete()
+
+        async with get_db_session() as db:
+            last_log_id = await get_max_log_id(db)
+        asyncio.create_task(create_snapshot_in_background(canvas_id, last_log_id))
+
+        logger.info(
+            f"Expanded canvas {canvas_id} from {previous.width}x{previous.height} to {width}x{height} "
+            f"(geometry version {expanded.version}, {replayed} logs replayed) in {time.time() - start_time:.2f} seconds"
+        )
+        return {
+            "width": width,
+            "height": height,
+            "version": expanded.version,
+            "after_log_id": copied_up_to,
+            "replayed_logs": replayed,
+        }
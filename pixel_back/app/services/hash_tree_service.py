@@ -0,0 +1,212 @@
+"""
+Tile-hash tree of the live canvas, for differential resyncs and consistency checks.
+
+The canvas is split into HASH_TILE_SIZE tiles; each tile hash is the CRC32 of
+the tile's row-major RGB bytes, and the root is the 64-bit BLAKE2b, in hex,
+of the big-endian tile hashes in row-major order (see ``tile_hashes`` and
+``root_hash``). A matching root skips the whole resync, so the root must not
+collide the way a 32-bit checksum would.
+
+Each worker keeps the tree of every canvas in memory and updates it like the
+overview pyramid: pub/sub updates mark tiles dirty, and only those tiles are
+read back from Redis and rehashed before the tree is used.
+
+A client that may have missed updates sends its root, or its tile hashes,
+and gets back only the tiles that differ. ``verify_canvas`` compares the
+tree with the tiles of the latest snapshot plus logs, reporting the tiles
+where Redis disagrees.
+"""
+
+import asyncio
+import time
+from typing import Dict, List, Optional, Set, Tuple
+
+import numpy as np
+
+from app.canvas_registry import DEFAULT_CANVAS_ID, get_canvas_config, list_canvas_configs
+from app.config import CANVAS_VERIFY_INTERVAL, HASH_TILE_SIZE
+from app.deps import get_db_session, get_read_db_session, get_redis_connection, job_lock
+from app.redis_store.canvas import CanvasStore
+from app.services.history_service import get_history_service
+from app.services.log_archive import get_max_log_id, iter_logs
+from app.utils.logger import logger
+from app.utils.utils import canvas_update_regions, root_hash, tile_hashes
+
+
+class CanvasHashTree:
+    """Tile hashes of one canvas with dirty tile tracking."""
+
+    def __init__(self, canvas_id: str = DEFAULT_CANVAS_ID, tile_size: int = HASH_TILE_SIZE):
+        self.canvas = get_canvas_config(canvas_id)
+        self.tile_size = tile_size
+        self.tile_columns = -(-self.canvas.width // tile_size)
+        self.tile_rows = -(-self.canvas.height // tile_size)
+        self._hashes: Optional[np.ndarray] = None
+        self._dirty: Set[Tuple[int, int]] = set()
+        self._lock = asyncio.Lock()
+
+    def tile_bounds(self, row: int, column: int) -> Tuple[int, int, int, int]:
+        """Get the (x, y, width, height) region covered by a tile."""
+        x0, y0 = column * self.tile_size, row * self.tile_size
+        return x0, y0, min(self.tile_size, self.canvas.width - x0), min(self.tile_size, self.canvas.height - y0)
+
+    def tiles_in_region(self, x: int, y: int, width: int = 1, height: int = 1) -> Set[Tuple[int, int]]:
+        """Get the (row, column) of the tiles overlapping a region."""
+        x0, y0 = max(x, 0), max(y, 0)
+        x1, y1 = min(x + width, self.canvas.width), min(y + height, self.canvas.height)
+        if x0 >= x1 or y0 >= y1:
+            return set()
+        return {
+            (row, column)
+            for row in range(y0 // self.tile_size, (y1 - 1) // self.tile_size + 1)
+            for column in range(x0 // self.tile_size, (x1 - 1) // self.tile_size + 1)
+        }
+
+    def mark_dirty(self, x: int, y: int, width: int = 1, height: int = 1):
+        """Mark the tiles overlapping a region as changed."""
+        if self._hashes is None:
+            return
+        self._dirty |= self.tiles_in_region(x, y, width, height)
+
+    async def _rebuild(self, canvas_store: CanvasStore):
+        # 先建立数组再读取，读取期间的更新仍会被标记为脏块
+        self._hashes = np.zeros((self.tile_rows, self.tile_columns), dtype=np.uint32)
+        self._dirty.clear()
+        loop = asyncio.get_event_loop()
+        for row in range(self.tile_rows):
+            _, y0, _, height = self.tile_bounds(row, 0)
+            strip = await canvas_store.get_region(0, y0, self.canvas.width, height)
+            self._hashes[row] = (await loop.run_in_executor(None, tile_hashes, strip, self.tile_size))[0]
+
+    async def _refresh_dirty(self, canvas_store: CanvasStore):
+        dirty, self._dirty = self._dirty, set()
+        for row, column in sorted(dirty):
+            tile = await canvas_store.get_region(*self.tile_bounds(row, column))
+            self._hashes[row, column] = tile_hashes(tile, self.tile_size)[0, 0]
+
+    async def get_hashes(self) -> np.ndarray:
+        """Bring the tree up to date with the live canvas and get a copy of the tile hashes."""
+        async with self._lock:
+            if self._hashes is None or self._dirty:
+                start_time = time.time()
+                full = self._hashes is None
+                tiles = len(self._dirty)
+                async with get_redis_connection() as redis_conn:
+                    canvas_store = CanvasStore(redis_conn, self.canvas.id, canvas=self.canvas)
+                    if full:
+                        await self._rebuild(canvas_store)
+                    else:
+                        await self._refresh_dirty(canvas_store)
+                logger.debug(
+                    f"Refreshed hash tree of canvas {self.canvas.id} "
+                    f"({'full rebuild' if full else f'{tiles} tiles'}) in {time.time() - start_time:.2f} seconds"
+                )
+            return self._hashes.copy()
+
+    async def diff(self, root: Optional[str], hashes: Optional[List[int]]) -> Tuple[str, List[Tuple[int, int]]]:
+        """Compare a client's root or tile hashes with the live canvas.
+
+        Every tile differs when the root does not match and no tile hashes
+        are given, or when they are not one per tile.
+
+        Returns:
+            The live root, and the (row, column) of the tiles that differ
+        """
+        live = await self.get_hashes()
+        live_root = root_hash(live)
+        if root is not None and root.lower() == live_root:
+            return live_root, []
+        if hashes is None or len(hashes) != live.size:
+            return live_root, [(row, column) for row in range(self.tile_rows) for column in range(self.tile_columns)]
+        client = np.asarray(hashes, dtype=np.int64).reshape(live.shape)
+        rows, columns = np.nonzero(client != live)
+        return live_root, list(zip(rows.tolist(), columns.tolist()))
+
+
+_hash_trees: Dict[str, CanvasHashTree] = {}
+
+
+def get_hash_tree(canvas_id: str = DEFAULT_CANVAS_ID) -> CanvasHashTree:
+    """Get this worker's hash tree of a canvas, rebuilt after the canvas is expanded."""
+    tree = _hash_trees.get(canvas_id)
+    if tree is None or tree.canvas is not get_canvas_config(canvas_id):
+        tree = _hash_trees[canvas_id] = CanvasHashTree(canvas_id)
+    return tree
+
+
+def handle_hash_tree_message(canvas_id: str, message: str):
+    """Pub/sub listener marking the tiles touched by a canvas update as dirty."""
+    tree = _hash_trees.get(canvas_id)
+    if tree is None:
+        return
+    try:
+        for x, y, width, height in canvas_update_regions(message):
+            tree.mark_dirty(x, y, width, height)
+    except (ValueError, KeyError, TypeError) as e:
+        logger.warning(f"Ignoring malformed canvas update for the hash tree: {e}")
+
+
+async def verify_canvas(canvas_id: str = DEFAULT_CANVAS_ID) -> Dict:
+    """Check that the live canvas matches its latest snapshot plus the logs after it.
+
+    The roots are compared first, so a consistent canvas costs one
+    reconstruction and no tile comparison. Tiles touched by logs written
+    while the check runs are left out, since the live read may be ahead of
+    or behind the reconstruction there.
+
+    Returns:
+        The log ID checked against and the (row, column) of mismatched tiles
+    """
+    tree = get_hash_tree(canvas_id)
+    async with get_db_session() as db:
+        before = await get_max_log_id(db)
+    live = await tree.get_hashes()
+    async with get_db_session() as db:
+        log_id = await get_max_log_id(db)
+
+    async with get_read_db_session(min_log_id=log_id) as db:
+        historical = await get_history_service(canvas_id).reconstruct(db, log_id)
+    if historical.frame.shape[:2] != (tree.canvas.height, tree.canvas.width):
+        # 检查期间画布被扩展
+        return {"log_id": log_id, "mismatched_tiles": [], "skipped": True}
+    expected = await asyncio.get_event_loop().run_in_executor(None, tile_hashes, historical.frame, tree.tile_size)
+    if root_hash(expected) == root_hash(live):
+        return {"log_id": log_id, "mismatched_tiles": [], "skipped": False}
+
+    unsettled: Set[Tuple[int, int]] = set()
+    async with get_db_session() as db:
+        async for rows in iter_logs(db, before, None, canvas_id=canvas_id):
+            for row in rows:
+                unsettled |= tree.tiles_in_region(row.x, row.y)
+    rows, columns = np.nonzero(expected != live)
+    mismatched = [tile for tile in zip(rows.tolist(), columns.tolist()) if tile not in unsettled]
+    if mismatched:
+        logger.warning(
+            f"Canvas {canvas_id} differs from its snapshot and logs at log ID {log_id} "
+            f"in {len(mismatched)} tiles: {mismatched[:20]}"
+        )
+    return {"log_id": log_id, "mismatched_tiles": mismatched, "skipped": False}
+
+
+async def run_canvas_verification():
+    """Verify every canvas, once across all workers."""
+    async with job_lock("canvas_verify", max(CANVAS_VERIFY_INTERVAL, 60)) as acquired:
+        if not acquired:
+            return
+        for canvas in list_canvas_configs():
+            start_time = time.time()
+            result = await verify_canvas(canvas.id)
+            logger.info(
+                f"Verified canvas {canvas.id} at log ID {result['log_id']}: "
+                f"{len(result['mismatched_tiles'])} mismatched tiles in {time.time() - start_time:.2f} seconds"
+            )
+
+
+async def canvas_verify_loop():
+    """Background loop verifying the canvases every CANVAS_VERIFY_INTERVAL seconds."""
+    while True:
+        await asyncio.sleep(CANVAS_VERIFY_INTERVAL)
+        try:
+            await run_canvas_verification()
+        except Exception as e:
+            logger.error(f"Error verifying canvases: {str(e)}", exc_info=True)
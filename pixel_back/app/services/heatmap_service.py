@@ -0,0 +1,251 @@
+"""
+Live activity heatmap of the canvas.
+
+The canvas is split into HEATMAP_CELL_SIZE cells, each with a placement
+counter that decays exponentially with a half-life of HEATMAP_HALF_LIFE
+seconds. Each worker keeps the counters of every canvas in a NumPy array
+fed by the pub/sub stream. Decay is applied lazily: counters are stored
+relative to a reference time and each placement adds ``2 ** (age /
+half-life)`` instead of decaying the whole array, which is rescaled only
+when the weights grow large.
+
+Every worker receives every placement, so the workers' arrays are copies
+rather than shares. They are merged every HEATMAP_MERGE_INTERVAL seconds
+through a shared copy in Redis by taking the maximum of each cell, so a
+worker that has just started, or that missed messages while its
+subscription reconnected, catches up without counting placements twice.
+The array is also written next to the canvas's snapshots whenever a
+snapshot is taken, and loaded from there when Redis has no copy. Only the
+latest copy is kept, in one ``heatmap.npz`` per canvas: the counters decay,
+so those of an older snapshot have no use once a newer one is written.
+
+Pixel updates and batches are counted from the pub/sub stream. Moderation
+rewrites, broadcast as one region image, are not player activity and are
+left out.
+"""
+
+import asyncio
+import json
+import os
+import time
+from io import BytesIO
+from typing import Dict, Iterable, Optional, Tuple
+
+import numpy as np
+
+from app.canvas_registry import DEFAULT_CANVAS_ID, CanvasConfig, get_canvas_config, list_canvas_configs
+from app.config import HEATMAP_CELL_SIZE, HEATMAP_HALF_LIFE, HEATMAP_MERGE_INTERVAL
+from app.deps import get_binary_redis_connection
+from app.services.snapshot_store import get_snapshot_store
+from app.utils.logger import logger
+
+HEATMAP_FILENAME = "heatmap.npz"
+# 增量权重超过该值时把计数衰减到当前时间，避免 float32 溢出与精度损失
+MAX_WEIGHT = 1024.0
+
+
+def heatmap_key(canvas_id: str) -> str:
+    return f"heatmap:{canvas_id}"
+
+
+def encode_heatmap(counts: np.ndarray, at: float, cell_size: int) -> bytes:
+    """Serialize counters decayed to ``at`` (blocking, compresses)."""
+    buffer = BytesIO()
+    np.savez_compressed(buffer, counts=counts, time=np.float64(at), cell_size=np.int64(cell_size))
+    return buffer.getvalue()
+
+
+def decode_heatmap(content: bytes) -> Tuple[np.ndarray, float, int]:
+    """Deserialize counters as (counts, time, cell_size) (blocking, decompresses)."""
+    with np.load(BytesIO(content), allow_pickle=False) as data:
+        return data["counts"].astype(np.float32), float(data["time"]), int(data["cell_size"])
+
+
+class CanvasHeatmap:
+    """Exponentially decaying placement counters of one canvas."""
+
+    def __init__(self, canvas_id: str = DEFAULT_CANVAS_ID, cell_size: int = HEATMAP_CELL_SIZE,
+                 half_life: float = HEATMAP_HALF_LIFE):
+        self.canvas = get_canvas_config(canvas_id)
+        self.cell_size = cell_size
+        self.half_life = half_life
+        self.columns = -(-self.canvas.width // cell_size)
+        self.rows = -(-self.canvas.height // cell_size)
+        # 计数以 reference_time 为基准，t 时刻的值为 counts * 2 ** (-(t - reference_time) / half_life)
+        self._counts = np.zeros((self.rows, self.columns), dtype=np.float32)
+        self._reference_time = time.time()
+
+    def _decay_factor(self, at: float) -> float:
+        return 2.0 ** (-(at - self._reference_time) / self.half_life)
+
+    def _rebase(self, at: float):
+        self._counts *= self._decay_factor(at)
+        self._reference_time = at
+
+    def add(self, xs: Iterable[int], ys: Iterable[int], at: Optional[float] = None):
+        """Count placements at the given pixels; pixels outside the canvas are ignored."""
+        at = time.time() if at is None else at
+        weight = 1.0 / self._decay_factor(at)
+        if weight > MAX_WEIGHT:
+            self._rebase(at)
+            weight = 1.0
+        xs = np.asarray(xs, dtype=np.int64)
+        ys = np.asarray(ys, dtype=np.int64)
+        inside = (xs >= 0) & (xs < self.canvas.width) & (ys >= 0) & (ys < self.canvas.height)
+        np.add.at(self._counts, (ys[inside] // self.cell_size, xs[inside] // self.cell_size), weight)
+
+    def values(self, at: Optional[float] = None) -> np.ndarray:
+        """Get a copy of the decayed counters at a time (now by default)."""
+        at = time.time() if at is None else at
+        return self._counts * np.float32(self._decay_factor(at))
+
+    def merge(self, counts: np.ndarray, at: float):
+        """Take the maximum of each cell with counters decayed to ``at``; extra cells are ignored."""
+        self._rebase(at)
+        rows, columns = min(self.rows, counts.shape[0]), min(self.columns, counts.shape[1])
+        np.maximum(self._counts[:rows, :columns], counts[:rows, :columns], out=self._counts[:rows, :columns])
+
+    def resized(self, canvas: CanvasConfig) -> "CanvasHeatmap":
+        """Get a heatmap of an expanded canvas carrying over these counters."""
+        heatmap = CanvasHeatmap(canvas.id, self.cell_size, self.half_life)
+        now = time.time()
+        heatmap.merge(self.values(now), now)
+        return heatmap
+
+    async def to_bytes(self) -> bytes:
+        """Serialize the counters decayed to now, compressing in a thread."""
+        now = time.time()
+        counts = self.values(now)
+        return await asyncio.get_event_loop().run_in_executor(None, encode_heatmap, counts, now, self.cell_size)
+
+    async def load_bytes(self, content: bytes) -> bool:
+        """Merge serialized counters into this heatmap, decompressing in a thread.
+
+        Returns:
+            False if they were recorded with another cell size and were ignored
+        """
+        counts, at, cell_size = await asyncio.get_event_loop().run_in_executor(None, decode_heatmap, content)
+        if cell_size != self.cell_size:
+            return False
+        # 先衰减到当前时间再合并
+        now = time.time()
+        counts *= np.float32(2.0 ** (-(now - at) / self.half_life))
+        self.merge(counts, now)
+        return True
+
+
+_heatmaps: Dict[str, CanvasHeatmap] = {}
+
+
+def get_heatmap(canvas_id: str = DEFAULT_CANVAS_ID) -> CanvasHeatmap:
+    """Get this worker's heatmap of a canvas, carried over to the new size after the canvas is expanded."""
+    canvas = get_canvas_config(canvas_id)
+    heatmap = _heatmaps.get(canvas_id)
+    if heatmap is None:
+        heatmap = _heatmaps[canvas_id] = CanvasHeatmap(canvas_id)
+    elif heatmap.canvas is not canvas:
+        heatmap = _heatmaps[canvas_id] = heatmap.resized(canvas)
+    return heatmap
+
+
+def handle_heatmap_message(canvas_id: str, message: str):
+    """Pub/sub listener counting the placements of a canvas update."""
+    if '"pixel_' not in message:
+        return
+    try:
+        payload = json.loads(message)
+        data = payload.get("data") or {}
+        if payload.get("type") == "pixel_update":
+            get_heatmap(canvas_id).add([int(data["x"])], [int(data["y"])])
+        elif payload.get("type") == "pixel_batch":
+            pixels = data["pixels"]
+            get_heatmap(canvas_id).add([int(p["x"]) for p in pixels], [int(p["y"]) for p in pixels])
+    except (ValueError, KeyError, TypeError) as e:
+        logger.warning(f"Ignoring malformed canvas update for the heatmap: {e}")
+
+
+def _snapshot_path(canvas_id: str) -> str:
+    store = get_snapshot_store(canvas_id)
+    return store.path(os.path.join(store.prefix, HEATMAP_FILENAME))
+
+
+def _write_file(full_path: str, content: bytes):
+    os.makedirs(os.path.dirname(full_path), exist_ok=True)
+    temp_path = f"{full_path}.{os.getpid()}.tmp"
+    with open(temp_path, 'wb') as f:
+        f.write(content)
+    os.replace(temp_path, full_path)
+
+
+async def save_heatmap_snapshot(canvas_id: str = DEFAULT_CANVAS_ID):
+    """Write the heatmap next to the canvas's snapshots, replacing the previous one."""
+    content = await get_heatmap(canvas_id).to_bytes()
+    await asyncio.get_event_loop().run_in_executor(None, _write_file, _snapshot_path(canvas_id), content)
+
+
+async def merge_heatmap(canvas_id: str = DEFAULT_CANVAS_ID):
+    """Merge this worker's heatmap with the shared copy in Redis and write the result back.
+
+    Concurrent merges may overwrite each other's result; the next round puts
+    any lost maximum back.
+    """
+    async with get_binary_redis_connection() as redis_conn:
+        shared = await redis_conn.get(heatmap_key(canvas_id))
+        # 每次等待后重新获取，期间画布可能被扩展
+        if shared is not None:
+            await get_heatmap(canvas_id).load_bytes(shared)
+        await redis_conn.set(heatmap_key(canvas_id), await get_heatmap(canvas_id).to_bytes())
+
+
+async def load_heatmaps():
+    """Load every canvas's heatmap from Redis, or from its snapshot directory; call at startup."""
+    for canvas in list_canvas_configs():
+        heatmap = get_heatmap(canvas.id)
+        async with get_binary_redis_connection() as redis_conn:
+            content = await redis_conn.get(heatmap_key(canvas.id))
+        source = "Redis"
+        if content is None and os.path.exists(_snapshot_path(canvas.id)):
+            with open(_snapshot_path(canvas.id), 'rb') as f:
+                content = f.read()
+            source = "snapshot directory"
+        if content is None:
+            continue
+        try:
+            if await heatmap.load_bytes(content):
+                logger.info(f"Loaded heatmap of canvas {canvas.id} from {source}")
+            else:
+                logger.info(f"Ignoring heatmap of canvas {canvas.id} with another cell size")
+        except (ValueError, KeyError, OSError) as e:
+            logger.warning(f"Ignoring unreadable heatmap of canvas {canvas.id}: {e}")
+
+
+async def heatmap_merge_loop():
+    """Background loop merging the heatmaps across workers every HEATMAP_MERGE_INTERVAL seconds."""
+    while True:
+        await asyncio.sleep(HEATMAP_MERGE_INTERVAL)
+        for canvas in list_canvas_configs():
+            try:
+                await merge_heatmap(canvas.id)
+            except Exception as e:
+                logger.error(f"Error merging heatmap of canvas {canvas.id}: {str(e)}", exc_info=True)
+
+
+def downsample_heatmap(counts: np.ndarray, scale: int) -> np.ndarray:
+    """Sum the counters in scale x scale blocks, padding the last row/column of blocks with zeros."""
+    if scale <= 1:
+        return counts
+    rows, columns = counts.shape
+    padded = np.pad(counts, ((0, -rows % scale), (0, -columns % scale)))
+    return padded.reshape(padded.shape[0] // scale, scale, padded.shape[1] // scale, scale).sum(axis=(1, 3))
+
+
+def heatmap_to_rgb(counts: np.ndarray) -> Tuple[np.ndarray, float]:
+    """Color counters on a black-red-yellow-white scale, logarithmic up to the maximum.
+
+    Returns:
+        The (rows, columns, 3) RGB image and the maximum counter
+    """
+    peak = float(counts.max()) if counts.size else 0.0
+    level = np.log1p(counts) / np.log1p(peak) if peak > 0 else np.zeros_like(counts)
+    rgb = np.stack([level * 3, level * 3 - 1, level * 3 - 2], axis=-1)
+    return (np.clip(rgb, 0, 1) * 255 + 0.5).astype(np.uint8), peak
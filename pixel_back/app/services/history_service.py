@@ -0,0 +1,312 @@
+"""
+Historical canvas reconstruction.
+
+The board at any past log ID is rebuilt from the nearest earlier snapshot
+(the keyframe) plus the pixel logs recorded after it. Keyframes are looked up
+through an in-memory index sorted by ``last_log_id`` and recently rebuilt
+frames are kept in a small LRU cache, which also serves as a closer starting
+point than the snapshot when one is available. Each canvas has its own
+service, since log IDs are shared by all canvases but frames are not. The
+starting frame is fitted to the canvas size at the target log ID, so a board
+rebuilt across an expansion has the size it had at that point.
+"""
+
+import asyncio
+import bisect
+import time
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+from dataclasses import dataclass
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app.canvas_registry import DEFAULT_CANVAS_ID, canvas_geometry_at, canvas_geometry_of_version
+from app.config import (
+    HISTORY_CACHE_SIZE,
+    HISTORY_LOG_CHUNK_SIZE,
+    KEYFRAME_INDEX_TTL,
+)
+from app.db.crud import list_snapshots
+from app.db.models import CanvasSnapshot
+from app.services.log_archive import get_max_log_id, iter_logs
+from app.services.snapshot_store import snapshot_store
+from app.utils.logger import logger
+from app.utils.utils import apply_pixel_updates, fit_frame, hex_colors_to_rgb
+
+
+@dataclass
+class HistoricalFrame:
+    """A reconstructed canvas frame.
+
+    ``frame`` is a read-only (height, width, 3) RGB array; copy it before
+    modifying.
+    """
+    log_id: int
+    frame: np.ndarray
+    keyframe_snapshot_id: Optional[int]
+    replayed_logs: int
+
+
+def blank_frame(width: int, height: int) -> np.ndarray:
+    """Create an empty (all white) canvas frame."""
+    return np.full((height, width, 3), 255, dtype=np.uint8)
+
+
+def load_snapshot_frame(snapshot: CanvasSnapshot) -> np.ndarray:
+    """Load a snapshot file as a (height, width, 3) RGB array.
+
+    Raises:
+        FileNotFoundError: If the snapshot file no longer exists
+    """
+    return snapshot_store.load_frame(snapshot.data_file_path, snapshot_size(snapshot))
+
+
+def snapshot_size(snapshot: CanvasSnapshot) -> Optional[Tuple[int, int]]:
+    """Get the (width, height) of a snapshot's geometry version, or None if this worker does not know it."""
+    try:
+        return canvas_geometry_of_version(snapshot.canvas_id, snapshot.geometry_version)
+    except KeyError:
+        return None
+
+
+def rows_to_updates(rows) -> Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+    """Convert pixel log rows into coordinate and color arrays for vectorized application.
+
+    Rows carrying a malformed color are dropped; the returned ``kept`` array
+    holds the positions (within ``rows``) of the rows that were converted.
+    """
+    kept = np.arange(len(rows))
+    xs = np.fromiter((row.x for row in rows), dtype=np.int64, count=len(rows))
+    ys = np.fromiter((row.y for row in rows), dtype=np.int64, count=len(rows))
+    colors = [row.color or "" for row in rows]
+    try:
+        rgb = hex_colors_to_rgb(colors)
+    except ValueError:
+        valid = np.zeros(len(rows), dtype=bool)
+        parsed = []
+        for i, color in enumerate(colors):
+            try:
+                parsed.append(hex_colors_to_rgb([color])[0])
+                valid[i] = True
+            except ValueError:
+                continue
+        xs, ys, kept = xs[valid], ys[valid], kept[valid]
+        rgb = np.array(parsed, dtype=np.uint8).reshape(-1, 3)
+    return xs, ys, rgb, kept
+
+
+async def replay_logs(
+    db: AsyncSession,
+    frame: np.ndarray,
+    after_id: int,
+    up_to_id: Optional[int],
+    chunk_size: int = HISTORY_LOG_CHUNK_SIZE,
+    canvas_id: str = DEFAULT_CANVAS_ID,
+) -> int:
+    """Apply the pixel logs of a canvas in (after_id, up_to_id] to ``frame`` in place.
+
+    Returns:
+        The number of log rows replayed
+    """
+    replayed = 0
+    async for rows in iter_logs(db, after_id, up_to_id, chunk_size, canvas_id=canvas_id):
+        xs, ys, rgb, _ = rows_to_updates(rows)
+        apply_pixel_updates(frame, xs, ys, rgb)
+        replayed += len(rows)
+    return replayed
+
+
+class KeyframeIndex:
+    """Snapshots sorted by ``last_log_id`` for nearest-earlier lookups."""
+
+    def __init__(self, ttl: int = KEYFRAME_INDEX_TTL):
+        self.ttl = ttl
+        self._log_ids: List[int] = []
+        self._snapshots: List[CanvasSnapshot] = []
+        self._loaded_at: Optional[float] = None
+
+    def is_stale(self) -> bool:
+        return self._loaded_at is None or time.monotonic() - self._loaded_at > self.ttl
+
+    def load(self, snapshots: List[CanvasSnapshot]):
+        """Replace the index contents with the given snapshots."""
+        ordered = sorted(
+            (s for s in snapshots if s.last_log_id is not None),
+            key=lambda s: (s.last_log_id, s.id),
+        )
+        self._snapshots = ordered
+        self._log_ids = [s.last_log_id for s in ordered]
+        self._loaded_at = time.monotonic()
+
+    def invalidate(self):
+        self._loaded_at = None
+
+    def find(self, log_id: int, exclude: Optional[set] = None) -> Optional[CanvasSnapshot]:
+        """Find the latest snapshot whose ``last_log_id`` is <= log_id.
+
+        Snapshots whose IDs are in ``exclude`` are skipped.
+        """
+        position = bisect.bisect_right(self._log_ids, log_id)
+        while position:
+            snapshot = self._snapshots[position - 1]
+            if not exclude or snapshot.id not in exclude:
+                return snapshot
+            position -= 1
+        return None
+
+
+class FrameCache:
+    """LRU cache of reconstructed frames keyed by log ID."""
+
+    def __init__(self, max_size: int = HISTORY_CACHE_SIZE):
+        self.max_size = max_size
+        self._frames: "OrderedDict[int, HistoricalFrame]" = OrderedDict()
+
+    def get(self, log_id: int) -> Optional[HistoricalFrame]:
+        frame = self._frames.get(log_id)
+        if frame is not None:
+            self._frames.move_to_end(log_id)
+        return frame
+
+    def put(self, frame: HistoricalFrame):
+        if self.max_size <= 0:
+            return
+        self._frames[frame.log_id] = frame
+        self._frames.move_to_end(frame.log_id)
+        while len(self._frames) > self.max_size:
+            self._frames.popitem(last=False)
+
+    def nearest_before(self, log_id: int) -> Optional[HistoricalFrame]:
+        """Get the cached frame with the largest log ID that is <= log_id."""
+        candidates = [key for key in self._frames if key <= log_id]
+        return self._frames[max(candidates)] if candidates else None
+
+    def clear(self):
+        self._frames.clear()
+
+
+class HistoryService:
+    """Rebuilds a canvas as it was at a given pixel log ID."""
+
+    def __init__(self, canvas_id: str = DEFAULT_CANVAS_ID):
+        self.canvas_id = canvas_id
+        self.keyframes = KeyframeIndex()
+        self.cache = FrameCache()
+        # 每个关键帧一把锁：同一起点的请求串行以复用缓存，不同起点的重建可以并行
+        self._locks: Dict[Optional[int], asyncio.Lock] = {}
+        self._lock_users: Dict[Optional[int], int] = {}
+
+    @asynccontextmanager
+    async def _keyframe_lock(self, keyframe_id: Optional[int]):
+        lock = self._locks.setdefault(keyframe_id, asyncio.Lock())
+        self._lock_users[keyframe_id] = self._lock_users.get(keyframe_id, 0) + 1
+        try:
+            async with lock:
+                yield
+        finally:
+            self._lock_users[keyframe_id] -= 1
+            if not self._lock_users[keyframe_id]:
+                del self._lock_users[keyframe_id]
+                del self._locks[keyframe_id]
+
+    async def _refresh_keyframes(self, db: AsyncSession, force: bool = False):
+        if force or self.keyframes.is_stale():
+            self.keyframes.load(await list_snapshots(db, self.canvas_id))
+
+    async def reconstruct(self, db: AsyncSession, log_id: int) -> HistoricalFrame:
+        """Get the canvas frame after applying every log with ID <= log_id.
+
+        A log_id past the newest log is clamped to it, so the returned frame's
+        ``log_id`` may be smaller than requested.
+
+        Args:
+            db: Database session used to read snapshots and logs
+            log_id: Target pixel log ID
+
+        Returns:
+            The reconstructed frame
+        """
+        log_id = min(log_id, await get_max_log_id(db))
+        cached = self.cache.get(log_id)
+        if cached is not None:
+            return cached
+
+        # 同一关键帧上的重建串行化，避免多个请求重复回放同一段日志
+        await self._refresh_keyframes(db)
+        keyframe = self.keyframes.find(log_id)
+        async with self._keyframe_lock(keyframe.id if keyframe is not None else None):
+            cached = self.cache.get(log_id)
+            if cached is not None:
+                return cached
+
+            start_time = time.time()
+            frame, start_log_id, keyframe_id = await self._load_starting_point(db, log_id)
+            # 起点可能早于画布扩展，按目标日志时的尺寸补齐
+            frame = fit_frame(frame, *canvas_geometry_at(self.canvas_id, log_id))
+            replayed = await replay_logs(db, frame, start_log_id, log_id, canvas_id=self.canvas_id)
+
+            frame.setflags(write=False)
+            result = HistoricalFrame(
+                log_id=log_id,
+                frame=frame,
+                keyframe_snapshot_id=keyframe_id,
+                replayed_logs=replayed,
+            )
+            self.cache.put(result)
+            logger.info(
+                f"Reconstructed canvas {self.canvas_id} at log ID {log_id} from log ID {start_log_id} "
+                f"({replayed} logs replayed) in {time.time() - start_time:.2f} seconds"
+            )
+            return result
+
+    async def _load_starting_point(
+        self, db: AsyncSession, log_id: int
+    ) -> Tuple[np.ndarray, int, Optional[int]]:
+        """Pick the closest known state at or before log_id and return a writable copy of it."""
+        keyframe = self.keyframes.find(log_id)
+        cached = self.cache.nearest_before(log_id)
+        if cached is not None and (keyframe is None or cached.log_id >= keyframe.last_log_id):
+            return cached.frame.copy(), cached.log_id, cached.keyframe_snapshot_id
+
+        missing = set()
+        while keyframe is not None:
+            loop = asyncio.get_event_loop()
+            try:
+                frame = await loop.run_in_executor(None, load_snapshot_frame, keyframe)
+                return frame, keyframe.last_log_id, keyframe.id
+            except FileNotFoundError as e:
+                # 快照文件已被删除，重新加载索引后退回到更早的关键帧
+                logger.warning(f"Keyframe snapshot file missing: {e}")
+                missing.add(keyframe.id)
+                await self._refresh_keyframes(db, force=True)
+                keyframe = self.keyframes.find(log_id, exclude=missing)
+
+        return blank_frame(*canvas_geometry_at(self.canvas_id, log_id)), 0, None
+
+    def invalidate(self):
+        """Drop the keyframe index and cached frames, e.g. after snapshots were deleted."""
+        self.keyframes.invalidate()
+        self.cache.clear()
+
+
+_history_services: Dict[str, HistoryService] = {}
+
+
+def get_history_service(canvas_id: str = DEFAULT_CANVAS_ID) -> HistoryService:
+    """Get the shared history service of a canvas."""
+    service = _history_services.get(canvas_id)
+    if service is None:
+        service = _history_services[canvas_id] = HistoryService(canvas_id)
+    return service
+
+
+def invalidate_history():
+    """Invalidate the history services of every canvas."""
+    for service in _history_services.values():
+        service.invalidate()
+
+
+# Shared instance for the default canvas
+history_service = get_history_service(DEFAULT_CANVAS_ID)
@@ -0,0 +1,191 @@
+"""
+"Who placed this pixel" lookups backed by the last-writer index.
+
+Placements record their log ID in ``LastWriterIndex`` as they happen, so a
+lookup is one BITFIELD read plus a primary key fetch of the log row. When the
+index is missing (a fresh Redis, or a canvas that predates the index) it is
+rebuilt in the background by streaming the canvas's logs, one pass per
+band of shard rows so that memory stays bounded on large canvases; until
+then single-pixel lookups fall back to the (canvas_id, x, y, id) index of
+pixel_logs.
+
+The log rows are read from the replica only once it has applied the log IDs
+found in the index, and fallbacks query the primary, so a lagging replica
+never names an earlier writer.
+"""
+
+import asyncio
+import time
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+
+from app.canvas_registry import DEFAULT_CANVAS_ID, get_canvas_config, list_canvas_configs
+from app.config import HISTORY_LOG_CHUNK_SIZE
+from app.db.crud import get_last_pixel_log_at
+from app.deps import (
+    get_binary_redis_connection,
+    get_db_session,
+    get_read_db_session,
+    get_redis_connection,
+    job_lock,
+)
+from app.redis_store.canvas import CanvasStore
+from app.redis_store.last_writer import LastWriterIndex
+from app.services.log_archive import get_logs_by_ids, get_max_log_id, iter_logs_paged
+from app.utils.logger import logger
+from app.utils.utils import rgb_to_hex_colors
+
+# 重建索引时每遍扫描日志所覆盖的像素数上限（至少一行分片）
+REBUILD_BAND_PIXELS = 1 << 24
+
+
+async def record_last_writer(canvas_id: str, x: int, y: int, log_id: int):
+    """Record a placement in the last-writer index."""
+    async with get_binary_redis_connection() as redis_conn:
+        await LastWriterIndex(redis_conn, canvas_id).set(x, y, log_id)
+
+
+async def record_last_writers(canvas_id: str, xs: List[int], ys: List[int], log_ids: List[int]):
+    """Record many placements in the last-writer index."""
+    async with get_binary_redis_connection() as redis_conn:
+        await LastWriterIndex(redis_conn, canvas_id).set_many(xs, ys, log_ids)
+
+
+def _log_to_dict(log) -> Dict:
+    return {
+        "user_id": log.user_id,
+        "color": log.color,
+        "created_at": log.created_at,
+    }
+
+
+async def get_pixel_info(x: int, y: int, canvas_id: str = DEFAULT_CANVAS_ID) -> Dict:
+    """Get the current color of a pixel and the log that last wrote it.
+
+    Raises:
+        ValueError: If the coordinates are out of bounds
+    """
+    async with get_redis_connection() as redis_conn:
+        color = await CanvasStore(redis_conn, canvas_id).get_pixel(x, y)
+    async with get_binary_redis_connection() as redis_conn:
+        log_id = await LastWriterIndex(redis_conn, canvas_id).get(x, y)
+
+    log = None
+    if log_id:
+        async with get_read_db_session(min_log_id=log_id) as db:
+            log = (await get_logs_by_ids(db, [log_id])).get(log_id)
+    if log is None:
+        # 索引尚未建立或记录尚未提交，退回到主库查询；副本可能只有更早的记录
+        async with get_db_session() as db:
+            log = await get_last_pixel_log_at(db, x, y, canvas_id)
+
+    return {
+        "x": x,
+        "y": y,
+        "color": color,
+        "log_id": log.id if log is not None else None,
+        "user_id": log.user_id if log is not None else None,
+        "created_at": log.created_at if log is not None else None,
+    }
+
+
+async def get_region_info(x: int, y: int, width: int, height: int, canvas_id: str = DEFAULT_CANVAS_ID) -> Dict:
+    """Get the colors and last writers of a rectangular region.
+
+    Pixels the index has no entry for have a log ID of 0 and are not looked
+    up in pixel_logs.
+
+    Returns:
+        Row-major ``colors`` and ``log_ids`` lists, and the referenced logs
+        keyed by ID
+
+    Raises:
+        ValueError: If the region is out of bounds
+    """
+    async with get_redis_connection() as redis_conn:
+        frame = await CanvasStore(redis_conn, canvas_id).get_region(x, y, width, height)
+    async with get_binary_redis_connection() as redis_conn:
+        log_ids = await LastWriterIndex(redis_conn, canvas_id).get_region(x, y, width, height)
+
+    unique_ids = np.unique(log_ids)
+    unique_ids = unique_ids[unique_ids > 0].tolist()
+    logs = {}
+    if unique_ids:
+        async with get_read_db_session(min_log_id=unique_ids[-1]) as db:
+            logs = await get_logs_by_ids(db, unique_ids)
+    return {
+        "x": x,
+        "y": y,
+        "width": width,
+        "height": height,
+        "colors": rgb_to_hex_colors(frame),
+        "log_ids": log_ids.ravel().tolist(),
+        "logs": {log_id: _log_to_dict(log) for log_id, log in logs.items()},
+    }
+
+
+def _rebuild_bands(canvas) -> List[Tuple[int, int]]:
+    """Split a canvas into (y, height) bands of whole shard rows of at most REBUILD_BAND_PIXELS pixels."""
+    shard_height = canvas.shard_size if canvas.sharded else canvas.height
+    rows_per_band = max(1, REBUILD_BAND_PIXELS // (canvas.width * shard_height)) * shard_height
+    return [(y, min(rows_per_band, canvas.height - y)) for y in range(0, canvas.height, rows_per_band)]
+
+
+async def rebuild_last_writer_index(canvas_id: str = DEFAULT_CANVAS_ID) -> Optional[int]:
+    """Rebuild a canvas's last-writer index from its logs, once across all workers.
+
+    Entries written by placements during the rebuild are kept, since the
+    result is merged with the larger log ID winning.
+
+    Returns:
+        The number of logs scanned, or None if another worker is rebuilding
+    """
+    canvas = get_canvas_config(canvas_id)
+    async with job_lock(f"last_writer_index:{canvas_id}", 3600) as acquired:
+        if not acquired:
+            return None
+        start_time = time.time()
+        scanned = 0
+        async with get_db_session() as db:
+            up_to_id = await get_max_log_id(db)
+        for y0, height in _rebuild_bands(canvas):
+            log_ids = np.zeros(canvas.width * height, dtype=np.int64)
+            async for rows in iter_logs_paged(0, up_to_id, HISTORY_LOG_CHUNK_SIZE, canvas_id=canvas_id):
+                ids = np.fromiter((row.id for row in rows), dtype=np.int64, count=len(rows))
+                xs = np.fromiter((row.x for row in rows), dtype=np.int64, count=len(rows))
+                ys = np.fromiter((row.y for row in rows), dtype=np.int64, count=len(rows))
+                inside = (xs >= 0) & (xs < canvas.width) & (ys >= y0) & (ys < y0 + height)
+                # 日志按ID升序返回，同一像素取最大的ID即为最后写入者
+                np.maximum.at(log_ids, (ys[inside] - y0) * canvas.width + xs[inside], ids[inside])
+                if y0 == 0:
+                    scanned += len(rows)
+
+            async with get_binary_redis_connection() as redis_conn:
+                await LastWriterIndex(redis_conn, canvas_id, canvas=canvas).merge_rows(
+                    y0, log_ids.reshape(height, canvas.width)
+                )
+        async with get_binary_redis_connection() as redis_conn:
+            await LastWriterIndex(redis_conn, canvas_id, canvas=canvas).delete_legacy()
+        logger.info(
+            f"Rebuilt last-writer index of canvas {canvas_id} from {scanned} logs "
+            f"in {time.time() - start_time:.2f} seconds"
+        )
+        return scanned
+
+
+async def ensure_last_writer_indexes():
+    """Start rebuilding the last-writer index of every canvas that does not have one."""
+    for canvas in list_canvas_configs():
+        async with get_binary_redis_connection() as redis_conn:
+            exists = await LastWriterIndex(redis_conn, canvas.id).exists()
+        if not exists:
+            logger.info(f"Last-writer index of canvas {canvas.id} is missing, rebuilding it")
+            asyncio.create_task(_rebuild_in_background(canvas.id))
+
+
+async def _rebuild_in_background(canvas_id: str):
+    try:
+        await rebuild_last_writer_index(canvas_id)
+    except Exception as e:
+        logger.error(f"Error rebuilding last-writer index of canvas {canvas_id}: {str(e)}", exc_info=True)
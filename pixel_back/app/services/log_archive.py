@@ -0,0 +1,430 @@
+"""
+Pixel log archival and a reader over hot and archived logs.
+
+Logs that are older than the oldest retained snapshot are no longer needed
+to rebuild the live canvas. The archival job compacts them into compressed
+columnar segment files (one NumPy array per column in an ``.npz``) named
+after the ID range they cover, and then removes them from pixel_logs, by
+dropping whole partitions when the table is partitioned.
+
+History, timelapse and the other log consumers read through ``iter_logs``,
+which serves IDs up to the end of the archive from the segment files and
+everything after that from the database.
+"""
+
+import asyncio
+import bisect
+import os
+import re
+import time
+from collections import namedtuple
+from datetime import datetime
+from typing import AsyncIterator, Dict, Iterable, List, Optional
+
+import numpy as np
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app.canvas_registry import DEFAULT_CANVAS_ID, list_canvas_configs
+from app.config import LOG_ARCHIVE_DIRECTORY, LOG_ARCHIVE_SEGMENT_SIZE, LOG_ARCHIVE_INTERVAL
+from app.db.crud import (
+    delete_pixel_logs_in_range,
+    get_last_pixel_log_id_before,
+    get_max_pixel_log_id,
+    get_oldest_snapshot,
+    get_pixel_logs_by_ids,
+    get_pixel_logs_chunk,
+    iter_pixel_logs,
+)
+from app.db.partitions import (
+    drop_pixel_log_partitions_up_to,
+    ensure_pixel_log_partitions,
+    partitioning_enabled,
+)
+from app.deps import get_autocommit_connection, get_db_session, get_read_db_session, job_lock
+from app.utils.logger import logger
+from app.utils.utils import hex_colors_to_rgb
+
+ArchivedPixelLog = namedtuple(
+    "ArchivedPixelLog", ["id", "x", "y", "color", "user_id", "created_at", "canvas_id"]
+)
+
+SEGMENT_NAME_PATTERN = re.compile(r"^pixel_logs_(\d+)_(\d+)\.npz$")
+# 无法解析的颜色在归档中以该值表示，读取时还原为空字符串
+INVALID_COLOR = np.uint32(0xFFFFFFFF)
+
+
+def _segment_name(first_id: int, last_id: int) -> str:
+    return f"pixel_logs_{first_id:015d}_{last_id:015d}.npz"
+
+
+class ArchiveSegment:
+    """An archived ID range [first_id, last_id] stored in one file."""
+
+    def __init__(self, first_id: int, last_id: int, path: str):
+        self.first_id = first_id
+        self.last_id = last_id
+        self.path = path
+
+    def load(self) -> dict:
+        with np.load(self.path, allow_pickle=False) as data:
+            return {name: data[name] for name in data.files}
+
+
+class ArchiveManifest:
+    """Sorted list of archive segments, read from the archive directory."""
+
+    def __init__(self, directory: str = LOG_ARCHIVE_DIRECTORY):
+        self.directory = directory
+        self.segments: List[ArchiveSegment] = []
+        self._last_ids: List[int] = []
+        self._mtime: Optional[float] = None
+
+    def refresh(self):
+        """Reload the segment list if the directory changed."""
+        if not os.path.isdir(self.directory):
+            self.segments, self._last_ids, self._mtime = [], [], None
+            return
+        mtime = os.stat(self.directory).st_mtime
+        if mtime == self._mtime:
+            return
+        segments = []
+        for name in os.listdir(self.directory):
+            match = SEGMENT_NAME_PATTERN.match(name)
+            if match:
+                segments.append(ArchiveSegment(
+                    int(match.group(1)), int(match.group(2)), os.path.join(self.directory, name)
+                ))
+        segments.sort(key=lambda segment: segment.first_id)
+        self.segments = segments
+        self._last_ids = [segment.last_id for segment in segments]
+        self._mtime = mtime
+
+    @property
+    def archived_up_to(self) -> int:
+        """The largest archived log ID, or 0."""
+        return self._last_ids[-1] if self._last_ids else 0
+
+    def segments_after(self, after_id: int) -> List[ArchiveSegment]:
+        """Get the segments that contain IDs greater than after_id."""
+        position = bisect.bisect_right(self._last_ids, after_id)
+        return self.segments[position:]
+
+
+manifest = ArchiveManifest()
+
+
+def _columns_to_rows(columns: dict, selection: np.ndarray) -> List[ArchivedPixelLog]:
+    ids = columns["id"][selection]
+    colors = columns["color"][selection]
+    hex_string = colors.astype(">u4").tobytes().hex().upper()
+    created_at = columns["created_at"][selection].astype("datetime64[us]").tolist()
+    canvas_ids = columns["canvas_id"][selection].tolist() if "canvas_id" in columns \
+        else [DEFAULT_CANVAS_ID] * len(ids)
+    return [
+        ArchivedPixelLog(
+            id=int(ids[i]),
+            x=int(x),
+            y=int(y),
+            color="" if colors[i] == INVALID_COLOR else f"#{hex_string[i * 8 + 2:i * 8 + 8]}",
+            user_id=user_id or None,
+            created_at=created_at[i],
+            canvas_id=canvas_ids[i],
+        )
+        for i, (x, y, user_id) in enumerate(zip(
+            columns["x"][selection].tolist(),
+            columns["y"][selection].tolist(),
+            columns["user_id"][selection].tolist(),
+        ))
+    ]
+
+
+async def _iter_archived_logs(
+    after_id: int,
+    up_to_id: Optional[int],
+    chunk_size: int,
+    canvas_id: Optional[str],
+) -> AsyncIterator[list]:
+    """Stream the archived logs with after_id < id <= up_to_id, chunk by chunk."""
+    loop = asyncio.get_event_loop()
+    for segment in manifest.segments_after(after_id):
+        if up_to_id is not None and segment.first_id > up_to_id:
+            return
+        columns = await loop.run_in_executor(None, segment.load)
+        mask = columns["id"] > after_id
+        if up_to_id is not None:
+            mask &= columns["id"] <= up_to_id
+        if canvas_id is not None:
+            if "canvas_id" in columns:
+                mask &= columns["canvas_id"] == canvas_id
+            elif canvas_id != DEFAULT_CANVAS_ID:
+                continue
+        positions = np.flatnonzero(mask)
+        for start in range(0, len(positions), chunk_size):
+            yield _columns_to_rows(columns, positions[start:start + chunk_size])
+
+
+async def iter_logs(
+    db: AsyncSession,
+    after_id: int,
+    up_to_id: Optional[int] = None,
+    chunk_size: int = 10000,
+    canvas_id: Optional[str] = DEFAULT_CANVAS_ID,
+) -> AsyncIterator[list]:
+    """Stream pixel logs with after_id < id <= up_to_id from the archive and the database.
+
+    Rows have the ``id``, ``x``, ``y``, ``color``, ``user_id``, ``created_at``
+    and ``canvas_id`` attributes whichever side they come from. Logs of every
+    canvas are returned when canvas_id is None.
+    """
+    manifest.refresh()
+    archived_up_to = manifest.archived_up_to
+    if after_id < archived_up_to:
+        async for rows in _iter_archived_logs(after_id, up_to_id, chunk_size, canvas_id):
+            yield rows
+        after_id = archived_up_to
+
+    if up_to_id is not None and after_id >= up_to_id:
+        return
+    async for rows in iter_pixel_logs(db, after_id, up_to_id, chunk_size, canvas_id=canvas_id):
+        yield rows
+
+
+async def iter_logs_paged(
+    after_id: int,
+    up_to_id: Optional[int] = None,
+    chunk_size: int = 10000,
+    canvas_id: Optional[str] = DEFAULT_CANVAS_ID,
+) -> AsyncIterator[list]:
+    """Stream pixel logs like ``iter_logs``, reading each chunk in its own short read transaction.
+
+    For long consumers such as exports, which would otherwise keep one
+    transaction, and the replica snapshot it pins, open for their whole run.
+    The read sessions must have applied ``up_to_id``.
+    """
+    manifest.refresh()
+    archived_up_to = manifest.archived_up_to
+    if after_id < archived_up_to:
+        async for rows in _iter_archived_logs(after_id, up_to_id, chunk_size, canvas_id):
+            yield rows
+        after_id = archived_up_to
+
+    while up_to_id is None or after_id < up_to_id:
+        async with get_read_db_session(min_log_id=up_to_id) as db:
+            rows = await get_pixel_logs_chunk(db, after_id, up_to_id, chunk_size, canvas_id)
+        if not rows:
+            return
+        yield rows
+        if len(rows) < chunk_size:
+            return
+        after_id = rows[-1].id
+
+
+async def get_logs_by_ids(db: AsyncSession, log_ids: Iterable[int]) -> Dict[int, object]:
+    """Get pixel logs by ID from the database or the archive, keyed by ID.
+
+    IDs that exist on neither side are left out.
+    """
+    wanted = sorted(set(int(log_id) for log_id in log_ids))
+    logs = {row.id: row for row in await get_pixel_logs_by_ids(db, wanted)}
+
+    manifest.refresh()
+    missing = np.array([log_id for log_id in wanted if log_id not in logs and log_id <= manifest.archived_up_to],
+                       dtype=np.int64)
+    if not len(missing):
+        return logs
+
+    loop = asyncio.get_event_loop()
+    for segment in manifest.segments_after(int(missing[0]) - 1):
+        in_segment = missing[(missing >= segment.first_id) & (missing <= segment.last_id)]
+        if not len(in_segment):
+            if segment.first_id > missing[-1]:
+                break
+            continue
+        columns = await loop.run_in_executor(None, segment.load)
+        # 归档段内的ID按升序存储
+        positions = np.searchsorted(columns["id"], in_segment)
+        positions = positions[positions < len(columns["id"])]
+        positions = positions[np.isin(columns["id"][positions], in_segment)]
+        for row in _columns_to_rows(columns, positions):
+            logs[row.id] = row
+    return logs
+
+
+async def get_max_log_id(db: AsyncSession) -> int:
+    """Get the largest pixel log ID, including archived logs."""
+    manifest.refresh()
+    return max(await get_max_pixel_log_id(db), manifest.archived_up_to)
+
+
+async def get_last_log_id_before(db: AsyncSession, timestamp: datetime) -> int:
+    """Get the ID of the last pixel log created at or before the given time, including archived logs."""
+    log_id = await get_last_pixel_log_id_before(db, timestamp)
+    manifest.refresh()
+    if log_id > manifest.archived_up_to:
+        return log_id
+
+    # 数据库中的结果落在归档范围内（或没有结果）时，归档中可能有更晚的日志：
+    # 其行可能已从热表删除。从最新的归档段开始向前查找
+    loop = asyncio.get_event_loop()
+    target = np.datetime64(timestamp, "us").astype(np.int64)
+    for segment in reversed(manifest.segments):
+        if segment.last_id <= log_id:
+            break
+        columns = await loop.run_in_executor(None, segment.load)
+        matches = columns["id"][columns["created_at"] <= target]
+        if len(matches):
+            return max(log_id, int(matches.max()))
+    return log_id
+
+
+def _write_segment(directory: str, ids, xs, ys, colors, user_ids, created_at, canvas_ids) -> str:
+    """Write one archive segment atomically and return its path."""
+    os.makedirs(directory, exist_ok=True)
+    path = os.path.join(directory, _segment_name(int(ids[0]), int(ids[-1])))
+    temp_path = f"{path}.tmp"
+    with open(temp_path, "wb") as f:
+        np.savez_compressed(
+            f,
+            id=np.asarray(ids, dtype=np.int64),
+            x=np.asarray(xs, dtype=np.int32),
+            y=np.asarray(ys, dtype=np.int32),
+            color=np.asarray(colors, dtype=np.uint32),
+            user_id=np.asarray(user_ids, dtype=np.str_),
+            created_at=np.asarray(created_at, dtype="datetime64[us]").astype(np.int64),
+            canvas_id=np.asarray(canvas_ids, dtype=np.str_),
+        )
+    os.replace(temp_path, path)
+    return path
+
+
+def _pack_colors(colors: List[str]) -> np.ndarray:
+    try:
+        rgb = hex_colors_to_rgb(colors).astype(np.uint32)
+        return (rgb[:, 0] << 16) | (rgb[:, 1] << 8) | rgb[:, 2]
+    except ValueError:
+        return np.array([_pack_colors([color])[0] if _is_hex_color(color) else INVALID_COLOR
+                         for color in colors], dtype=np.uint32)
+
+
+def _is_hex_color(color: str) -> bool:
+    try:
+        hex_colors_to_rgb([color])
+        return True
+    except ValueError:
+        return False
+
+
+async def get_archive_cutoff(db: AsyncSession) -> int:
+    """Get the log ID up to which every canvas's oldest retained snapshot includes the logs.
+
+    Canvases without a snapshot do not hold archival back: they are replayed
+    from the first log, which stays readable from the archive.
+    """
+    cutoffs = []
+    for canvas in list_canvas_configs():
+        oldest = await get_oldest_snapshot(db, canvas.id)
+        if oldest is not None and oldest.last_log_id:
+            cutoffs.append(oldest.last_log_id)
+    return min(cutoffs, default=0)
+
+
+async def archive_pixel_logs(db: AsyncSession, segment_size: int = LOG_ARCHIVE_SEGMENT_SIZE) -> int:
+    """Write the logs that the oldest retained snapshots already include to archive segments.
+
+    The logs stay in pixel_logs until ``remove_archived_pixel_logs``.
+
+    Returns:
+        The number of logs archived
+    """
+    cutoff = await get_archive_cutoff(db)
+    if not cutoff:
+        return 0
+
+    manifest.refresh()
+    archived_up_to = manifest.archived_up_to
+    if cutoff <= archived_up_to:
+        return 0
+
+    loop = asyncio.get_event_loop()
+    archived = 0
+    columns = ([], [], [], [], [], [], [])
+
+    async def flush():
+        nonlocal archived
+        if not columns[0]:
+            return
+        ids, xs, ys, colors, user_ids, created_at, canvas_ids = columns
+        path = await loop.run_in_executor(
+            None, _write_segment, manifest.directory,
+            ids, xs, ys, _pack_colors(colors), user_ids, created_at, canvas_ids,
+        )
+        archived += len(ids)
+        logger.info(f"Archived pixel logs {ids[0]}..{ids[-1]} to {path}")
+        for column in columns:
+            column.clear()
+
+    async for rows in iter_pixel_logs(db, archived_up_to, cutoff, min(segment_size, 50000), canvas_id=None):
+        for row in rows:
+            columns[0].append(row.id)
+            columns[1].append(row.x)
+            columns[2].append(row.y)
+            columns[3].append(row.color or "")
+            columns[4].append(row.user_id or "")
+            columns[5].append(row.created_at or datetime.utcfromtimestamp(0))
+            columns[6].append(row.canvas_id or DEFAULT_CANVAS_ID)
+        if len(columns[0]) >= segment_size:
+            await flush()
+    await flush()
+
+    return archived
+
+
+async def remove_archived_pixel_logs() -> int:
+    """Remove the logs that are in the archive from pixel_logs.
+
+    Runs after the archival transaction has committed: whole partitions are
+    detached and dropped outside any transaction block, then the remaining
+    rows are deleted in a transaction of their own.
+
+    Returns:
+        The number of rows deleted, not counting dropped partitions
+    """
+    manifest.refresh()
+    archived_up_to = manifest.archived_up_to
+    if not archived_up_to:
+        return 0
+    if partitioning_enabled():
+        async with get_autocommit_connection() as conn:
+            dropped = await drop_pixel_log_partitions_up_to(conn, archived_up_to)
+        if dropped:
+            logger.info(f"Dropped archived pixel_logs partitions: {dropped}")
+    async with get_db_session() as db:
+        deleted = await delete_pixel_logs_in_range(db, 0, archived_up_to)
+    if deleted:
+        logger.info(f"Removed {deleted} archived rows from pixel_logs up to log ID {archived_up_to}")
+    return deleted
+
+
+async def run_log_maintenance():
+    """Create upcoming partitions and archive old logs, once across all workers."""
+    async with job_lock("log_archive", max(LOG_ARCHIVE_INTERVAL, 600)) as acquired:
+        if not acquired:
+            return
+        start_time = time.time()
+        async with get_db_session() as db:
+            await ensure_pixel_log_partitions(db)
+        async with get_db_session() as db:
+            archived = await archive_pixel_logs(db)
+        # 归档事务提交后再从热表中删除
+        await remove_archived_pixel_logs()
+        logger.info(f"Log maintenance archived {archived} logs in {time.time() - start_time:.2f} seconds")
+
+
+async def log_maintenance_loop():
+    """Background loop running log maintenance every LOG_ARCHIVE_INTERVAL seconds."""
+    while True:
+        try:
+            await run_log_maintenance()
+        except Exception as e:
+            logger.error(f"Error during log maintenance: {str(e)}", exc_info=True)
+        await asyncio.sleep(LOG_ARCHIVE_INTERVAL)
@@ -0,0 +1,230 @@
+"""
+Multi-resolution overview pyramid of the canvas.
+
+Level ``n`` is the canvas downsampled by ``2**n`` with a 2x2 box filter,
+for n = 1..PYRAMID_LEVELS. Each worker keeps its own pyramid in memory:
+it is built from the frame whenever the worker takes a snapshot (or on
+first use), and kept current by marking the PYRAMID_TILE_SIZE tiles touched
+by pub/sub updates as dirty. Before a level is served, only the dirty tiles
+are read back from Redis and pushed up through the levels. Encoded PNGs are
+cached per level until the next change.
+
+A refresh reads everything it needs before touching the levels, then applies
+it without yielding to the event loop, so a level is never served half
+rebuilt. Readers wait for a refresh while any tile is dirty, and tiles
+marked during a refresh stay dirty for the next one.
+"""
+
+import asyncio
+import hashlib
+import time
+from typing import Dict, Optional, Set, Tuple
+
+import numpy as np
+
+from app.canvas_registry import DEFAULT_CANVAS_ID, get_canvas_config
+from app.config import PYRAMID_LEVELS, PYRAMID_TILE_SIZE
+from app.deps import get_redis_connection
+from app.redis_store.canvas import CanvasStore
+from app.utils.logger import logger
+from app.utils.utils import canvas_update_regions, rgb_array_to_png
+
+# 脏块超过该比例时直接整体重建
+FULL_REBUILD_RATIO = 0.5
+
+
+def downsample(frame: np.ndarray) -> np.ndarray:
+    """Halve a (height, width, 3) frame with a 2x2 box filter, repeating the last row/column when odd."""
+    height, width = frame.shape[:2]
+    if height % 2 or width % 2:
+        frame = np.pad(frame, ((0, height % 2), (0, width % 2), (0, 0)), mode="edge")
+    blocks = frame.reshape(frame.shape[0] // 2, 2, frame.shape[1] // 2, 2, 3).astype(np.uint16)
+    return ((blocks.sum(axis=(1, 3)) + 2) // 4).astype(np.uint8)
+
+
+class CanvasPyramid:
+    """Downsampled levels of one canvas with dirty tile tracking."""
+
+    def __init__(self, canvas_id: str = DEFAULT_CANVAS_ID, levels: int = PYRAMID_LEVELS,
+                 tile_size: int = PYRAMID_TILE_SIZE):
+        if tile_size % (1 << levels):
+            raise ValueError("PYRAMID_TILE_SIZE must be a multiple of 2 ** PYRAMID_LEVELS")
+        self.canvas = get_canvas_config(canvas_id)
+        self.levels = levels
+        self.tile_size = tile_size
+        self.tile_columns = -(-self.canvas.width // tile_size)
+        self.tile_rows = -(-self.canvas.height // tile_size)
+        # levels[0] 未使用，levels[n] 为缩小 2**n 倍的画面
+        self._levels: Optional[list] = None
+        self._dirty: Set[Tuple[int, int]] = set()
+        # 读取整幅画面期间被修改的块，重建后需要重新刷新
+        self._changed_since_frame: Optional[Set[Tuple[int, int]]] = None
+        # 刷新期间被修改的块，刷新完成后仍为脏块
+        self._changed_during_refresh: Optional[Set[Tuple[int, int]]] = None
+        self._png_cache: Dict[int, Tuple[str, bytes]] = {}
+        self.version = 0
+        self._lock = asyncio.Lock()
+
+    def level_shape(self, level: int) -> Tuple[int, int]:
+        """Get the (height, width) of a level."""
+        height, width = self.canvas.height, self.canvas.width
+        for _ in range(level):
+            height, width = -(-height // 2), -(-width // 2)
+        return height, width
+
+    def mark_dirty(self, x: int, y: int, width: int = 1, height: int = 1):
+        """Mark the tiles overlapping a region as changed."""
+        if self._levels is None and self._changed_since_frame is None and self._changed_during_refresh is None:
+            return
+        x0, y0 = max(x, 0), max(y, 0)
+        x1, y1 = min(x + width, self.canvas.width), min(y + height, self.canvas.height)
+        if x0 >= x1 or y0 >= y1:
+            return
+        for row in range(y0 // self.tile_size, (y1 - 1) // self.tile_size + 1):
+            for column in range(x0 // self.tile_size, (x1 - 1) // self.tile_size + 1):
+                self._dirty.add((row, column))
+                if self._changed_since_frame is not None:
+                    self._changed_since_frame.add((row, column))
+                if self._changed_during_refresh is not None:
+                    self._changed_during_refresh.add((row, column))
+
+    def _update_region(self, levels: list, x0: int, y0: int, region: np.ndarray):
+        """Push a tile-aligned region of the full-resolution canvas up through every level."""
+        for level in range(1, self.levels + 1):
+            region = downsample(region)
+            x0, y0 = x0 // 2, y0 // 2
+            height, width = region.shape[:2]
+            levels[level][y0:y0 + height, x0:x0 + width] = region
+
+    def track_changes(self):
+        """Start recording changed tiles; call before reading the frame passed to ``rebuild_from_frame``."""
+        self._changed_since_frame = set()
+
+    def _build_levels(self, frame: np.ndarray) -> list:
+        levels = [None]
+        for _ in range(self.levels):
+            frame = downsample(frame)
+            levels.append(frame)
+        return levels
+
+    async def rebuild_from_frame(self, frame: np.ndarray):
+        """Rebuild every level from a full (height, width, 3) frame.
+
+        Tiles changed since ``track_changes`` are refreshed again on the next
+        read, since the frame may predate them. Frames of another geometry
+        (the canvas was expanded meanwhile) are ignored.
+        """
+        if frame.shape[:2] != (self.canvas.height, self.canvas.width):
+            return
+        levels = await asyncio.get_event_loop().run_in_executor(None, self._build_levels, frame)
+        async with self._lock:
+            self._levels = levels
+            self._dirty |= self._changed_since_frame or set()
+            self._changed_since_frame = None
+            self._bump()
+
+    async def _build_from_redis(self, canvas_store: CanvasStore) -> list:
+        # 按块行读取，避免超大画布一次性占用整幅画面的内存；在新数组中构建，完成后再换入
+        levels = [None] + [np.zeros(self.level_shape(n) + (3,), dtype=np.uint8)
+                           for n in range(1, self.levels + 1)]
+        for row in range(self.tile_rows):
+            y0 = row * self.tile_size
+            height = min(self.tile_size, self.canvas.height - y0)
+            strip = await canvas_store.get_region(0, y0, self.canvas.width, height)
+            self._update_region(levels, 0, y0, strip)
+        return levels
+
+    async def _read_tiles(self, canvas_store: CanvasStore, tiles: Set[Tuple[int, int]]) -> list:
+        regions = []
+        for row, column in sorted(tiles):
+            x0, y0 = column * self.tile_size, row * self.tile_size
+            width = min(self.tile_size, self.canvas.width - x0)
+            height = min(self.tile_size, self.canvas.height - y0)
+            regions.append((x0, y0, await canvas_store.get_region(x0, y0, width, height)))
+        return regions
+
+    def _bump(self):
+        self.version += 1
+        self._png_cache.clear()
+
+    async def refresh(self):
+        """Bring the pyramid up to date with the live canvas."""
+        if self._levels is not None and not self._dirty:
+            return
+        async with self._lock:
+            if self._levels is not None and not self._dirty:
+                return
+            start_time = time.time()
+            full = self._levels is None or \
+                len(self._dirty) > FULL_REBUILD_RATIO * self.tile_rows * self.tile_columns
+            tiles = len(self._dirty)
+            self._changed_during_refresh = set()
+            try:
+                async with get_redis_connection() as redis_conn:
+                    canvas_store = CanvasStore(redis_conn, self.canvas.id, canvas=self.canvas)
+                    if full:
+                        levels = await self._build_from_redis(canvas_store)
+                    else:
+                        regions = await self._read_tiles(canvas_store, self._dirty)
+                # 以下不再让出事件循环：读者只会看到完整的旧层级或新层级
+                if full:
+                    self._levels = levels
+                else:
+                    for x0, y0, region in regions:
+                        self._update_region(self._levels, x0, y0, region)
+                self._dirty = self._changed_during_refresh
+            finally:
+                self._dirty |= self._changed_during_refresh
+                self._changed_during_refresh = None
+            self._bump()
+            logger.info(
+                f"Refreshed overview pyramid of canvas {self.canvas.id} "
+                f"({'full rebuild' if full else f'{tiles} tiles'}) in {time.time() - start_time:.2f} seconds"
+            )
+
+    async def get_png(self, level: int) -> Tuple[str, bytes]:
+        """Get a level encoded as PNG, with a digest of the PNG to use as ETag.
+
+        The digest rather than the version identifies the image, so that all
+        workers agree on it.
+
+        Raises:
+            ValueError: If the level does not exist
+        """
+        if not 1 <= level <= self.levels:
+            raise ValueError(f"level must be between 1 and {self.levels}")
+        await self.refresh()
+        cached = self._png_cache.get(level)
+        if cached is not None:
+            return cached
+        version = self.version
+        # 编码副本，编码期间的刷新不会影响结果
+        image = self._levels[level].copy()
+        png_bytes = await asyncio.get_event_loop().run_in_executor(None, rgb_array_to_png, image)
+        encoded = (hashlib.md5(png_bytes).hexdigest(), png_bytes)
+        if version == self.version:
+            self._png_cache[level] = encoded
+        return encoded
+
+
+_pyramids: Dict[str, CanvasPyramid] = {}
+
+
+def get_pyramid(canvas_id: str = DEFAULT_CANVAS_ID) -> CanvasPyramid:
+    """Get this worker's pyramid of a canvas, rebuilt after the canvas is expanded."""
+    pyramid = _pyramids.get(canvas_id)
+    if pyramid is None or pyramid.canvas is not get_canvas_config(canvas_id):
+        pyramid = _pyramids[canvas_id] = CanvasPyramid(canvas_id)
+    return pyramid
+
+
+def handle_canvas_message(canvas_id: str, message: str):
+    """Pub/sub listener marking the tiles touched by a canvas update as dirty."""
+    pyramid = _pyramids.get(canvas_id)
+    if pyramid is None:
+        return
+    try:
+        for x, y, width, height in canvas_update_regions(message):
+            pyramid.mark_dirty(x, y, width, height)
+    except (ValueError, KeyError, TypeError) as e:
+        logger.warning(f"Ignoring malformed canvas update for the overview pyramid: {e}")
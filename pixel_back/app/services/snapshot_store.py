@@ -0,0 +1,353 @@
+"""
+Snapshot storage with delta encoding, retention and garbage collection.
+
+Snapshot files are content-addressed, so two snapshots can never collide on
+a name. A snapshot is stored either as a keyframe, a full PNG named
+``snapshot_<hash>.png``, or as a compressed diff against a keyframe named
+``delta_<hash>__<keyframe stem>.npz``. Putting the keyframe in the delta's
+name lets the garbage collector work out file references without opening
+any file. A new keyframe is started every hour, or when the diff against the
+current keyframe becomes too large.
+
+Snapshots of the default canvas live directly in SNAPSHOT_DIRECTORY, those
+of other canvases in a subdirectory named after the canvas; the stored file
+name is always relative to SNAPSHOT_DIRECTORY.
+
+Retention keeps, per canvas, the newest SNAPSHOT_KEEP_LAST snapshots plus the
+first snapshot of each hour and of each day within the configured windows. The GC
+deletes the other rows, then deletes files that no retained row uses,
+directly or as a keyframe. Keyframes that a worker is diffing against may
+not be referenced by any row yet, and the GC can run in another worker, so
+every snapshot records its keyframe in a Redis sorted set scored by time;
+keyframes used within SNAPSHOT_KEYFRAME_RETENTION seconds are kept too.
+"""
+
+import asyncio
+import hashlib
+import json
+import os
+import re
+import time
+from datetime import datetime, timedelta
+from io import BytesIO
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+
+import numpy as np
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app.canvas_registry import DEFAULT_CANVAS_ID
+from app.config import (
+    SNAPSHOT_DIRECTORY,
+    SNAPSHOT_KEEP_LAST,
+    SNAPSHOT_KEEP_HOURLY,
+    SNAPSHOT_KEEP_DAILY,
+    SNAPSHOT_GC_INTERVAL,
+    SNAPSHOT_KEYFRAME_MAX_CHANGED,
+    SNAPSHOT_KEYFRAME_RETENTION,
+)
+from app.db.crud import delete_snapshots, list_snapshots
+from app.db.models import CanvasSnapshot
+from app.deps import get_db_session, get_redis_connection, job_lock
+from app.utils.logger import logger
+from app.utils.utils import hex_colors_to_rgb, png_to_rgb_array, rgb_array_to_png
+
+DELTA_NAME_PATTERN = re.compile(r"^delta_[0-9a-f]+__(?P<base>.+)\.npz$")
+SNAPSHOT_FILE_PATTERN = re.compile(r"^(snapshot_.+\.(png|json)|delta_.+\.npz)$")
+# 未被引用的文件在删除前至少保留这么久，避免删除刚写入、尚未提交数据库记录的快照
+GC_GRACE_SECONDS = 600
+# 各 worker 正在使用的关键帧：成员为文件名，分数为最近一次使用的时间
+LIVE_KEYFRAMES_KEY = "snapshot_live_keyframes"
+
+
+def is_delta(filename: str) -> bool:
+    return DELTA_NAME_PATTERN.match(os.path.basename(filename)) is not None
+
+
+def keyframe_of(filename: str) -> str:
+    """Get the keyframe file a snapshot file depends on (itself for keyframes)."""
+    match = DELTA_NAME_PATTERN.match(os.path.basename(filename))
+    if not match:
+        return filename
+    # 关键帧与增量文件位于同一目录
+    return os.path.join(os.path.dirname(filename), f"{match.group('base')}.png")
+
+
+class SnapshotStore:
+    """Reads and writes snapshot files in SNAPSHOT_DIRECTORY.
+
+    Any store can read any snapshot file; ``canvas_id`` only selects where new
+    snapshots are written and which keyframe they are diffed against.
+    """
+
+    def __init__(self, directory: str = SNAPSHOT_DIRECTORY, canvas_id: str = DEFAULT_CANVAS_ID):
+        self.directory = directory
+        self.canvas_id = canvas_id
+        self.prefix = "" if canvas_id == DEFAULT_CANVAS_ID else canvas_id
+        # 当前关键帧：(文件名, 画面, 创建时间)
+        self._keyframe: Optional[Tuple[str, np.ndarray, datetime]] = None
+
+    def path(self, filename: str) -> str:
+        return os.path.join(self.directory, filename)
+
+    def exists(self, filename: str) -> bool:
+        return os.path.exists(self.path(filename)) and (
+            not is_delta(filename) or os.path.exists(self.path(keyframe_of(filename)))
+        )
+
+    def load_frame(self, filename: str, size: Optional[Tuple[int, int]] = None) -> np.ndarray:
+        """Load a snapshot as a writable (height, width, 3) RGB array.
+
+        Args:
+            size: (width, height) of the snapshot's geometry version; only
+                old JSON snapshots, which do not record their size, need it
+
+        Raises:
+            FileNotFoundError: If the snapshot or its keyframe no longer exists
+            ValueError: If a JSON snapshot is loaded without its size
+        """
+        full_path = self.path(filename)
+        if not os.path.exists(full_path):
+            raise FileNotFoundError(full_path)
+
+        if is_delta(filename):
+            frame = self.load_frame(keyframe_of(filename))
+            with np.load(full_path, allow_pickle=False) as delta:
+                height, width = (int(v) for v in delta["shape"])
+                if frame.shape[:2] != (height, width):
+                    raise ValueError(f"Delta {filename} does not match its keyframe size")
+                frame.reshape(-1, 3)[delta["indices"]] = delta["colors"]
+            return frame
+
+        _, ext = os.path.splitext(full_path)
+        if ext.lower() == '.png':
+            return png_to_rgb_array(full_path)
+
+        # JSON fallback for old snapshots
+        if size is None:
+            raise ValueError(f"The canvas size of JSON snapshot {filename} is required")
+        width, height = size
+        with open(full_path, 'r') as f:
+            color_array = json.load(f)
+        return hex_colors_to_rgb(color_array).reshape(height, width, 3).copy()
+
+    def read_png(self, filename: str, size: Optional[Tuple[int, int]] = None) -> bytes:
+        """Get a snapshot encoded as PNG, reading keyframes without re-encoding.
+
+        ``size`` is passed on to ``load_frame``.
+        """
+        if filename.lower().endswith('.png'):
+            full_path = self.path(filename)
+            if not os.path.exists(full_path):
+                raise FileNotFoundError(full_path)
+            with open(full_path, 'rb') as f:
+                return f.read()
+        return rgb_array_to_png(self.load_frame(filename, size))
+
+    def _write_atomic(self, filename: str, content: bytes):
+        full_path = self.path(filename)
+        if os.path.exists(full_path):
+            # 内容寻址：同名文件内容必然相同，刷新修改时间以免被GC当作过期文件
+            os.utime(full_path)
+            return
+        temp_path = f"{full_path}.{os.getpid()}.tmp"
+        with open(temp_path, 'wb') as f:
+            f.write(content)
+        os.replace(temp_path, full_path)
+
+    def _save_keyframe(self, frame: np.ndarray, created_at: datetime) -> str:
+        png_bytes = rgb_array_to_png(frame)
+        filename = os.path.join(self.prefix, f"snapshot_{hashlib.sha256(png_bytes).hexdigest()[:16]}.png")
+        self._write_atomic(filename, png_bytes)
+        self._keyframe = (filename, frame.copy(), created_at)
+        return filename
+
+    def _current_keyframe(self, latest_filename: Optional[str]) -> Optional[Tuple[str, np.ndarray, datetime]]:
+        """Get the keyframe to diff against, reloading it after a restart."""
+        if self._keyframe is None and latest_filename:
+            filename = keyframe_of(latest_filename)
+            if filename.lower().endswith('.png') and os.path.exists(self.path(filename)):
+                mtime = datetime.utcfromtimestamp(os.path.getmtime(self.path(filename)))
+                self._keyframe = (filename, png_to_rgb_array(self.path(filename)), mtime)
+        return self._keyframe
+
+    def save(self, frame: np.ndarray, created_at: datetime, latest_filename: Optional[str] = None) -> str:
+        """Store a snapshot and return its file name.
+
+        Args:
+            frame: (height, width, 3) RGB array of the canvas
+            created_at: Snapshot time (UTC)
+            latest_filename: File of the previous snapshot, used to find the
+                keyframe after a restart
+
+        Returns:
+            The file name relative to SNAPSHOT_DIRECTORY
+        """
+        os.makedirs(os.path.join(self.directory, self.prefix), exist_ok=True)
+        keyframe = self._current_keyframe(latest_filename)
+
+        if keyframe is None:
+            return self._save_keyframe(frame, created_at)
+        base_name, base_frame, base_created_at = keyframe
+        new_hour = created_at.replace(minute=0, second=0, microsecond=0) != \
+            base_created_at.replace(minute=0, second=0, microsecond=0)
+        if new_hour or base_frame.shape != frame.shape:
+            return self._save_keyframe(frame, created_at)
+
+        changed = np.flatnonzero((base_frame != frame).any(axis=2).ravel())
+        if len(changed) > SNAPSHOT_KEYFRAME_MAX_CHANGED * frame.shape[0] * frame.shape[1]:
+            return self._save_keyframe(frame, created_at)
+
+        indices = changed.astype(np.uint32)
+        colors = np.ascontiguousarray(frame.reshape(-1, 3)[changed])
+        shape = np.array(frame.shape[:2], dtype=np.int64)
+        base_stem, _ = os.path.splitext(os.path.basename(base_name))
+
+        digest = hashlib.sha256()
+        for part in (base_stem.encode(), shape.tobytes(), indices.tobytes(), colors.tobytes()):
+            digest.update(part)
+        filename = os.path.join(self.prefix, f"delta_{digest.hexdigest()[:16]}__{base_stem}.npz")
+
+        buffer = BytesIO()
+        np.savez_compressed(buffer, indices=indices, colors=colors, shape=shape)
+        self._write_atomic(filename, buffer.getvalue())
+        return filename
+
+
+async def mark_keyframe_live(filename: str, at: Optional[float] = None):
+    """Record that a snapshot's keyframe is in use, so that the GC of any worker keeps it."""
+    async with get_redis_connection() as redis_conn:
+        await redis_conn.zadd(LIVE_KEYFRAMES_KEY, {os.path.normpath(keyframe_of(filename)): time.time() if at is None else at})
+
+
+async def get_live_keyframes(now: Optional[float] = None) -> Set[str]:
+    """Get the keyframes used within SNAPSHOT_KEYFRAME_RETENTION seconds, forgetting older ones."""
+    since = (time.time() if now is None else now) - SNAPSHOT_KEYFRAME_RETENTION
+    async with get_redis_connection() as redis_conn:
+        await redis_conn.zremrangebyscore(LIVE_KEYFRAMES_KEY, "-inf", f"({since}")
+        return set(await redis_conn.zrange(LIVE_KEYFRAMES_KEY, 0, -1))
+
+
+def plan_retention(snapshots: Iterable[CanvasSnapshot], now: datetime) -> Tuple[List[CanvasSnapshot], List[CanvasSnapshot]]:
+    """Split snapshots into the ones to keep and the ones to delete.
+
+    Keeps the newest SNAPSHOT_KEEP_LAST snapshots, and the first snapshot of
+    each of the last SNAPSHOT_KEEP_HOURLY hours and SNAPSHOT_KEEP_DAILY days.
+    """
+    ordered = sorted(snapshots, key=lambda s: (s.last_log_id or 0, s.id))
+    keep_ids: Set[int] = {s.id for s in ordered[-SNAPSHOT_KEEP_LAST:]} if SNAPSHOT_KEEP_LAST > 0 else set()
+
+    hourly: Dict[datetime, CanvasSnapshot] = {}
+    daily: Dict[datetime, CanvasSnapshot] = {}
+    hourly_since = now - timedelta(hours=SNAPSHOT_KEEP_HOURLY)
+    daily_since = now - timedelta(days=SNAPSHOT_KEEP_DAILY)
+    for snapshot in ordered:
+        created_at = snapshot.created_at
+        if created_at is None:
+            continue
+        if created_at >= hourly_since:
+            hourly.setdefault(created_at.replace(minute=0, second=0, microsecond=0), snapshot)
+        if created_at >= daily_since:
+            daily.setdefault(created_at.replace(hour=0, minute=0, second=0, microsecond=0), snapshot)
+    keep_ids.update(s.id for s in hourly.values())
+    keep_ids.update(s.id for s in daily.values())
+
+    keep = [s for s in ordered if s.id in keep_ids]
+    delete = [s for s in ordered if s.id not in keep_ids]
+    return keep, delete
+
+
+def _iter_snapshot_files(directory: str) -> Iterable[str]:
+    """List snapshot file names relative to the snapshot directory, including canvas subdirectories."""
+    for root, _, names in os.walk(directory):
+        relative_root = os.path.relpath(root, directory)
+        for name in names:
+            if SNAPSHOT_FILE_PATTERN.match(name):
+                yield name if relative_root == "." else os.path.join(relative_root, name)
+
+
+async def collect_snapshot_garbage(db: AsyncSession, directory: str = SNAPSHOT_DIRECTORY) -> Tuple[int, int]:
+    """Apply the retention policy to snapshot rows and files.
+
+    Returns:
+        (deleted rows, deleted files)
+    """
+    by_canvas: Dict[str, List[CanvasSnapshot]] = {}
+    for snapshot in await list_snapshots(db):
+        by_canvas.setdefault(snapshot.canvas_id or DEFAULT_CANVAS_ID, []).append(snapshot)
+
+    now = datetime.utcnow()
+    keep: List[CanvasSnapshot] = []
+    delete: List[CanvasSnapshot] = []
+    for snapshots in by_canvas.values():
+        canvas_keep, canvas_delete = plan_retention(snapshots, now)
+        keep.extend(canvas_keep)
+        delete.extend(canvas_delete)
+    if delete:
+        await delete_snapshots(db, [s.id for s in delete])
+
+    referenced = set()
+    for snapshot in keep:
+        referenced.add(os.path.normpath(snapshot.data_file_path))
+        referenced.add(os.path.normpath(keyframe_of(snapshot.data_file_path)))
+    referenced.update(await get_live_keyframes())
+    for store in _snapshot_stores.values():
+        if store._keyframe is not None:
+            referenced.add(os.path.normpath(store._keyframe[0]))
+
+    deleted_files = 0
+    if os.path.isdir(directory):
+        cutoff = time.time() - GC_GRACE_SECONDS
+        for name in list(_iter_snapshot_files(directory)):
+            if os.path.normpath(name) in referenced:
+                continue
+            full_path = os.path.join(directory, name)
+            try:
+                if os.path.getmtime(full_path) < cutoff:
+                    os.remove(full_path)
+                    deleted_files += 1
+            except FileNotFoundError:
+                continue
+    return len(delete), deleted_files
+
+
+async def run_snapshot_gc():
+    """Run snapshot garbage collection, once across all workers."""
+    async with job_lock("snapshot_gc", max(SNAPSHOT_GC_INTERVAL, 60)) as acquired:
+        if not acquired:
+            return
+        start_time = time.time()
+        async with get_db_session() as db:
+            deleted_rows, deleted_files = await collect_snapshot_garbage(db)
+        logger.info(
+            f"Snapshot GC deleted {deleted_rows} rows and {deleted_files} files "
+            f"in {time.time() - start_time:.2f} seconds"
+        )
+        if deleted_rows:
+            # 延迟导入，避免与历史服务循环导入
+            from app.services.history_service import invalidate_history
+            invalidate_history()
+
+
+async def snapshot_gc_loop():
+    """Background loop running snapshot GC every SNAPSHOT_GC_INTERVAL seconds."""
+    while True:
+        await asyncio.sleep(SNAPSHOT_GC_INTERVAL)
+        try:
+            await run_snapshot_gc()
+        except Exception as e:
+            logger.error(f"Error during snapshot GC: {str(e)}", exc_info=True)
+
+
+_snapshot_stores: Dict[str, SnapshotStore] = {}
+
+
+def get_snapshot_store(canvas_id: str = DEFAULT_CANVAS_ID) -> SnapshotStore:
+    """Get the shared store that writes a canvas's snapshots."""
+    store = _snapshot_stores.get(canvas_id)
+    if store is None:
+        store = _snapshot_stores[canvas_id] = SnapshotStore(canvas_id=canvas_id)
+    return store
+
+
+# Shared instance used by snapshot creation and readers
+snapshot_store = get_snapshot_store(DEFAULT_CANVAS_ID)
@@ -0,0 +1,188 @@
+"""
+Read-only spectator streams over Server-Sent Events.
+
+Spectators do not need a WebSocket session: each worker's ``SpectatorHub``
+receives the canvas updates once through the connection manager's pub/sub
+listener, coalesces them for SPECTATOR_TICK seconds (the last color of a
+pixel wins), and encodes every tick once into an SSE frame. The same bytes
+object is queued to every subscriber of the canvas, so a spectator costs a
+queue slot and a socket write per tick instead of a receive loop, a Redis
+client and a JSON encode per message.
+
+Frames carry an ``id`` made of a per-worker token and a per-canvas sequence
+number, and are queued with that number. A browser reconnecting with
+``Last-Event-ID`` is replayed the frames it missed from a short backlog, and
+queued frames that the replay already covered are skipped. When the missed
+frames are gone (another worker, too long ago, or sent while nobody was
+watching) it gets a ``resync`` event instead, so that it reloads or
+diff-resyncs the board.
+"""
+
+import asyncio
+import json
+import uuid
+from collections import deque
+from typing import AsyncIterator, Deque, Dict, List, Optional, Set, Tuple
+
+from app.config import SPECTATOR_BACKLOG, SPECTATOR_KEEPALIVE, SPECTATOR_QUEUE_SIZE, SPECTATOR_TICK
+from app.utils.logger import logger
+
+KEEPALIVE_FRAME = b": keepalive\n\n"
+# 浏览器断线后的重连间隔（毫秒）
+RETRY_FRAME = b"retry: 3000\n\n"
+
+
+def sse_frame(event: str, data, event_id: Optional[str] = None) -> bytes:
+    """Encode one Server-Sent Event; ``data`` is serialized as JSON on a single line."""
+    lines = []
+    if event_id is not None:
+        lines.append(f"id: {event_id}")
+    lines.append(f"event: {event}")
+    lines.append(f"data: {json.dumps(data, separators=(',', ':'))}")
+    return ("\n".join(lines) + "\n\n").encode("utf-8")
+
+
+class CanvasFeed:
+    """Pending updates, backlog and subscribers of one canvas in one worker."""
+
+    def __init__(self):
+        self.subscribers: Set[asyncio.Queue] = set()
+        # 本次间隔内按到达顺序排列的待发送事件；相邻的像素更新合并为一个
+        # ("pixels", {(x, y): color}) 批次，按坐标去重保留最后的颜色
+        self.events: List[Tuple[str, dict]] = []
+        self.sequence = 0
+        self.backlog: Deque[Tuple[int, bytes]] = deque(maxlen=SPECTATOR_BACKLOG)
+
+
+class SpectatorHub:
+    """Coalesces canvas updates and fans the encoded frames out to SSE subscribers."""
+
+    def __init__(self):
+        self.token = uuid.uuid4().hex[:8]
+        self.feeds: Dict[str, CanvasFeed] = {}
+
+    def handle_message(self, canvas_id: str, message: str):
+        """Pub/sub listener collecting the updates of canvases that have spectators."""
+        feed = self.feeds.get(canvas_id)
+        if feed is None:
+            return
+        if not feed.subscribers:
+            # 无人观看时不记录更新，跳过一个序号使之后带 Last-Event-ID 重连的客户端重新同步
+            feed.sequence += 1
+            feed.backlog.clear()
+            return
+        try:
+            payload = json.loads(message)
+            data = payload.get("data") or {}
+            kind = payload.get("type")
+            if kind == "pixel_update":
+                self._add_pixel(feed, int(data["x"]), int(data["y"]), data["color"])
+            elif kind == "pixel_batch":
+                for pixel in data["pixels"]:
+                    self._add_pixel(feed, int(pixel["x"]), int(pixel["y"]), pixel["color"])
+            elif kind in ("region_update", "canvas_resize"):
+                feed.events.append((kind, data))
+        except (ValueError, KeyError, TypeError) as e:
+            logger.warning(f"Ignoring malformed canvas update for spectators: {e}")
+
+    @staticmethod
+    def _add_pixel(feed: CanvasFeed, x: int, y: int, color: str):
+        if not feed.events or feed.events[-1][0] != "pixels":
+            feed.events.append(("pixels", {}))
+        feed.events[-1][1][(x, y)] = color
+
+    def _encode(self, feed: CanvasFeed) -> List[Tuple[int, bytes]]:
+        frames = []
+        events, feed.events = feed.events, []
+        for kind, data in events:
+            feed.sequence += 1
+            event_id = f"{self.token}-{feed.sequence}"
+            if kind == "pixels":
+                batch = [{"x": x, "y": y, "color": color} for (x, y), color in data.items()]
+                frame = sse_frame("pixel_batch", {"pixels": batch}, event_id)
+            else:
+                frame = sse_frame(kind, data, event_id)
+            feed.backlog.append((feed.sequence, frame))
+            frames.append((feed.sequence, frame))
+        return frames
+
+    def _publish(self, feed: CanvasFeed, frame: bytes, sequence: Optional[int] = None):
+        """Queue a frame, with its sequence number unless it is a keepalive, to every subscriber."""
+        item = (sequence, frame)
+        lagging = []
+        for queue in feed.subscribers:
+            try:
+                queue.put_nowait(item)
+            except asyncio.QueueFull:
+                lagging.append(queue)
+        for queue in lagging:
+            # 跟不上的订阅者：清空队列并结束其响应，浏览器会带 Last-Event-ID 重连
+            feed.subscribers.discard(queue)
+            while not queue.empty():
+                queue.get_nowait()
+            queue.put_nowait(None)
+
+    async def run(self):
+        """Flush the coalesced updates every SPECTATOR_TICK seconds and send keepalives."""
+        loop = asyncio.get_event_loop()
+        last_keepalive = loop.time()
+        while True:
+            await asyncio.sleep(SPECTATOR_TICK)
+            try:
+                keepalive = loop.time() - last_keepalive >= SPECTATOR_KEEPALIVE
+                if keepalive:
+                    last_keepalive = loop.time()
+                for feed in self.feeds.values():
+                    for sequence, frame in self._encode(feed) if feed.events else ():
+                        self._publish(feed, frame, sequence)
+                    if keepalive:
+                        # 注释行使代理与负载均衡器不会因空闲而断开连接
+                        self._publish(feed, KEEPALIVE_FRAME)
+            except Exception as e:
+                logger.error(f"Error flushing spectator updates: {str(e)}", exc_info=True)
+
+    def _missed_frames(self, feed: CanvasFeed, last_event_id: Optional[str]) -> Optional[List[Tuple[int, bytes]]]:
+        """Get the (sequence, frame) after Last-Event-ID from the backlog, or None if they are not all there."""
+        token, _, sequence = (last_event_id or "").partition("-")
+        if token != self.token or not sequence.isdigit():
+            return None
+        sequence = int(sequence)
+        if sequence == feed.sequence:
+            return []
+        if not feed.backlog or feed.backlog[0][0] > sequence + 1:
+            return None
+        return [(frame_sequence, frame) for frame_sequence, frame in feed.backlog if frame_sequence > sequence]
+
+    async def subscribe(self, canvas_id: str, last_event_id: Optional[str] = None) -> AsyncIterator[bytes]:
+        """Stream the SSE frames of a canvas until the client disconnects or falls behind."""
+        feed = self.feeds.setdefault(canvas_id, CanvasFeed())
+        queue: asyncio.Queue = asyncio.Queue(maxsize=SPECTATOR_QUEUE_SIZE)
+        feed.subscribers.add(queue)
+        # 队列先于补发注册，以免漏掉其间的帧；已补发的帧按序号跳过
+        replayed_up_to = 0
+        try:
+            yield RETRY_FRAME
+            if last_event_id:
+                missed = self._missed_frames(feed, last_event_id)
+                if missed is None:
+                    yield sse_frame("resync", {"reason": "missed updates are no longer available"})
+                else:
+                    for replayed_up_to, frame in missed:
+                        yield frame
+            while True:
+                item = await queue.get()
+                if item is None:
+                    return
+                sequence, frame = item
+                if sequence is not None and sequence <= replayed_up_to:
+                    continue
+                yield frame
+        finally:
+            feed.subscribers.discard(queue)
+
+    def stats(self) -> Dict[str, int]:
+        """Get the spectator count of this worker."""
+        return {"spectators": sum(len(feed.subscribers) for feed in self.feeds.values())}
+
+
+spectator_hub = SpectatorHub()
@@ -0,0 +1,406 @@
+"""
+Timelapse export from pixel_logs.
+
+Logs are streamed in chunks and applied with NumPy to a single working frame.
+Every time the frame crosses a step boundary (a number of logs or seconds) a
+copy is handed to a thread pool for encoding, with a bounded number of frames
+in flight, and the encoded frames are appended to the output file in order.
+GIF output is written frame by frame with a local palette per frame, so no
+format needs the whole animation in memory. Logs are read in one short
+transaction per chunk rather than one transaction for the whole export.
+"""
+
+import asyncio
+import os
+import struct
+import time
+import uuid
+import zipfile
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from io import BytesIO
+from typing import Optional
+
+import numpy as np
+from PIL import Image
+
+from app.config import (
+    TIMELAPSE_DIRECTORY,
+    TIMELAPSE_WORKERS,
+    TIMELAPSE_DEFAULT_STEP_LOGS,
+    TIMELAPSE_MAX_FRAMES,
+    HISTORY_LOG_CHUNK_SIZE,
+)
+from app.canvas_registry import DEFAULT_CANVAS_ID, canvas_geometry_at, get_canvas_config
+from app.db.crud import get_snapshot_by_id
+from app.deps import get_read_db_session, get_redis_connection
+from app.schemas.timelapse import TimelapseRequest, TimelapseJob
+from app.services.history_service import (
+    blank_frame,
+    get_history_service,
+    load_snapshot_frame,
+    rows_to_updates,
+)
+from app.services.log_archive import iter_logs_paged
+from app.utils.logger import logger
+from app.utils.utils import apply_pixel_updates, fit_frame
+
+TIMELAPSE_FORMATS = ("gif", "zip")
+TIMELAPSE_JOB_KEY_PREFIX = "timelapse_job"
+TIMELAPSE_JOB_TTL = 7 * 24 * 3600
+
+# GIF application extension that makes the animation loop forever
+_GIF_LOOP_EXTENSION = b"!\xff\x0bNETSCAPE2.0\x03\x01\x00\x00\x00"
+_GIF_TRAILER = b";"
+
+# Shared pool for frame encoding; PIL and zlib release the GIL while encoding
+_encoder_pool = ThreadPoolExecutor(max_workers=TIMELAPSE_WORKERS, thread_name_prefix="timelapse")
+
+
+def validate_timelapse_request(request: TimelapseRequest):
+    """Check a timelapse request.
+
+    Raises:
+        ValueError: If the request is invalid
+    """
+    try:
+        get_canvas_config(request.canvas_id)
+    except KeyError:
+        raise ValueError(f"Unknown canvas {request.canvas_id}")
+    if request.format not in TIMELAPSE_FORMATS:
+        raise ValueError(f"Unsupported format, expected one of {TIMELAPSE_FORMATS}")
+    if request.step_logs is not None and request.step_seconds is not None:
+        raise ValueError("Only one of step_logs and step_seconds may be given")
+    if request.step_logs is not None and request.step_logs <= 0:
+        raise ValueError("step_logs must be positive")
+    if request.step_seconds is not None and request.step_seconds <= 0:
+        raise ValueError("step_seconds must be positive")
+    if request.start_snapshot_id is not None and request.start_log_id is not None:
+        raise ValueError("Only one of start_snapshot_id and start_log_id may be given")
+    if request.scale < 1:
+        raise ValueError("scale must be at least 1")
+    if request.frame_duration_ms <= 0:
+        raise ValueError("frame_duration_ms must be positive")
+
+
+def _encode_png_frame(frame: np.ndarray) -> bytes:
+    img_bytes = BytesIO()
+    Image.fromarray(frame, 'RGB').save(img_bytes, format='PNG')
+    return img_bytes.getvalue()
+
+
+def _gif_header(width: int, height: int) -> bytes:
+    """GIF89a header and logical screen descriptor without a global color table."""
+    return b"GIF89a" + struct.pack("<HHBBB", width, height, 0, 0, 0)
+
+
+def _skip_sub_blocks(data: bytes, position: int) -> int:
+    # 数据子块序列：长度字节 + 数据，以长度 0 结束
+    while data[position]:
+        position += data[position] + 1
+    return position + 1
+
+
+def _gif_frame_blocks(data: bytes) -> bytes:
+    """Turn a single-image GIF file into blocks that can be appended to an animation.
+
+    The header and trailer are dropped, and the global color table is moved
+    into the image descriptor as a local color table, because each frame of
+    the animation has its own palette.
+    """
+    if data[:6] not in (b"GIF87a", b"GIF89a"):
+        raise ValueError("Not a GIF file")
+    flags = data[10]
+    position = 13
+    color_table = b""
+    if flags & 0x80:
+        table_size = 3 << ((flags & 0x07) + 1)
+        color_table = data[position:position + table_size]
+        position += table_size
+
+    blocks = []
+    while data[position:position + 1] != _GIF_TRAILER:
+        introducer = data[position]
+        if introducer == 0x21:
+            # 扩展块：引入符、标签，再接数据子块
+            end = _skip_sub_blocks(data, position + 2)
+            blocks.append(data[position:end])
+        elif introducer == 0x2C:
+            descriptor = bytearray(data[position:position + 10])
+            end = position + 10
+            if descriptor[9] & 0x80:
+                local_size = 3 << ((descriptor[9] & 0x07) + 1)
+                local_table = data[end:end + local_size]
+                end += local_size
+            else:
+                descriptor[9] = (descriptor[9] & 0x78) | 0x80 | (flags & 0x07)
+                local_table = color_table
+            # LZW 最小码长，再接图像数据子块
+            image_end = _skip_sub_blocks(data, end + 1)
+            blocks.append(bytes(descriptor) + local_table + data[end:image_end])
+            end = image_end
+        else:
+            raise ValueError(f"Unexpected GIF block 0x{introducer:02X}")
+        position = end
+    return b"".join(blocks)
+
+
+def _encode_gif_frame(frame: np.ndarray, duration_ms: int) -> bytes:
+    """Encode one frame as GIF blocks (graphic control extension and image) with its own color table."""
+    img = Image.fromarray(frame, 'RGB').quantize(256)
+    img_bytes = BytesIO()
+    img.save(img_bytes, format='GIF', duration=duration_ms, disposal=1)
+    return _gif_frame_blocks(img_bytes.getvalue())
+
+
+class _FrameWriter:
+    """Appends encoded frames to the output file in order."""
+
+    def __init__(self, path: str, fmt: str, duration_ms: int):
+        self.path = path
+        self.fmt = fmt
+        self.duration_ms = duration_ms
+        self.frames = 0
+        self._file = None
+        self._zip = None
+
+    def open(self, width: int, height: int):
+        if self.fmt == "zip":
+            # PNG帧本身已压缩，zip中直接存储即可
+            self._zip = zipfile.ZipFile(self.path, "w", compression=zipfile.ZIP_STORED)
+        else:
+            self._file = open(self.path, "wb")
+            self._file.write(_gif_header(width, height))
+            self._file.write(_GIF_LOOP_EXTENSION)
+
+    def encode(self, frame: np.ndarray) -> bytes:
+        if self.fmt == "zip":
+            return _encode_png_frame(frame)
+        return _encode_gif_frame(frame, self.duration_ms)
+
+    def write(self, encoded: bytes):
+        self.frames += 1
+        if self._zip is not None:
+            self._zip.writestr(f"frame_{self.frames:06d}.png", encoded)
+        else:
+            self._file.write(encoded)
+
+    def close(self):
+        if self._zip is not None:
+            self._zip.close()
+        if self._file is not None:
+            self._file.write(_GIF_TRAILER)
+            self._file.close()
+
+
+class TimelapseExporter:
+    """Renders the canvas evolution between two points into an animation file."""
+
+    def __init__(self, request: TimelapseRequest, output_path: str):
+        self.request = request
+        self.output_path = output_path
+        self.max_in_flight = TIMELAPSE_WORKERS * 2
+
+    async def _load_start(self):
+        """Get a writable starting frame and the log ID it includes.
+
+        The frame has the size of the canvas at the end of the range, so that
+        every frame of the animation has the same size.
+        """
+        async with get_read_db_session(min_log_id=self.request.end_log_id) as db:
+            frame, start_log_id = await self._load_start_frame(db)
+        width, height = canvas_geometry_at(self.request.canvas_id, self.request.end_log_id)
+        return fit_frame(frame, width, height), start_log_id
+
+    async def _load_start_frame(self, db):
+        request = self.request
+        if request.start_snapshot_id is not None:
+            snapshot = await get_snapshot_by_id(db, request.start_snapshot_id)
+            if snapshot is None or (snapshot.canvas_id or DEFAULT_CANVAS_ID) != request.canvas_id:
+                raise ValueError(f"Snapshot {request.start_snapshot_id} not found")
+            loop = asyncio.get_event_loop()
+            frame = await loop.run_in_executor(None, load_snapshot_frame, snapshot)
+            return frame, snapshot.last_log_id
+        if request.start_log_id:
+            historical = await get_history_service(request.canvas_id).reconstruct(db, request.start_log_id)
+            return historical.frame.copy(), historical.log_id
+        canvas = get_canvas_config(request.canvas_id)
+        return blank_frame(canvas.width, canvas.height), 0
+
+    async def run(self, progress=None) -> int:
+        """Export the timelapse.
+
+        Args:
+            progress: Optional async callback invoked with (frames, last_log_id)
+
+        Returns:
+            The number of frames written
+        """
+        request = self.request
+        scale = request.scale
+        by_time = request.step_seconds is not None
+        step = int(request.step_seconds * 1_000_000) if by_time else (request.step_logs or TIMELAPSE_DEFAULT_STEP_LOGS)
+
+        writer = _FrameWriter(self.output_path, request.format, request.frame_duration_ms)
+        loop = asyncio.get_event_loop()
+        in_flight = deque()
+        last_log_id = 0
+
+        async def emit():
+            # 复制当前画面交给编码线程，限制同时在编码中的帧数以控制内存
+            if writer.frames + len(in_flight) >= TIMELAPSE_MAX_FRAMES:
+                raise ValueError(f"Timelapse exceeds {TIMELAPSE_MAX_FRAMES} frames, use a larger step")
+            snapshot = frame[::scale, ::scale].copy()
+            in_flight.append(loop.run_in_executor(_encoder_pool, writer.encode, snapshot))
+            while len(in_flight) >= self.max_in_flight:
+                writer.write(await in_flight.popleft())
+            if progress is not None:
+                await progress(writer.frames + len(in_flight), last_log_id)
+
+        frame, start_log_id = await self._load_start()
+        last_log_id = start_log_id
+        height, width = frame[::scale, ::scale].shape[:2]
+        writer.open(width, height)
+        try:
+            await emit()
+            boundary = None if by_time else start_log_id + step
+            key_floor = np.iinfo(np.int64).min
+            dirty = False
+
+            async for rows in iter_logs_paged(
+                start_log_id, request.end_log_id, HISTORY_LOG_CHUNK_SIZE, canvas_id=request.canvas_id
+            ):
+                xs, ys, rgb, kept = rows_to_updates(rows)
+                if by_time:
+                    keys = np.array(
+                        [rows[i].created_at for i in kept], dtype="datetime64[us]"
+                    ).astype(np.int64)
+                    # created_at 不保证随ID单调递增，取累计最大值以便二分查找
+                    if len(keys):
+                        keys = np.maximum(np.maximum.accumulate(keys), key_floor)
+                        key_floor = int(keys[-1])
+                else:
+                    keys = np.fromiter((rows[i].id for i in kept), dtype=np.int64, count=len(kept))
+                if boundary is None and len(keys):
+                    boundary = int(keys[0]) + step
+
+                position = 0
+                while position < len(keys):
+                    cut = int(np.searchsorted(keys, boundary, side="right"))
+                    if cut > position:
+                        apply_pixel_updates(frame, xs[position:cut], ys[position:cut], rgb[position:cut])
+                        dirty = True
+                        position = cut
+                    if position == len(keys):
+                        break
+                    # 跨过边界：输出一帧，并跳过没有任何更新的空白区间
+                    last_log_id = rows[kept[position - 1]].id if position else last_log_id
+                    if dirty:
+                        await emit()
+                        dirty = False
+                    boundary += step * max(1, -(-(int(keys[position]) - boundary) // step))
+                last_log_id = rows[-1].id
+
+            if dirty:
+                await emit()
+            while in_flight:
+                writer.write(await in_flight.popleft())
+        finally:
+            for future in in_flight:
+                future.cancel()
+            writer.close()
+
+        return writer.frames
+
+
+async def _save_job(job: TimelapseJob):
+    async with get_redis_connection() as redis_conn:
+        key = f"{TIMELAPSE_JOB_KEY_PREFIX}:{job.id}"
+        fields = {
+            "id": job.id,
+            "status": job.status,
+            "format": job.format,
+            "frames": job.frames,
+            "last_log_id": job.last_log_id if job.last_log_id is not None else "",
+            "error": job.error or "",
+            "created_at": job.created_at.isoformat() if job.created_at else "",
+            "finished_at": job.finished_at.isoformat() if job.finished_at else "",
+        }
+        await redis_conn.hset(key, mapping=fields)
+        await redis_conn.expire(key, TIMELAPSE_JOB_TTL)
+
+
+async def get_timelapse_job(job_id: str) -> Optional[TimelapseJob]:
+    """Get a timelapse job's status, from any worker."""
+    async with get_redis_connection() as redis_conn:
+        fields = await redis_conn.hgetall(f"{TIMELAPSE_JOB_KEY_PREFIX}:{job_id}")
+    if not fields:
+        return None
+    return TimelapseJob(
+        id=fields["id"],
+        status=fields["status"],
+        format=fields["format"],
+        frames=int(fields.get("frames") or 0),
+        last_log_id=int(fields["last_log_id"]) if fields.get("last_log_id") else None,
+        error=fields.get("error") or None,
+        created_at=fields.get("created_at") or None,
+        finished_at=fields.get("finished_at") or None,
+    )
+
+
+def get_timelapse_path(job_id: str, fmt: str) -> str:
+    """Get the output file path of a timelapse job."""
+    return os.path.join(TIMELAPSE_DIRECTORY, f"timelapse_{job_id}.{fmt}")
+
+
+async def run_timelapse_job(job: TimelapseJob, request: TimelapseRequest):
+    """Background task running a timelapse export and recording its progress."""
+    output_path = get_timelapse_path(job.id, request.format)
+    os.makedirs(TIMELAPSE_DIRECTORY, exist_ok=True)
+    start_time = time.time()
+
+    async def progress(frames: int, last_log_id: int):
+        job.frames = frames
+        job.last_log_id = last_log_id
+        # 每隔若干帧更新一次进度，避免频繁写Redis
+        if frames % 50 == 0:
+            await _save_job(job)
+
+    try:
+        job.status = "running"
+        await _save_job(job)
+        exporter = TimelapseExporter(request, output_path)
+        job.frames = await exporter.run(progress)
+        job.status = "done"
+        logger.info(
+            f"Timelapse {job.id} exported {job.frames} frames to {output_path} "
+            f"in {time.time() - start_time:.2f} seconds"
+        )
+    except Exception as e:
+        logger.error(f"Error exporting timelapse {job.id}: {str(e)}", exc_info=True)
+        job.status = "failed"
+        job.error = str(e)
+        if os.path.exists(output_path):
+            os.remove(output_path)
+    finally:
+        job.finished_at = datetime.utcnow()
+        await _save_job(job)
+
+
+async def start_timelapse_job(request: TimelapseRequest) -> TimelapseJob:
+    """Validate a request and start exporting it in the background.
+
+    Raises:
+        ValueError: If the request is invalid
+    """
+    validate_timelapse_request(request)
+    job = TimelapseJob(
+        id=uuid.uuid4().hex,
+        status="pending",
+        format=request.format,
+        created_at=datetime.utcnow(),
+    )
+    await _save_job(job)
+    asyncio.create_task(run_timelapse_job(job, request))
+    return job
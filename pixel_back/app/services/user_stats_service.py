@@ -0,0 +1,99 @@
+"""
+Per-user placement statistics and leaderboards.
+
+Statistics are bumped in Redis on every placement (see ``UserStatsStore``),
+so reads never aggregate over pixel_logs. The rebuild job recomputes them by
+streaming a canvas's logs in chunks and swaps the result in. The swap sets a
+floor at the highest log ID recorded live so far; live placements at or below
+it are skipped from then on, and the job adds the logs between its own end
+and the floor from the primary instead, so nothing is counted twice. A
+placement below the floor whose log commits only after that catch-up read is
+not counted until the next rebuild.
+"""
+
+import asyncio
+import time
+from collections import Counter
+from datetime import datetime, timezone
+from typing import Dict, Optional
+
+from app.canvas_registry import DEFAULT_CANVAS_ID, list_canvas_configs
+from app.config import HISTORY_LOG_CHUNK_SIZE
+from app.deps import get_db_session, get_read_db_session, get_redis_connection, job_lock
+from app.redis_store.user_stats import UserStatsStore
+from app.services.log_archive import get_max_log_id, iter_logs
+from app.utils.logger import logger
+
+
+def _timestamp(created_at: Optional[datetime]) -> float:
+    # created_at 为不带时区的 UTC 时间
+    return created_at.replace(tzinfo=timezone.utc).timestamp() if created_at else 0.0
+
+
+async def _aggregate_logs(canvas_id: str, after_id: int, up_to_id: int, primary: bool = False):
+    """Count placements and last placement times per user over (after_id, up_to_id]."""
+    placements: Counter = Counter()
+    last_placed: Dict[str, float] = {}
+    session = get_db_session() if primary else get_read_db_session(min_log_id=up_to_id)
+    async with session as db:
+        async for rows in iter_logs(db, after_id, up_to_id, HISTORY_LOG_CHUNK_SIZE, canvas_id=canvas_id):
+            for row in rows:
+                if not row.user_id:
+                    continue
+                placements[row.user_id] += 1
+                placed = _timestamp(row.created_at)
+                if placed > last_placed.get(row.user_id, 0.0):
+                    last_placed[row.user_id] = placed
+    return placements, last_placed
+
+
+async def rebuild_user_stats(canvas_id: str = DEFAULT_CANVAS_ID) -> Optional[int]:
+    """Rebuild a canvas's user statistics from its logs, once across all workers.
+
+    Returns:
+        The number of users, or None if another worker is rebuilding
+    """
+    async with job_lock(f"user_stats:{canvas_id}", 3600) as acquired:
+        if not acquired:
+            return None
+        start_time = time.time()
+        async with get_db_session() as db:
+            up_to_id = await get_max_log_id(db)
+        placements, last_placed = await _aggregate_logs(canvas_id, 0, up_to_id)
+
+        async with get_redis_connection() as redis_conn:
+            store = UserStatsStore(redis_conn, canvas_id)
+            floor = await store.replace(dict(placements), last_placed, up_to_id)
+
+            # 替换丢失了重建期间的实时计数；下限以下的日志此后不再实时计入，从主库补上
+            if floor > up_to_id:
+                recent, recent_last_placed = await _aggregate_logs(canvas_id, up_to_id, floor, primary=True)
+                await store.add(dict(recent), recent_last_placed)
+
+        logger.info(
+            f"Rebuilt user statistics of canvas {canvas_id} for {len(placements)} users "
+            f"up to log ID {up_to_id} in {time.time() - start_time:.2f} seconds"
+        )
+        return len(placements)
+
+
+async def ensure_user_stats():
+    """Start rebuilding the statistics of every canvas that were never built."""
+    for canvas in list_canvas_configs():
+        async with get_redis_connection() as redis_conn:
+            built = await UserStatsStore(redis_conn, canvas.id).is_built()
+        if not built:
+            logger.info(f"User statistics of canvas {canvas.id} are missing, rebuilding them")
+            start_user_stats_rebuild(canvas.id)
+
+
+def start_user_stats_rebuild(canvas_id: str = DEFAULT_CANVAS_ID):
+    """Rebuild a canvas's user statistics in the background."""
+    asyncio.create_task(_rebuild_in_background(canvas_id))
+
+
+async def _rebuild_in_background(canvas_id: str):
+    try:
+        await rebuild_user_stats(canvas_id)
+    except Exception as e:
+        logger.error(f"Error rebuilding user statistics of canvas {canvas_id}: {str(e)}", exc_info=True)
@@ -5,7 +5,11 @@
 @Description:
 """
 
-from typing import List
+import hashlib
+import json
+import re
+import zlib
+from typing import List, Tuple
 from PIL import Image
 import numpy as np
 
@@ -116,4 +120,237 @@ def png_to_color_array(png_path: str = None, png_bytes: bytes = None) -> List[st
             # 添加到数组
             color_array.append(color_hex)
     
-    return color_array
\ No newline at end of file
+    return color_array
+
+HEX_COLOR_PATTERN = re.compile(r"^#[0-9A-Fa-f]{6}$")
+
+
+def is_hex_color(color: str) -> bool:
+    """检查颜色是否为 "#RRGGBB" 格式的十六进制颜色码"""
+    return isinstance(color, str) and HEX_COLOR_PATTERN.match(color) is not None
+
+
+def hex_colors_to_rgb(colors: List[str], strict: bool = True) -> np.ndarray:
+    """
+    将十六进制颜色码列表批量转换为 (N, 3) 的 uint8 RGB 数组
+
+    Args:
+        colors: 颜色数组，每个元素为十六进制颜色码（如"#FF0000"）
+        strict: 为 False 时无法解析的颜色码按白色处理，而不是抛出异常
+
+    Returns:
+        np.ndarray: 形状为 (N, 3) 的 RGB 数组
+
+    Raises:
+        ValueError: 当 strict 为 True 且存在无法解析的颜色码时
+    """
+    if not colors:
+        return np.zeros((0, 3), dtype=np.uint8)
+    # 快速路径：拼接成一个十六进制串后一次性解析
+    hex_string = "".join(color[1:] if color.startswith('#') else color for color in colors)
+    try:
+        if len(hex_string) != len(colors) * 6:
+            raise ValueError("颜色码必须为 #RRGGBB 格式")
+        return np.frombuffer(bytes.fromhex(hex_string), dtype=np.uint8).reshape(-1, 3)
+    except ValueError:
+        if strict:
+            raise
+
+    rgb = np.full((len(colors), 3), 255, dtype=np.uint8)
+    for i, color in enumerate(colors):
+        try:
+            rgb[i] = hex_colors_to_rgb([color])[0]
+        except (ValueError, AttributeError):
+            continue
+    return rgb
+
+
+def rgb_to_hex_colors(rgb_array: np.ndarray) -> List[str]:
+    """
+    将 RGB 数组批量转换为十六进制颜色码列表
+
+    Args:
+        rgb_array: 最后一维为 3 的 uint8 数组（如 (H, W, 3) 或 (N, 3)）
+
+    Returns:
+        List[str]: 按行优先顺序排列的颜色数组
+    """
+    hex_string = np.ascontiguousarray(rgb_array, dtype=np.uint8).tobytes().hex().upper()
+    return [f"#{hex_string[i:i + 6]}" for i in range(0, len(hex_string), 6)]
+
+
+def color_array_to_rgb_array(color_array: List[str], width: int, height: int) -> np.ndarray:
+    """
+    将颜色数组转换为 (height, width, 3) 的 RGB 数组，无法解析的颜色按白色处理
+
+    Raises:
+        ValueError: 当颜色数组长度与指定的宽高不匹配时
+    """
+    if len(color_array) != width * height:
+        raise ValueError(f"颜色数组长度({len(color_array)})与指定尺寸({width}x{height}={width*height})不匹配")
+    return hex_colors_to_rgb(color_array, strict=False).reshape(height, width, 3).copy()
+
+
+def png_to_rgb_array(png_path: str = None, png_bytes: bytes = None) -> np.ndarray:
+    """
+    将PNG图像读取为 (height, width, 3) 的 RGB 数组
+    """
+    if not png_path and not png_bytes:
+        raise ValueError("必须提供png_path或png_bytes参数")
+
+    if png_path:
+        img = Image.open(png_path)
+    else:
+        from io import BytesIO
+        img = Image.open(BytesIO(png_bytes))
+
+    # np.array 返回只读视图时需要复制，保证后续可以原地修改
+    return np.array(img.convert('RGB'), dtype=np.uint8)
+
+
+def rgb_array_to_png(rgb_array: np.ndarray, output_path: str = None, mask: np.ndarray = None) -> bytes:
+    """
+    将 (height, width, 3) 的 RGB 数组编码为PNG
+
+    Args:
+        rgb_array: RGB 数组
+        output_path: 可选，输出文件路径，如果提供则保存到文件
+        mask: 可选，(height, width) 的布尔数组，提供时输出RGBA图片，未选中的像素完全透明
+
+    Returns:
+        bytes: PNG图片的字节数据
+    """
+    from io import BytesIO
+    if mask is not None:
+        rgba = np.empty(rgb_array.shape[:2] + (4,), dtype=np.uint8)
+        rgba[..., :3] = rgb_array
+        rgba[..., 3] = np.where(mask, 255, 0)
+        img = Image.fromarray(rgba, 'RGBA')
+    else:
+        img = Image.fromarray(np.ascontiguousarray(rgb_array, dtype=np.uint8), 'RGB')
+    img_bytes = BytesIO()
+    img.save(img_bytes, format='PNG')
+    png_bytes = img_bytes.getvalue()
+    if output_path:
+        with open(output_path, 'wb') as f:
+            f.write(png_bytes)
+    return png_bytes
+
+
+def apply_pixel_updates(frame: np.ndarray, xs: np.ndarray, ys: np.ndarray, rgb: np.ndarray) -> int:
+    """
+    以向量化方式将一批像素更新原地写入画面
+
+    同一坐标出现多次时以最后一次为准（与按日志顺序逐条回放的结果一致），
+    超出画面范围的更新会被忽略。
+
+    Args:
+        frame: (height, width, 3) 的 RGB 数组，会被原地修改
+        xs: 横坐标数组
+        ys: 纵坐标数组
+        rgb: (N, 3) 的颜色数组，与坐标一一对应
+
+    Returns:
+        int: 实际写入的像素数量
+    """
+    height, width = frame.shape[:2]
+    xs = np.asarray(xs, dtype=np.int64)
+    ys = np.asarray(ys, dtype=np.int64)
+    in_bounds = (xs >= 0) & (xs < width) & (ys >= 0) & (ys < height)
+    if not in_bounds.all():
+        xs, ys, rgb = xs[in_bounds], ys[in_bounds], rgb[in_bounds]
+    if len(xs) == 0:
+        return 0
+
+    flat_index = ys * width + xs
+    # 反转后取首次出现的位置，即原顺序中每个坐标的最后一次写入
+    _, last_positions = np.unique(flat_index[::-1], return_index=True)
+    keep = len(flat_index) - 1 - last_positions
+    frame.reshape(-1, 3)[flat_index[keep]] = rgb[keep]
+    return len(keep)
+
+
+def fit_frame(frame: np.ndarray, width: int, height: int) -> np.ndarray:
+    """
+    将画面调整为指定尺寸：向右、向下补白，超出部分裁掉
+
+    画布只会向右下方扩展，已有像素的坐标保持不变。尺寸已一致时原样返回。
+
+    Args:
+        frame: (height, width, 3) 的 RGB 数组
+        width: 目标宽度
+        height: 目标高度
+
+    Returns:
+        np.ndarray: (height, width, 3) 的 RGB 数组
+    """
+    if frame.shape[:2] == (height, width):
+        return frame
+    fitted = np.full((height, width, 3), 255, dtype=np.uint8)
+    copy_height, copy_width = min(height, frame.shape[0]), min(width, frame.shape[1])
+    fitted[:copy_height, :copy_width] = frame[:copy_height, :copy_width]
+    return fitted
+
+
+def canvas_update_regions(message: str) -> List[Tuple[int, int, int, int]]:
+    """
+    解析画布频道上的一条消息，返回其修改的区域列表 (x, y, width, height)
+
+    pixel_update、pixel_batch 与 region_update 之外的消息返回空列表。
+
+    Args:
+        message: 画布频道上的 JSON 消息
+
+    Returns:
+        List[Tuple[int, int, int, int]]: 被修改的矩形区域
+
+    Raises:
+        ValueError, KeyError, TypeError: 消息格式错误
+    """
+    payload = json.loads(message)
+    data = payload.get("data") or {}
+    if payload.get("type") == "pixel_update":
+        return [(int(data["x"]), int(data["y"]), 1, 1)]
+    if payload.get("type") == "pixel_batch":
+        return [(int(pixel["x"]), int(pixel["y"]), 1, 1) for pixel in data["pixels"]]
+    if payload.get("type") == "region_update":
+        return [(int(data["x"]), int(data["y"]), int(data["width"]), int(data["height"]))]
+    return []
+
+
+def tile_hashes(frame: np.ndarray, tile_size: int) -> np.ndarray:
+    """
+    计算画面每个方块的哈希：方块内按行排列的 RGB 字节的 CRC32
+
+    右侧与下方边缘的方块可能小于 tile_size。
+
+    Args:
+        frame: (height, width, 3) 的 RGB 数组
+        tile_size: 方块边长
+
+    Returns:
+        np.ndarray: (方块行数, 方块列数) 的 uint32 数组
+    """
+    height, width = frame.shape[:2]
+    rows, columns = -(-height // tile_size), -(-width // tile_size)
+    hashes = np.zeros((rows, columns), dtype=np.uint32)
+    for row in range(rows):
+        for column in range(columns):
+            tile = frame[row * tile_size:(row + 1) * tile_size, column * tile_size:(column + 1) * tile_size]
+            hashes[row, column] = zlib.crc32(np.ascontiguousarray(tile).tobytes())
+    return hashes
+
+
+def root_hash(hashes: np.ndarray) -> str:
+    """
+    将方块哈希汇总为根哈希：按行排列的大端 uint32 方块哈希的 64 位 BLAKE2b
+
+    根哈希的比较决定是否跳过整个同步，CRC32 的碰撞概率对此过高。
+
+    Args:
+        hashes: tile_hashes 返回的数组
+
+    Returns:
+        str: 16 个十六进制字符的根哈希
+    """
+    return hashlib.blake2b(hashes.astype(">u4").tobytes(), digest_size=8).hexdigest()
@@ -1,14 +1,17 @@
-from fastapi import APIRouter, WebSocket, WebSocketDisconnect, BackgroundTasks
+from fastapi import APIRouter, WebSocket, WebSocketDisconnect, status
+from app.canvas_registry import DEFAULT_CANVAS_ID, get_canvas_config
 from app.redis_store.canvas import CanvasStore
-from app.schemas.events import PixelUpdateEvent
+from app.schemas.events import PixelBatchEvent, PixelUpdateEvent
 from app.utils.logger import logger
 import app.deps as deps
 from redis import asyncio as aioredis
 import json
 import time
-import asyncio
-from app.services.canvas_service import CanvasService
+from app.services.canvas_service import CanvasService, pixel_batch_message, track_placements, validate_pixel
+from pydantic import ValidationError
+from fastapi.encoders import jsonable_encoder
 from app.websocket.manager import ConnectionManager
+from app.config import WS_BATCH_PIXELS_PER_SECOND, WS_PIXEL_BATCH_MAX_SIZE
 
 # Create connection manager for this module
 manager = ConnectionManager()
@@ -16,28 +19,43 @@ manager = ConnectionManager()
 router = APIRouter()
 
 
-async def create_snapshot_background(last_log_id: int, canvas_service: CanvasService):
-    """Background task to create snapshot without blocking the main event loop."""
-    try:
-        logger.info(f"Starting background snapshot creation for log ID: {last_log_id}")
-        start_time = time.time()
-        snapshot = await canvas_service.create_snapshot(last_log_id)
-        elapsed_time = time.time() - start_time
-        logger.info(f"Background snapshot creation completed in {elapsed_time:.2f} seconds. Snapshot: {snapshot}")
-    except Exception as e:
-        logger.error(f"Error creating snapshot in background: {str(e)}", exc_info=True)
+@router.websocket("/ws/canvas")
+@router.websocket("/ws/canvas/{canvas_id}")
+async def canvas_websocket(websocket: WebSocket, canvas_id: str = DEFAULT_CANVAS_ID):
+    """WebSocket endpoint for canvas updates.
 
+    Clients may tag "pixel_update" and "pixel_batch" messages with a ``seq``
+    of their choosing and keep several in flight: each one is answered, in
+    order, with {"type": "ack", "seq", "log_id"} (or "pixel_batch_result"
+    for batches) once committed, or {"type": "reject", "seq", "error"} if it
+    was not applied. Invalid messages are rejected without touching Redis or
+    the database, and errors no longer close the socket.
+
+    The server sends {"type": "ping"} every WS_HEARTBEAT_INTERVAL seconds;
+    a client that has answered {"type": "pong"} once is closed after
+    WS_IDLE_TIMEOUT seconds of silence (any message counts). Clients that
+    never answer are left to the protocol-level ping/pong of the server.
+
+    WebSocket clients are not authenticated, so their batches are capped at
+    WS_PIXEL_BATCH_MAX_SIZE pixels and limited to WS_BATCH_PIXELS_PER_SECOND
+    per connection; larger batches go through the admin-only REST endpoint.
+    """
+    try:
+        get_canvas_config(canvas_id)
+    except KeyError:
+        await websocket.close(code=status.WS_1008_POLICY_VIOLATION)
+        return
 
-@router.websocket("/ws/canvas")
-async def canvas_websocket(websocket: WebSocket):
-    """WebSocket endpoint for canvas updates."""
     # 初始化Redis连接用于pub/sub
     await manager.init_redis()
-    connection_id = await manager.connect(websocket)
+    connection_id = await manager.connect(websocket, canvas_id)
+    if connection_id is None:
+        return
     
     # Get Redis connection from pool
     redis = aioredis.Redis(connection_pool=deps.redis_pool)
-    canvas_store = CanvasStore(redis)
+    canvas_store = CanvasStore(redis, canvas_id)
+    batch_budget = PixelBudget(WS_BATCH_PIXELS_PER_SECOND, WS_PIXEL_BATCH_MAX_SIZE)
     
     try:
         # Send initial canvas state (no initialization needed now)
@@ -51,29 +69,36 @@ async def canvas_websocket(websocket: WebSocket):
         
         while True:
             data = await websocket.receive_text()
-            message = json.loads(data)
-            if message["type"] == "pixel_update":
-                # Process pixel update
-                event = PixelUpdateEvent(**message["data"])
-                log_id = None
-
-                # 更新redis并记录日志到数据库
-                async with deps.get_db_session() as db_session:
-                    canvas_service = CanvasService(canvas_store, db_session)
-                    log_id = await canvas_service.process_pixel_update(event)
-                    await deps.increment_pixel_logs_counter()
-                    # 检查是否需要创建快照
-                    if await deps.async_should_create_snapshot():
-                        await deps.reset_pixel_logs_counter()
-                        # 使用后台任务创建快照，避免阻塞WebSocket消息处理
-                        asyncio.create_task(create_snapshot_background(log_id, canvas_service))
-                
-                # 发送更新并记录执行时间
-                start_time = time.time()
-                await manager.broadcast(json.dumps({"type": "pixel_update", "data": message["data"]}))
-                elapsed_time = time.time() - start_time
-                logger.info(f"Broadcast message took {elapsed_time:.4f} seconds")
-                
+            manager.touch(connection_id)
+            seq = None
+            try:
+                message = json.loads(data)
+                if not isinstance(message, dict):
+                    raise ValueError("Message must be a JSON object")
+                # 客户端分配的序号，原样带回确认消息中
+                seq = message.get("seq")
+                if not isinstance(message.get("data") or {}, dict):
+                    raise ValueError("data must be a JSON object")
+                if message.get("type") == "pong":
+                    manager.touch(connection_id, pong=True)
+                    continue
+                if message.get("type") == "ping":
+                    await manager.send_personal_message(json.dumps({"type": "pong"}), websocket)
+                elif message.get("type") == "pixel_update":
+                    await _handle_pixel_update(websocket, canvas_store, seq, message.get("data") or {})
+                elif message.get("type") == "pixel_batch":
+                    await _handle_pixel_batch(websocket, canvas_store, batch_budget, seq, message.get("data") or {})
+                else:
+                    raise ValueError(f"Unknown message type {message.get('type')!r}")
+            except ValueError as e:
+                # 无效请求：在任何Redis/数据库操作之前拒绝
+                await manager.send_personal_message(reject_message(seq, str(e)), websocket)
+            except WebSocketDisconnect:
+                raise
+            except Exception as e:
+                logger.error(f"Error handling WebSocket message: {e}", exc_info=True)
+                await manager.send_personal_message(reject_message(seq, "Internal error"), websocket)
+
     except WebSocketDisconnect:
         manager.disconnect(connection_id=connection_id)
         logger.info("Client disconnected")
@@ -82,4 +107,105 @@ async def canvas_websocket(websocket: WebSocket):
         manager.disconnect(connection_id=connection_id)
     finally:
         # Close Redis connection (returns it to the pool)
-        await redis.close()
\ No newline at end of file
+        await redis.close()
+
+
+class PixelBudget:
+    """Token bucket limiting the pixels a connection may place.
+
+    Tokens refill at ``rate`` per second up to ``burst``.
+    """
+
+    def __init__(self, rate: float, burst: int):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+
+    def take(self, count: int) -> bool:
+        """Spend ``count`` tokens; False, spending none, if there are not enough."""
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if count > self.tokens:
+            return False
+        self.tokens -= count
+        return True
+
+
+def ack_message(seq, log_id: int) -> str:
+    """Build the acknowledgement of an applied placement."""
+    return json.dumps({"type": "ack", "seq": seq, "log_id": log_id})
+
+
+def reject_message(seq, error: str) -> str:
+    """Build the rejection of a message that was not applied."""
+    return json.dumps({"type": "reject", "seq": seq, "error": error})
+
+
+async def _handle_pixel_update(websocket: WebSocket, canvas_store: CanvasStore, seq, data: dict):
+    """Apply one placement, acknowledge it with its log ID and broadcast it."""
+    # 先校验再进行任何I/O
+    try:
+        event = PixelUpdateEvent(**data)
+    except ValidationError as e:
+        raise ValueError(f"Invalid pixel_update: {e.errors()[0]['msg']}")
+    validate_pixel(canvas_store.canvas, event)
+
+    # 更新redis并记录日志到数据库
+    async with deps.get_db_session() as db_session:
+        canvas_service = CanvasService(canvas_store, db_session)
+        log_id = await canvas_service.process_pixel_update(event)
+    await manager.send_personal_message(ack_message(seq, log_id), websocket)
+    await _after_commit(canvas_store, 1, log_id, {"type": "pixel_update", "data": data})
+
+
+async def _handle_pixel_batch(
+    websocket: WebSocket, canvas_store: CanvasStore, budget: PixelBudget, seq, data: dict
+):
+    """Apply a batch of placements, report every pixel's result and broadcast the applied ones."""
+    # 批量落子：一次批量插入、一次Redis管道写入、一次广播
+    try:
+        batch = PixelBatchEvent(**data)
+    except ValidationError as e:
+        raise ValueError(f"Invalid pixel_batch: {e.errors()[0]['msg']}")
+    if len(batch.pixels) > WS_PIXEL_BATCH_MAX_SIZE:
+        raise ValueError(f"Batch contains more than {WS_PIXEL_BATCH_MAX_SIZE} pixels")
+    if not budget.take(len(batch.pixels)):
+        raise ValueError("Rate limit exceeded, retry later")
+    async with deps.get_db_session() as db_session:
+        canvas_service = CanvasService(canvas_store, db_session)
+        results, applied = await canvas_service.process_pixel_batch(batch, WS_PIXEL_BATCH_MAX_SIZE)
+
+    await manager.send_personal_message(
+        json.dumps({
+            "type": "pixel_batch_result",
+            "seq": seq,
+            "data": {"results": jsonable_encoder(results)},
+        }),
+        websocket
+    )
+    if applied:
+        last_log_id = max(result.log_id for result in results if result.ok)
+        await _after_commit(canvas_store, len(applied), last_log_id, pixel_batch_message(applied))
+
+
+async def _after_commit(canvas_store: CanvasStore, count: int, last_log_id: int, message: dict):
+    """Count committed placements and broadcast them.
+
+    The placements are already acknowledged, so failures are logged rather
+    than raised: a reject for an acknowledged ``seq`` would make the client
+    undo a committed pixel.
+    """
+    try:
+        # 计数并在需要时于后台创建快照，避免阻塞WebSocket消息处理
+        await track_placements(canvas_store, count, last_log_id)
+    except Exception as e:
+        logger.error(f"Error counting placements up to log ID {last_log_id}: {e}", exc_info=True)
+    try:
+        # 发送更新并记录执行时间
+        start_time = time.time()
+        await manager.broadcast(json.dumps(message), canvas_store.canvas_id)
+        logger.info(f"Broadcast message took {time.time() - start_time:.4f} seconds")
+    except Exception as e:
+        logger.error(f"Error broadcasting placements up to log ID {last_log_id}: {e}", exc_info=True)
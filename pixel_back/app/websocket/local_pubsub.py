@@ -0,0 +1,131 @@
+"""
+Same-host pub/sub between uvicorn workers, replacing Redis pub/sub with the
+mmap canvas backend.
+
+Every worker listens on a Unix socket named after its PID in
+``<CANVAS_MMAP_DIRECTORY>/pubsub``. Publishing sends the length-prefixed
+(channel, message) frame to every socket in that directory, the publisher's
+own included, so each worker receives the same stream of canvas updates as
+with a Redis pattern subscription. Sockets of workers that are gone refuse
+connections and are removed.
+
+Each peer has its own queue and writer task, so publishing never waits for
+a socket: a slow worker only delays its own frames, in order, and is
+dropped once PEER_QUEUE_SIZE frames are pending.
+"""
+
+import asyncio
+import glob
+import os
+import struct
+from typing import Awaitable, Callable, Dict, Optional
+
+from app.config import CANVAS_MMAP_DIRECTORY
+from app.utils.logger import logger
+
+FRAME_HEADER = struct.Struct(">I")
+# 每个对端积压的帧数上限，超过后断开该对端
+PEER_QUEUE_SIZE = 10000
+
+
+class _Peer:
+    """Queue of frames to one worker, written by its own task."""
+
+    def __init__(self, pubsub: "LocalPubSub", path: str):
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize=PEER_QUEUE_SIZE)
+        self.task = asyncio.create_task(pubsub._write_loop(path, self))
+
+
+class LocalPubSub:
+    """Fan-out of messages to the workers of one host over Unix sockets."""
+
+    def __init__(self, directory: str):
+        self.directory = directory
+        self.path = None
+        self._server = None
+        self._callback: Optional[Callable[[str, str], Awaitable[None]]] = None
+        # 到各工作进程（含自身）的发送队列，按套接字路径复用
+        self._peers: Dict[str, _Peer] = {}
+
+    async def start(self, callback: Callable[[str, str], Awaitable[None]]):
+        """Start receiving messages, calling ``callback(channel, message)`` for each one."""
+        if self._server is not None:
+            return
+        os.makedirs(self.directory, exist_ok=True)
+        self._callback = callback
+        self.path = os.path.join(self.directory, f"{os.getpid()}.sock")
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+        self._server = await asyncio.start_unix_server(self._handle_peer, path=self.path)
+
+    async def _handle_peer(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            while True:
+                (length,) = FRAME_HEADER.unpack(await reader.readexactly(FRAME_HEADER.size))
+                channel, _, message = (await reader.readexactly(length)).decode("utf-8").partition("\n")
+                try:
+                    await self._callback(channel, message)
+                except Exception as e:
+                    logger.error(f"Error handling local pub/sub message: {e}", exc_info=True)
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    async def _write_loop(self, path: str, peer: _Peer):
+        """Connect to a worker and write its queued frames in order."""
+        try:
+            _, writer = await asyncio.open_unix_connection(path)
+        except (ConnectionRefusedError, FileNotFoundError):
+            # 工作进程已退出，清理其遗留的套接字文件
+            if path != self.path:
+                try:
+                    os.unlink(path)
+                except FileNotFoundError:
+                    pass
+            self._drop(path, peer)
+            return
+        try:
+            while True:
+                frame = await peer.queue.get()
+                writer.write(frame)
+                await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+            self._drop(path, peer)
+
+    def _drop(self, path: str, peer: _Peer):
+        if self._peers.get(path) is peer:
+            del self._peers[path]
+
+    async def publish(self, channel: str, message: str):
+        """Queue a message on a channel for every worker of the host."""
+        payload = f"{channel}\n{message}".encode("utf-8")
+        frame = FRAME_HEADER.pack(len(payload)) + payload
+        for path in glob.glob(os.path.join(self.directory, "*.sock")):
+            peer = self._peers.get(path)
+            if peer is None:
+                peer = self._peers[path] = _Peer(self, path)
+            try:
+                peer.queue.put_nowait(frame)
+            except asyncio.QueueFull:
+                logger.warning(f"Dropping local pub/sub peer {path}, {PEER_QUEUE_SIZE} frames behind")
+                peer.task.cancel()
+                self._drop(path, peer)
+
+    async def close(self):
+        """Stop receiving messages and close the connections to other workers."""
+        for peer in self._peers.values():
+            peer.task.cancel()
+        self._peers.clear()
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+            self._server = None
+            if os.path.exists(self.path):
+                os.unlink(self.path)
+
+
+local_pubsub = LocalPubSub(os.path.join(CANVAS_MMAP_DIRECTORY, "pubsub"))
@@ -0,0 +1,144 @@
+"""
+Shared fixtures: the app runs against fakeredis and a SQLite database.
+
+Settings are set before ``app`` is imported, so the default canvas is small
+and every file the services write goes to a temporary directory.
+
+Tests marked ``postgres`` run against the primary and replica of
+docker-compose.test.yml instead, given by TEST_DATABASE_URL and
+TEST_DATABASE_READ_URL.
+"""
+
+import os
+import shutil
+import tempfile
+
+DATA_DIRECTORY = tempfile.mkdtemp(prefix="pixel_back_tests_")
+os.environ.update({
+    "CANVAS_WIDTH": "64",
+    "CANVAS_HEIGHT": "48",
+    "CANVAS_SHARD_SIZE": "0",
+    "CANVASES": "sharded:100x80:32",
+    "CANVAS_BACKEND": "redis",
+    "ADMIN_TOKEN": "test-admin-token",
+    "SNAPSHOT_DIRECTORY": os.path.join(DATA_DIRECTORY, "snapshots"),
+    "LOG_ARCHIVE_DIRECTORY": os.path.join(DATA_DIRECTORY, "archive"),
+    "CANVAS_MMAP_DIRECTORY": os.path.join(DATA_DIRECTORY, "mmap"),
+    "DATABASE_READ_URL": "",
+    "CANVAS_RESIZE_GRACE_SECONDS": "0",
+})
+
+import fakeredis  # noqa: E402
+import pytest  # noqa: E402
+from sqlalchemy import BigInteger  # noqa: E402
+from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine  # noqa: E402
+from sqlalchemy.ext.compiler import compiles  # noqa: E402
+from sqlalchemy.orm import sessionmaker  # noqa: E402
+
+import app.deps as deps  # noqa: E402
+from app import canvas_registry  # noqa: E402
+from app.db.models import Base  # noqa: E402
+from app.redis_store import mmap_canvas  # noqa: E402
+from app.services import (  # noqa: E402
+    hash_tree_service,
+    heatmap_service,
+    history_service,
+    log_archive,
+    pyramid_service,
+    snapshot_store,
+)
+
+
+@compiles(BigInteger, "sqlite")
+def _bigint_as_integer(element, compiler, **kw):
+    # SQLite 只对 INTEGER 主键自动分配ID
+    return "INTEGER"
+
+
+def pytest_collection_modifyitems(config, items):
+    for item in items:
+        if "slow" in item.keywords and os.getenv("RUN_SLOW_TESTS") != "1":
+            item.add_marker(pytest.mark.skip(reason="set RUN_SLOW_TESTS=1 to run"))
+        if "postgres" in item.keywords and not os.getenv("TEST_DATABASE_URL"):
+            item.add_marker(pytest.mark.skip(reason="set TEST_DATABASE_URL, see docker-compose.test.yml"))
+
+
+@pytest.fixture
+def registry(monkeypatch):
+    """Fresh canvas registry, so geometry changes do not leak between tests."""
+    canvases = canvas_registry._load_canvases()
+    monkeypatch.setattr(canvas_registry, "canvases", canvases)
+    monkeypatch.setattr(canvas_registry, "_geometry_history", {
+        canvas.id: [(0, 0, canvas.width, canvas.height)] for canvas in canvases.values()
+    })
+    return canvas_registry
+
+
+@pytest.fixture
+def redis_server(monkeypatch):
+    """In-process Redis shared by the text and binary connection pools."""
+    server = fakeredis.FakeServer()
+    monkeypatch.setattr(deps, "redis_pool", fakeredis.FakeAsyncRedis(server=server, decode_responses=True).connection_pool)
+    monkeypatch.setattr(deps, "binary_redis_pool", fakeredis.FakeAsyncRedis(server=server).connection_pool)
+    return server
+
+
+@pytest.fixture
+async def database(tmp_path, monkeypatch):
+    """SQLite database with the app's tables, used as the primary."""
+    engine = create_async_engine(f"sqlite+aiosqlite:///{tmp_path / 'pixel.db'}")
+    async with engine.begin() as conn:
+        await conn.run_sync(Base.metadata.create_all)
+    monkeypatch.setattr(deps, "async_session", sessionmaker(engine, class_=AsyncSession, expire_on_commit=False))
+    monkeypatch.setattr(deps, "async_read_session", None)
+    yield engine
+    await engine.dispose()
+
+
+@pytest.fixture
+async def postgres(monkeypatch):
+    """Empty tables on the primary of TEST_DATABASE_URL, and its replica as the read database."""
+    primary = create_async_engine(os.environ["TEST_DATABASE_URL"])
+    replica_url = os.getenv("TEST_DATABASE_READ_URL")
+    replica = create_async_engine(replica_url) if replica_url else None
+    async with primary.begin() as conn:
+        await conn.run_sync(Base.metadata.drop_all)
+        await conn.run_sync(Base.metadata.create_all)
+    monkeypatch.setattr(deps, "async_session", sessionmaker(primary, class_=AsyncSession, expire_on_commit=False))
+    monkeypatch.setattr(
+        deps, "async_read_session",
+        sessionmaker(replica, class_=AsyncSession, expire_on_commit=False) if replica else None,
+    )
+    # 每次都重新查询副本位置
+    monkeypatch.setattr(deps, "READ_REPLICA_CHECK_INTERVAL", 0)
+    monkeypatch.setitem(deps._replica_position, "checked_at", 0.0)
+    yield {"primary": primary, "replica": replica}
+    await primary.dispose()
+    if replica is not None:
+        await replica.dispose()
+
+
+@pytest.fixture
+def data_directories():
+    """Empty snapshot and archive directories, and per-worker caches reset."""
+    for name in ("snapshots", "archive", "mmap"):
+        shutil.rmtree(os.path.join(DATA_DIRECTORY, name), ignore_errors=True)
+        os.makedirs(os.path.join(DATA_DIRECTORY, name))
+    for store in snapshot_store._snapshot_stores.values():
+        store._keyframe = None
+    log_archive.manifest.refresh()
+    log_archive.manifest._mtime = None
+    for service in history_service._history_services.values():
+        service.invalidate()
+    pyramid_service._pyramids.clear()
+    mmap_canvas._mappings.clear()
+    mmap_canvas._written.clear()
+    hash_tree_service._hash_trees.clear()
+    heatmap_service._heatmaps.clear()
+    return DATA_DIRECTORY
+
+
+@pytest.fixture
+async def backend(registry, redis_server, database, data_directories):
+    """Everything a service needs: registry, Redis, database and data directories."""
+    return {"registry": registry, "redis": redis_server, "database": database, "data": data_directories}
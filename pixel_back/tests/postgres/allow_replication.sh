@@ -0,0 +1,4 @@
+#!/bin/bash
+# 允许副本通过网络以流复制方式连接
+set -e
+echo "host replication all all scram-sha-256" >> "$PGDATA/pg_hba.conf"
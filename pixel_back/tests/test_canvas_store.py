@@ -0,0 +1,30 @@
+import numpy as np
+import pytest
+
+from app.deps import get_redis_connection
+from app.redis_store.canvas import CanvasStore
+
+
+async def test_sharded_region_reads_span_shards(backend):
+    async with get_redis_connection() as redis_conn:
+        store = CanvasStore(redis_conn, "sharded")
+        await store.initialize_canvas()
+        await store.set_pixels([31, 32, 40], [31, 32, 70], ["#FF0000", "#00FF00", "#0000FF"])
+
+        region = await store.get_region(30, 30, 12, 41)
+        assert region.shape == (41, 12, 3)
+        assert tuple(region[1, 1]) == (255, 0, 0)
+        assert tuple(region[2, 2]) == (0, 255, 0)
+        assert tuple(region[40, 10]) == (0, 0, 255)
+        assert (region == 255).all(axis=2).sum() == 41 * 12 - 3
+
+
+async def test_missing_shard_is_an_error(backend):
+    async with get_redis_connection() as redis_conn:
+        store = CanvasStore(redis_conn, "sharded")
+        await store.initialize_canvas()
+        await redis_conn.delete(store.backend.shard_key(1, 1))
+
+        assert np.array_equal(await store.get_region(0, 0, 32, 32), np.full((32, 32, 3), 255, dtype=np.uint8))
+        with pytest.raises(RuntimeError):
+            await store.get_frame()
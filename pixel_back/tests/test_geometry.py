@@ -0,0 +1,61 @@
+from datetime import datetime
+
+import pytest
+from sqlalchemy import func, select
+
+from app.canvas_registry import get_canvas_config
+from app.db.models import PixelLog
+from app.deps import get_db_session, get_redis_connection
+from app.redis_store.canvas import CanvasStore
+from app.schemas.events import PixelUpdateEvent
+from app.services import geometry_service
+from app.services.canvas_service import CanvasService
+
+
+async def _place(store: CanvasStore, x: int, y: int, color: str) -> int:
+    async with get_db_session() as db:
+        return await CanvasService(store, db).process_pixel_update(
+            PixelUpdateEvent(x=x, y=y, color=color, user_id="alice", timestamp=datetime.utcnow())
+        )
+
+
+async def _log_count() -> int:
+    async with get_db_session() as db:
+        return await db.scalar(select(func.count()).select_from(PixelLog))
+
+
+@pytest.mark.parametrize("canvas_id", ["default", "sharded"])
+async def test_expansion_replays_late_placements_and_fences_the_old_version(backend, monkeypatch, canvas_id):
+    previous = get_canvas_config(canvas_id)
+    async with get_redis_connection() as redis_conn:
+        await CanvasStore(redis_conn, canvas_id).initialize_canvas()
+        await _place(CanvasStore(redis_conn, canvas_id), 1, 1, "#000001")
+        # 尚未切换到新版本的工作进程
+        stale = CanvasStore(redis_conn, canvas_id, canvas=previous)
+        publish = geometry_service.publish_canvas_message
+
+        async def publish_then_place(*args):
+            await publish(*args)
+            await _place(stale, 2, 2, "#000002")
+
+        monkeypatch.setattr(geometry_service, "publish_canvas_message", publish_then_place)
+
+        async def no_snapshot(*args):
+            pass
+
+        monkeypatch.setattr(geometry_service, "create_snapshot_in_background", no_snapshot)
+        result = await geometry_service.expand_canvas(canvas_id, previous.width + 16, previous.height + 8)
+        assert result["replayed_logs"] == 1
+
+        expanded = CanvasStore(redis_conn, canvas_id)
+        assert (expanded.canvas.width, expanded.canvas.height) == (previous.width + 16, previous.height + 8)
+        assert (await expanded.get_pixel(1, 1)).upper() == "#000001"
+        assert (await expanded.get_pixel(2, 2)).upper() == "#000002"
+        assert not await stale.exists()
+
+        # 切换之后仍写入旧版本的落子失败，其日志回滚
+        count = await _log_count()
+        with pytest.raises(Exception):
+            await _place(stale, 3, 3, "#000003")
+        assert await _log_count() == count
+        assert not await stale.exists()
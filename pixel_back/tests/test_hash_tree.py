@@ -0,0 +1,28 @@
+import numpy as np
+
+from app.deps import get_redis_connection
+from app.redis_store.canvas import CanvasStore
+from app.services.hash_tree_service import CanvasHashTree
+from app.utils.utils import root_hash, tile_hashes
+
+
+def test_root_hash_matches_the_frontend():
+    # 与 pixel_front/src/utils/tileHash.js 的 rootHash 对同一输入的结果一致
+    hashes = np.array([(i * 2654435761) % 2 ** 32 for i in range(100)], dtype=np.uint32)
+    assert root_hash(hashes) == "052c4d10444c9a31"
+    assert root_hash(hashes[:0]) == "e4a6a0577479b2b4"
+
+
+async def test_diff_returns_the_tiles_that_differ(backend):
+    async with get_redis_connection() as redis_conn:
+        store = CanvasStore(redis_conn)
+        await store.initialize_canvas()
+        tree = CanvasHashTree(tile_size=16)
+        client = tile_hashes(await store.get_frame(), 16)
+
+        assert await tree.diff(root_hash(client).upper(), None) == (root_hash(client), [])
+        await store.set_pixel(20, 40, "#000000")
+        tree.mark_dirty(20, 40)
+        root, stale = await tree.diff(root_hash(client), client.ravel().tolist())
+    assert root != root_hash(client)
+    assert stale == [(2, 1)]
@@ -0,0 +1,13 @@
+import pytest
+
+from app.api import canvas as canvas_api
+from app.canvas_registry import get_canvas_config
+
+
+@pytest.mark.parametrize("scale", [None, 1, 3, 8])
+async def test_heatmap_scale_respects_the_cell_cap(backend, monkeypatch, scale):
+    # 64x48 的画布以 4 像素为一格共 16x12 格
+    monkeypatch.setattr(canvas_api, "MAX_HEATMAP_CELLS", 16)
+    result = await canvas_api.get_canvas_heatmap(format="json", scale=scale, canvas=get_canvas_config())
+    assert len(result["cells"]) == result["rows"] * result["columns"] <= 16
+    assert result["cell_size"] == 4 * max(scale or 1, 4)
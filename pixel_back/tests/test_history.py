@@ -0,0 +1,118 @@
+import asyncio
+from datetime import datetime, timedelta
+
+import numpy as np
+from sqlalchemy import update
+
+from app.api.canvas import get_canvas_at_log_id, get_canvas_at_time
+from app.canvas_registry import get_canvas_config
+from app.config import HISTORY_RECENT_MAX_AGE
+from app.db.crud import create_pixel_logs, create_snapshot, get_last_pixel_log_id_before
+from app.db.models import PixelLog
+from app.deps import get_db_session
+from app.schemas.events import PixelUpdateEvent
+from app.services.history_service import blank_frame, get_history_service
+from app.services.snapshot_store import get_snapshot_store
+from app.utils.utils import apply_pixel_updates, hex_colors_to_rgb
+
+
+def _events(count, seed):
+    rng = np.random.default_rng(seed)
+    return [
+        PixelUpdateEvent(x=int(x), y=int(y), color=f"#{int(c):06X}", user_id=f"user{seed}")
+        for x, y, c in zip(rng.integers(0, 64, count), rng.integers(0, 48, count), rng.integers(0, 1 << 24, count))
+    ]
+
+
+def _expected(events):
+    frame = blank_frame(64, 48)
+    apply_pixel_updates(
+        frame,
+        np.array([e.x for e in events]),
+        np.array([e.y for e in events]),
+        hex_colors_to_rgb([e.color for e in events]),
+    )
+    return frame
+
+
+async def _place(events):
+    async with get_db_session() as db:
+        return await create_pixel_logs(db, events)
+
+
+async def test_reconstruct_matches_replayed_logs(backend):
+    first, second = _events(300, 1), _events(200, 2)
+    first_ids = await _place(first)
+    second_ids = await _place(second)
+
+    service = get_history_service()
+    async with get_db_session() as db:
+        middle = await service.reconstruct(db, first_ids[-1])
+        latest = await service.reconstruct(db, second_ids[-1])
+    assert np.array_equal(middle.frame, _expected(first))
+    assert np.array_equal(latest.frame, _expected(first + second))
+    assert not latest.frame.flags.writeable
+
+
+async def test_reconstruct_starts_from_keyframe(backend):
+    first, second = _events(100, 3), _events(100, 4)
+    first_ids = await _place(first)
+    filename = get_snapshot_store().save(_expected(first), datetime.utcnow())
+    async with get_db_session() as db:
+        snapshot = await create_snapshot(db, first_ids[-1], filename)
+    second_ids = await _place(second)
+
+    service = get_history_service()
+    service.invalidate()
+    async with get_db_session() as db:
+        result = await service.reconstruct(db, second_ids[-1])
+    assert result.keyframe_snapshot_id == snapshot.id
+    assert result.replayed_logs == len(second)
+    assert np.array_equal(result.frame, _expected(first + second))
+
+
+async def test_concurrent_reconstructions_share_work(backend):
+    ids = await _place(_events(50, 5))
+    service = get_history_service()
+
+    async def reconstruct():
+        async with get_db_session() as db:
+            return await service.reconstruct(db, ids[-1])
+
+    results = await asyncio.gather(*(reconstruct() for _ in range(4)))
+    assert all(result is results[0] for result in results)
+    # 用完的关键帧锁会被释放
+    assert service._locks == {}
+
+
+async def test_logs_are_stamped_with_server_time(backend):
+    event = PixelUpdateEvent(x=1, y=1, color="#000000", timestamp=datetime(2000, 1, 1))
+    [log_id] = await _place([event])
+    async with get_db_session() as db:
+        assert await get_last_pixel_log_id_before(db, datetime(2000, 1, 2)) == 0
+        assert await get_last_pixel_log_id_before(db, datetime.utcnow()) == log_id
+
+
+async def test_recent_times_are_not_cached_as_final(backend):
+    await _place(_events(10, 6))
+    canvas = get_canvas_config()
+
+    recent = await get_canvas_at_time(datetime.utcnow() - timedelta(seconds=1), canvas=canvas)
+    assert recent.headers["Cache-Control"] == f"public, max-age={HISTORY_RECENT_MAX_AGE}"
+    old = await get_canvas_at_time(datetime.utcnow() - timedelta(days=1), canvas=canvas)
+    assert "immutable" in old.headers["Cache-Control"]
+
+    # 刚写入的日志之前仍可能有进行中的落子提交
+    existing = await get_canvas_at_log_id(1, canvas=canvas)
+    assert existing.headers["Cache-Control"] == f"public, max-age={HISTORY_RECENT_MAX_AGE}"
+    future = await get_canvas_at_log_id(10_000, canvas=canvas)
+    assert future.headers["Cache-Control"] == f"public, max-age={HISTORY_RECENT_MAX_AGE}"
+
+    async with get_db_session() as db:
+        await db.execute(
+            update(PixelLog).where(PixelLog.id <= 5).values(created_at=datetime.utcnow() - timedelta(days=1))
+        )
+    settled = await get_canvas_at_log_id(5, canvas=canvas)
+    assert "immutable" in settled.headers["Cache-Control"]
+    unsettled = await get_canvas_at_log_id(6, canvas=canvas)
+    assert "immutable" not in unsettled.headers["Cache-Control"]
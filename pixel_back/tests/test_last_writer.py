@@ -0,0 +1,60 @@
+import numpy as np
+import pytest
+
+from app.db.crud import create_pixel_logs
+from app.deps import get_binary_redis_connection, get_db_session
+from app.redis_store import last_writer
+from app.redis_store.last_writer import LastWriterIndex
+from app.schemas.events import PixelUpdateEvent
+from app.services import last_writer_service
+from app.services.last_writer_service import rebuild_last_writer_index
+
+
+async def test_ids_beyond_32_bits_are_kept(backend):
+    async with get_binary_redis_connection() as redis_conn:
+        index = LastWriterIndex(redis_conn, "sharded")
+        await index.set(40, 50, 2 ** 32 + 7)
+        await index.set(40, 50, 5)
+        await index.set_many([40, 41], [50, 50], [2 ** 32 + 3, 2 ** 40])
+        assert await index.get(40, 50) == 2 ** 32 + 7
+        assert await index.get_many([40, 41, 0], [50, 50, 0]) == [2 ** 32 + 7, 2 ** 40, 0]
+        with pytest.raises(ValueError):
+            await index.set(0, 0, 2 ** 60)
+
+
+@pytest.mark.parametrize("attempts", [3, 0])
+async def test_merge_keeps_newer_entries(backend, monkeypatch, attempts):
+    # attempts=0 时直接走逐像素比较写入的路径
+    monkeypatch.setattr(last_writer, "_MERGE_ATTEMPTS", attempts)
+    async with get_binary_redis_connection() as redis_conn:
+        index = LastWriterIndex(redis_conn, "sharded")
+        await index.set(5, 5, 1000)
+        frame = np.zeros((80, 100), dtype=np.int64)
+        frame[5, 5] = 10
+        frame[70, 90] = 20
+        await index.merge_frame(frame)
+        assert await index.get(5, 5) == 1000
+        assert await index.get(90, 70) == 20
+        assert await index.exists()
+
+
+async def test_rebuild_band_by_band_matches_logs(backend, monkeypatch):
+    # 每遍只覆盖一行分片
+    monkeypatch.setattr(last_writer_service, "REBUILD_BAND_PIXELS", 100 * 32)
+    rng = np.random.default_rng(3)
+    events = [
+        PixelUpdateEvent(x=int(x), y=int(y), color="#ABCDEF")
+        for x, y in zip(rng.integers(0, 100, 2000), rng.integers(0, 80, 2000))
+    ]
+    async with get_db_session() as db:
+        ids = await create_pixel_logs(db, events, "sharded")
+    expected = np.zeros((80, 100), dtype=np.int64)
+    for event, log_id in zip(events, ids):
+        expected[event.y, event.x] = log_id
+
+    async with get_binary_redis_connection() as redis_conn:
+        await redis_conn.set("last_log:canvas:sharded:0:0", b"\0" * 4)
+        assert await rebuild_last_writer_index("sharded") == len(events)
+        region = await LastWriterIndex(redis_conn, "sharded").get_region(0, 0, 100, 80)
+        assert not await redis_conn.exists("last_log:canvas:sharded:0:0")
+    assert np.array_equal(region, expected)
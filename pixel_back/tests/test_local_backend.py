@@ -0,0 +1,93 @@
+import asyncio
+import fcntl
+import os
+import socket
+import threading
+import time
+
+import numpy as np
+import pytest
+
+from app.canvas_registry import get_canvas_config
+from app.redis_store import mmap_canvas
+from app.redis_store.canvas_backend import CanvasBackend
+from app.redis_store.mmap_canvas import MmapCanvasBackend, sync_mapped_canvases
+from app.websocket.local_pubsub import LocalPubSub
+
+
+def test_backends_must_implement_every_operation():
+    class Partial(CanvasBackend):
+        async def exists(self):
+            return True
+
+    with pytest.raises(TypeError):
+        Partial(get_canvas_config())
+
+
+async def test_mmap_writes_wait_for_other_processes_readers(data_directories):
+    backend = MmapCanvasBackend(get_canvas_config())
+    await backend.initialize_canvas()
+
+    # 另一个打开的文件描述，与另一个工作进程持有的锁等效
+    fd = os.open(f"{backend.path}.lock", os.O_RDWR)
+    fcntl.flock(fd, fcntl.LOCK_SH)
+    writer = threading.Thread(target=lambda: asyncio.run(backend.set_pixel(3, 4, "#102030")))
+    writer.start()
+    time.sleep(0.1)
+    assert writer.is_alive()
+    assert np.array_equal(await asyncio.get_event_loop().run_in_executor(
+        None, lambda: np.array(mmap_canvas._mappings[backend.canvas.id][1][4, 3])
+    ), [255, 255, 255])
+    fcntl.flock(fd, fcntl.LOCK_UN)
+    os.close(fd)
+    writer.join(timeout=5)
+
+    assert await backend.get_pixel(3, 4) == "#102030"
+    assert sync_mapped_canvases() == 1
+    assert sync_mapped_canvases() == 0
+
+
+async def test_local_pubsub_is_not_held_up_by_a_stalled_worker(tmp_path):
+    received = []
+    pubsub = LocalPubSub(str(tmp_path))
+
+    async def callback(channel, message):
+        received.append((channel, message))
+
+    await pubsub.start(callback)
+    # 从不读取的工作进程，以及已退出的工作进程遗留的套接字文件
+    stalled = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    stalled.bind(str(tmp_path / "stalled.sock"))
+    stalled.listen()
+    gone = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    gone.bind(str(tmp_path / "gone.sock"))
+    gone.close()
+    try:
+        message = "x" * 10000
+        start = time.monotonic()
+        for i in range(500):
+            await pubsub.publish("canvas_updates", f"{i}:{message}")
+        assert time.monotonic() - start < 1
+
+        for _ in range(200):
+            if len(received) == 500:
+                break
+            await asyncio.sleep(0.01)
+        assert [int(text.partition(":")[0]) for _, text in received] == list(range(500))
+        assert not (tmp_path / "gone.sock").exists()
+    finally:
+        await pubsub.close()
+        stalled.close()
+
+
+async def test_mmap_writes_to_a_retired_version_fail(data_directories):
+    retiring = MmapCanvasBackend(get_canvas_config())
+    await retiring.initialize_canvas()
+    stale = MmapCanvasBackend(get_canvas_config())
+    await stale.set_pixel(1, 1, "#000000")
+
+    await retiring.delete()
+    # 另一个工作进程仍持有旧文件的映射
+    with pytest.raises(RuntimeError):
+        await stale.set_pixel(2, 2, "#000000")
+    assert not os.path.exists(stale.path)
@@ -0,0 +1,83 @@
+from datetime import datetime, timedelta
+
+from sqlalchemy import delete
+
+from app.db.crud import create_pixel_logs, create_snapshot, get_max_pixel_log_id
+from app.db.models import PixelLog
+from app.deps import get_db_session
+from app.schemas.events import PixelUpdateEvent
+from app.services import log_archive
+from app.services.log_archive import (
+    archive_pixel_logs,
+    get_archive_cutoff,
+    get_last_log_id_before,
+    iter_logs,
+    remove_archived_pixel_logs,
+)
+
+
+async def _place(count, canvas_id="default"):
+    events = [PixelUpdateEvent(x=i % 32, y=i // 32, color="#123456") for i in range(count)]
+    async with get_db_session() as db:
+        return await create_pixel_logs(db, events, canvas_id)
+
+
+async def _snapshot(last_log_id, canvas_id="default"):
+    async with get_db_session() as db:
+        await create_snapshot(db, last_log_id, f"{canvas_id}_{last_log_id}.png", canvas_id)
+
+
+async def _all_ids(canvas_id):
+    async with get_db_session() as db:
+        return [row.id async for rows in iter_logs(db, 0, canvas_id=canvas_id) for row in rows]
+
+
+async def test_cutoff_is_the_oldest_snapshot_across_canvases(backend):
+    default_ids = await _place(40)
+    sharded_ids = await _place(40, "sharded")
+    async with get_db_session() as db:
+        assert await get_archive_cutoff(db) == 0
+
+    await _snapshot(default_ids[-1])
+    await _snapshot(default_ids[10])
+    await _snapshot(sharded_ids[30], "sharded")
+    # 快照属于已不存在的画布时不影响归档
+    await _snapshot(1, "removed")
+    async with get_db_session() as db:
+        assert await get_archive_cutoff(db) == default_ids[10]
+
+
+async def test_archived_logs_are_removed_after_commit_and_stay_readable(backend):
+    ids = await _place(100)
+    sharded_ids = await _place(20, "sharded")
+    await _snapshot(ids[59])
+
+    async with get_db_session() as db:
+        assert await archive_pixel_logs(db, segment_size=25) == 60
+    # 归档后、删除前数据仍在热表中
+    async with get_db_session() as db:
+        assert await get_max_pixel_log_id(db) == sharded_ids[-1]
+    log_archive.manifest.refresh()
+    assert log_archive.manifest.archived_up_to == ids[59]
+
+    assert await remove_archived_pixel_logs() == 60
+    assert await _all_ids("default") == ids
+    assert await _all_ids("sharded") == sharded_ids
+
+
+async def test_last_log_before_time_checks_the_archive(backend):
+    ids = await _place(30)
+    await _snapshot(ids[19])
+    async with get_db_session() as db:
+        await archive_pixel_logs(db)
+    future = datetime.utcnow() + timedelta(seconds=5)
+
+    # 只归档未删除，删除之后，以及热表为空时都能找到
+    async with get_db_session() as db:
+        assert await get_last_log_id_before(db, future) == ids[-1]
+    await remove_archived_pixel_logs()
+    async with get_db_session() as db:
+        assert await get_last_log_id_before(db, future) == ids[-1]
+        assert await get_last_log_id_before(db, datetime(2000, 1, 1)) == 0
+        await db.execute(delete(PixelLog))
+        assert await get_last_log_id_before(db, future) == ids[19]
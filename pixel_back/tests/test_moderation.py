@@ -0,0 +1,40 @@
+import pytest
+from sqlalchemy import func, select
+
+from app.canvas_registry import get_canvas_config
+from app.db.models import PixelLog
+from app.deps import get_db_session, get_redis_connection
+from app.redis_store.canvas import CanvasStore
+from app.schemas.moderation import RegionFillRequest
+from app.services.heatmap_service import get_heatmap
+from app.services.moderation_service import fill_region
+
+
+@pytest.mark.parametrize("canvas_id", ["default", "sharded"])
+async def test_fill_keeps_placements_made_after_the_diff(backend, monkeypatch, canvas_id):
+    async with get_redis_connection() as redis_conn:
+        store = CanvasStore(redis_conn, canvas_id)
+        await store.initialize_canvas()
+        await store.set_pixel(31, 31, "#00ff00")
+
+        get_region = CanvasStore.get_region
+
+        async def get_region_then_place(self, *args):
+            region = await get_region(self, *args)
+            # 读取差异之后、写入之前的一次落子
+            await CanvasStore(redis_conn, canvas_id).set_pixel(32, 32, "#0000FF")
+            return region
+
+        monkeypatch.setattr(CanvasStore, "get_region", get_region_then_place)
+        request = RegionFillRequest(x=30, y=30, width=4, height=4, color="#FF0000", user_id="mod")
+        result = await fill_region(get_canvas_config(canvas_id), request)
+        monkeypatch.setattr(CanvasStore, "get_region", get_region)
+
+        assert (result["changed"], result["skipped"]) == (15, 1)
+        region = await store.get_region(30, 30, 4, 4)
+        assert tuple(region[2, 2]) == (0, 0, 255)
+        assert (region[:, :, 0] == 255).sum() == 15
+        # 管理员的改写不计为玩家活动
+        assert get_heatmap(canvas_id).values().sum() == 0
+    async with get_db_session() as db:
+        assert await db.scalar(select(func.count()).select_from(PixelLog)) == 15
@@ -0,0 +1,72 @@
+import pytest
+from sqlalchemy import func, select
+
+from app.db import crud
+from app.db.models import PixelLog
+from app.deps import get_binary_redis_connection, get_db_session, get_redis_connection
+from app.redis_store.canvas import CanvasStore
+from app.redis_store.last_writer import LastWriterIndex
+from app.schemas.events import PixelBatchEvent, PixelUpdateEvent
+from app.services.canvas_service import CanvasService
+from app.websocket.endpoints import PixelBudget
+
+
+def _batch(pixels, user_id="alice"):
+    return PixelBatchEvent(
+        pixels=[PixelUpdateEvent(x=x, y=y, color=color) for x, y, color in pixels], user_id=user_id
+    )
+
+
+async def test_batch_maps_log_ids_to_pixels(backend, monkeypatch):
+    monkeypatch.setattr(crud, "PIXEL_LOG_INSERT_CHUNK_SIZE", 3)
+    pixels = [(1, 1, "#000001"), (2, 2, "#000002"), (1, 1, "#000003"), (3, 3, "#000004"),
+              (64, 0, "#000005"), (4, 4, "#000006"), (5, 5, "#000007"), (1, 1, "#000008")]
+    async with get_redis_connection() as redis_conn:
+        store = CanvasStore(redis_conn)
+        await store.initialize_canvas()
+        async with get_db_session() as db:
+            results, applied = await CanvasService(store, db).process_pixel_batch(_batch(pixels))
+
+        assert [result.ok for result in results] == [True] * 4 + [False] + [True] * 3
+        log_ids = [result.log_id for result in results if result.ok]
+        async with get_db_session() as db:
+            logs = {log.id: log for log in await crud.get_pixel_logs_by_ids(db, log_ids)}
+        placed = [pixel for pixel in pixels if pixel[0] < 64]
+        assert [(logs[log_id].x, logs[log_id].y, logs[log_id].color) for log_id in log_ids] == placed
+        # 同一像素的多次落子按批内顺序递增，最后一次生效
+        repeated = [log_id for log_id, pixel in zip(log_ids, placed) if pixel[:2] == (1, 1)]
+        assert repeated == sorted(repeated)
+        assert (await store.get_pixel(1, 1)).upper() == "#000008"
+    async with get_binary_redis_connection() as redis_conn:
+        assert await LastWriterIndex(redis_conn).get(1, 1) == repeated[-1]
+
+
+async def test_failed_redis_write_leaves_no_logs(backend, monkeypatch):
+    async with get_redis_connection() as redis_conn:
+        store = CanvasStore(redis_conn)
+        await store.initialize_canvas()
+
+        async def fail(*args, **kwargs):
+            raise ConnectionError("Redis is down")
+
+        monkeypatch.setattr(store, "set_pixels", fail)
+        with pytest.raises(ConnectionError):
+            async with get_db_session() as db:
+                await CanvasService(store, db).process_pixel_batch(_batch([(1, 1, "#123456")]))
+
+    async with get_db_session() as db:
+        assert await db.scalar(select(func.count()).select_from(PixelLog)) == 0
+
+
+async def test_batch_size_cap_and_budget(backend):
+    async with get_redis_connection() as redis_conn, get_db_session() as db:
+        service = CanvasService(CanvasStore(redis_conn), db)
+        with pytest.raises(ValueError):
+            await service.process_pixel_batch(_batch([(0, 0, "#FFFFFF")] * 3), max_size=2)
+
+    budget = PixelBudget(rate=10, burst=50)
+    assert budget.take(50)
+    assert not budget.take(1)
+    budget.updated -= 1
+    assert budget.take(10)
+    assert not budget.take(1)
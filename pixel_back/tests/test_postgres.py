@@ -0,0 +1,183 @@
+import asyncio
+from datetime import datetime, timedelta
+
+import pytest
+from sqlalchemy import text
+
+import app.deps as deps
+from app.api import canvas as canvas_api
+from app.canvas_registry import get_canvas_config
+from app.config import READ_REPLICA_MAX_LAG_LOGS
+from app.db import partitions
+from app.db.crud import create_pixel_logs, get_last_pixel_log_at
+from app.db.migrations import upgrade_schema
+from app.redis_store.canvas import CanvasStore
+from app.schemas.events import PixelUpdateEvent
+from app.schemas.moderation import RegionFillRequest
+from app.services.canvas_service import CanvasService
+from app.services.moderation_service import fill_region
+from app.utils.utils import hex_colors_to_rgb
+
+pytestmark = pytest.mark.postgres
+
+
+async def _place(count: int):
+    events = [PixelUpdateEvent(x=i % 64, y=i % 48, color="#ABCDEF") for i in range(count)]
+    async with deps.get_db_session() as db:
+        ids = await create_pixel_logs(db, events)
+    await deps.record_committed_log_id(ids[-1])
+    return ids
+
+
+async def _in_recovery(db) -> bool:
+    return await db.scalar(text("SELECT pg_is_in_recovery()"))
+
+
+async def _wait_for_replica(replica, log_id: int):
+    for _ in range(100):
+        async with replica.connect() as conn:
+            if (await conn.scalar(text("SELECT COALESCE(max(id), 0) FROM pixel_logs"))) >= log_id:
+                return
+        await asyncio.sleep(0.1)
+    raise AssertionError(f"Replica did not apply log ID {log_id}")
+
+
+@pytest.fixture
+def replica(postgres):
+    if postgres["replica"] is None:
+        pytest.skip("set TEST_DATABASE_READ_URL to the replica")
+    return postgres["replica"]
+
+
+async def test_reads_use_the_replica_only_when_fresh(redis_server, replica):
+    ids = await _place(10)
+    await _wait_for_replica(replica, ids[-1])
+
+    async with deps.get_read_db_session(min_log_id=ids[-1]) as db:
+        assert await _in_recovery(db)
+    # 副本尚未应用所需的日志
+    async with deps.get_read_db_session(min_log_id=ids[-1] + 1) as db:
+        assert not await _in_recovery(db)
+    # 副本落后主库超过 READ_REPLICA_MAX_LAG_LOGS
+    await deps.record_committed_log_id(ids[-1] + READ_REPLICA_MAX_LAG_LOGS + 1)
+    async with deps.get_read_db_session() as db:
+        assert not await _in_recovery(db)
+
+
+async def test_canvas_at_time_resolves_the_log_id_on_the_primary(
+    registry, redis_server, data_directories, replica, monkeypatch
+):
+    await _wait_for_replica(replica, 0)
+    async with replica.connect() as conn:
+        await (await conn.execution_options(isolation_level="AUTOCOMMIT")).execute(
+            text("SELECT pg_wal_replay_pause()")
+        )
+    try:
+        # 副本停止回放，但落后的日志数仍在允许范围内
+        ids = await _place(5)
+        resolved = []
+
+        async def capture(canvas, log_id, fmt, immutable=None):
+            resolved.append(log_id)
+
+        monkeypatch.setattr(canvas_api, "_get_canvas_at", capture)
+        await canvas_api.get_canvas_at_time(datetime.utcnow() + timedelta(seconds=1), canvas=get_canvas_config())
+        assert resolved == [ids[-1]]
+    finally:
+        async with replica.connect() as conn:
+            await (await conn.execution_options(isolation_level="AUTOCOMMIT")).execute(
+                text("SELECT pg_wal_replay_resume()")
+            )
+
+
+async def _column_and_indexes(conn):
+    column = await conn.scalar(text(
+        "SELECT count(*) FROM information_schema.columns "
+        "WHERE table_name = 'pixel_logs' AND column_name = 'canvas_id'"
+    ))
+    indexes = set((await conn.execute(text(
+        "SELECT indexname FROM pg_indexes WHERE tablename = 'pixel_logs'"
+    ))).scalars())
+    return column, indexes
+
+
+async def test_schema_upgrade_of_a_first_release_database(postgres):
+    async with deps.get_db_session() as db:
+        await db.execute(text("DROP TABLE pixel_logs CASCADE"))
+        await db.execute(text("DROP TABLE canvas_geometries"))
+        await db.execute(text("ALTER TABLE canvas_snapshots DROP COLUMN geometry_version"))
+        await db.execute(text(
+            "CREATE TABLE pixel_logs (id BIGSERIAL PRIMARY KEY, x INTEGER, y INTEGER, color VARCHAR, "
+            "user_id VARCHAR, created_at TIMESTAMP DEFAULT now())"
+        ))
+        await db.execute(text("INSERT INTO pixel_logs (x, y, color) VALUES (1, 2, '#000000')"))
+
+    async with deps.get_autocommit_connection() as conn:
+        assert await upgrade_schema(conn) > 0
+        # 再次执行不做任何改变
+        await upgrade_schema(conn)
+        column, indexes = await _column_and_indexes(conn)
+        assert column == 1
+        assert {"ix_pixel_logs_canvas_id_id", "ix_pixel_logs_canvas_id_x_y_id"} <= indexes
+        assert await conn.scalar(text("SELECT canvas_id FROM pixel_logs")) == "default"
+        assert await conn.scalar(text("SELECT count(*) FROM canvas_geometries")) == 0
+        assert await conn.scalar(text(
+            "SELECT count(*) FROM information_schema.columns "
+            "WHERE table_name = 'canvas_snapshots' AND column_name = 'geometry_version'"
+        )) == 1
+
+
+async def test_partitions_are_created_and_dropped(postgres, redis_server, monkeypatch):
+    monkeypatch.setattr(partitions, "PIXEL_LOG_PARTITION_SIZE", 10)
+    async with deps.get_db_session() as db:
+        await db.execute(text("DROP TABLE pixel_logs CASCADE"))
+    async with deps.get_db_session() as db:
+        assert await partitions.prepare_pixel_logs(db)
+        assert await partitions.list_pixel_log_partitions(db) == [0, 1, 2]
+
+    ids = await _place(25)
+    assert ids == list(range(1, 26))
+    async with deps.get_db_session() as db:
+        await partitions.ensure_pixel_log_partitions(db)
+        assert await partitions.list_pixel_log_partitions(db) == [0, 1, 2, 3, 4]
+
+    async with deps.get_autocommit_connection() as conn:
+        assert await partitions.drop_pixel_log_partitions_up_to(conn, 19) == [0, 1]
+        assert await conn.scalar(text("SELECT count(*) FROM pixel_logs")) == 6
+        # 升级跳过分区表上的并发建索引
+        await upgrade_schema(conn)
+        _, indexes = await _column_and_indexes(conn)
+        assert "ix_pixel_logs_canvas_id" in indexes
+
+
+async def test_moderation_logs_precede_placements_written_after_it(
+    registry, redis_server, data_directories, postgres, monkeypatch
+):
+    async with deps.get_redis_connection() as redis_conn:
+        store = CanvasStore(redis_conn)
+        await store.initialize_canvas()
+        compare_and_set_region = CanvasStore.compare_and_set_region
+        placed = []
+
+        async def place_then_compare_and_set(self, *args):
+            # 差异计算之后、比较写入之前的一次落子，有自己的日志
+            async with deps.get_db_session() as db:
+                placed.append(await CanvasService(CanvasStore(redis_conn), db).process_pixel_update(
+                    PixelUpdateEvent(x=32, y=32, color="#0000FF", user_id="alice", timestamp=datetime.utcnow())
+                ))
+            return await compare_and_set_region(self, *args)
+
+        monkeypatch.setattr(CanvasStore, "compare_and_set_region", place_then_compare_and_set)
+        request = RegionFillRequest(x=30, y=30, width=4, height=4, color="#FF0000", user_id="mod")
+        result = await fill_region(get_canvas_config(), request)
+        monkeypatch.setattr(CanvasStore, "compare_and_set_region", compare_and_set_region)
+
+        assert (result["changed"], result["skipped"]) == (15, 1)
+        assert result["last_log_id"] < placed[0]
+        region = await store.get_region(30, 30, 4, 4)
+        # 每个像素的最新日志与画布一致
+        async with deps.get_db_session() as db:
+            for dy in range(4):
+                for dx in range(4):
+                    log = await get_last_pixel_log_at(db, 30 + dx, 30 + dy)
+                    assert hex_colors_to_rgb([log.color]).tolist()[0] == region[dy, dx].tolist()
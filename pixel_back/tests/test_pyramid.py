@@ -0,0 +1,81 @@
+import asyncio
+import io
+
+import numpy as np
+import pytest
+from PIL import Image
+
+from app.deps import get_redis_connection
+from app.redis_store.canvas import CanvasStore
+from app.services.pyramid_service import CanvasPyramid, downsample
+
+
+def _decode(png_bytes: bytes) -> np.ndarray:
+    return np.array(Image.open(io.BytesIO(png_bytes)).convert("RGB"))
+
+
+@pytest.fixture
+async def slow_reads(monkeypatch):
+    """Region reads that yield to the event loop several times."""
+    get_region = CanvasStore.get_region
+
+    async def slow_get_region(self, *args):
+        for _ in range(3):
+            await asyncio.sleep(0)
+        return await get_region(self, *args)
+
+    monkeypatch.setattr(CanvasStore, "get_region", slow_get_region)
+
+
+@pytest.mark.parametrize("dirty_tiles", [[(0, 0)], [(0, 0), (0, 1), (0, 2), (1, 0), (1, 1), (2, 2)]])
+async def test_readers_never_see_a_half_refreshed_level(backend, slow_reads, dirty_tiles):
+    async with get_redis_connection() as redis_conn:
+        store = CanvasStore(redis_conn)
+        await store.initialize_canvas()
+        pyramid = CanvasPyramid(levels=2, tile_size=16)
+        await pyramid.refresh()
+
+        frame = np.zeros((48, 64, 3), dtype=np.uint8)
+        frame[:] = (0, 0, 255)
+        await store.set_region(0, 0, frame)
+        for row, column in dirty_tiles:
+            pyramid.mark_dirty(column * 16, row * 16, 16, 16)
+
+        # 刷新进行中到达的读取，以及刷新之后的读取
+        refresh = asyncio.ensure_future(pyramid.refresh())
+        await asyncio.sleep(0)
+        during, after = await asyncio.gather(pyramid.get_png(1), pyramid.get_png(1))
+        await refresh
+
+        expected = np.full((24, 32, 3), 255, dtype=np.uint8)
+        for row, column in dirty_tiles:
+            expected[row * 8:(row + 1) * 8, column * 8:(column + 1) * 8] = (0, 0, 255)
+        assert np.array_equal(_decode(during[1]), expected)
+        assert during[0] == after[0]
+
+
+async def test_tiles_changed_during_a_refresh_stay_dirty(backend, monkeypatch):
+    async with get_redis_connection() as redis_conn:
+        store = CanvasStore(redis_conn)
+        await store.initialize_canvas()
+        pyramid = CanvasPyramid(levels=2, tile_size=16)
+
+        get_region = CanvasStore.get_region
+        placed = []
+
+        async def get_region_then_place(self, *args):
+            region = await get_region(self, *args)
+            if not placed:
+                # 已读取的块在刷新期间被修改
+                placed.append(True)
+                await store.set_pixel(1, 1, "#000000")
+                pyramid.mark_dirty(1, 1)
+            return region
+
+        monkeypatch.setattr(CanvasStore, "get_region", get_region_then_place)
+        await pyramid.refresh()
+        assert pyramid._dirty == {(0, 0)}
+
+        _, png_bytes = await pyramid.get_png(1)
+        frame = await store.get_frame()
+    assert np.array_equal(_decode(png_bytes), downsample(frame))
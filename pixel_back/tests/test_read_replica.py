@@ -0,0 +1,74 @@
+from datetime import datetime, timedelta
+
+from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
+from sqlalchemy.orm import sessionmaker
+
+import app.deps as deps
+from app.api import canvas as canvas_api
+from app.canvas_registry import get_canvas_config
+from app.db.crud import create_pixel_logs
+from app.db.models import Base, PixelLog
+from app.deps import get_redis_connection
+from app.redis_store.canvas import CanvasStore
+from app.schemas.events import PixelUpdateEvent
+from app.services.canvas_service import CanvasService
+from app.services.last_writer_service import get_pixel_info, get_region_info
+
+
+async def _replica(tmp_path, monkeypatch):
+    replica = create_async_engine(f"sqlite+aiosqlite:///{tmp_path / 'replica.db'}")
+    async with replica.begin() as conn:
+        await conn.run_sync(Base.metadata.create_all)
+    monkeypatch.setattr(deps, "async_read_session", sessionmaker(replica, class_=AsyncSession, expire_on_commit=False))
+    return replica
+
+
+async def test_canvas_at_time_ignores_a_lagging_replica(backend, tmp_path, monkeypatch):
+    # 副本被认为足够新，但尚未应用任何日志
+    replica = await _replica(tmp_path, monkeypatch)
+
+    async def fresh(min_log_id):
+        return True
+
+    monkeypatch.setattr(deps, "_replica_is_fresh", fresh)
+    async with deps.get_db_session() as db:
+        ids = await create_pixel_logs(db, [PixelUpdateEvent(x=1, y=1, color="#000000")] * 3)
+
+    resolved = []
+
+    async def capture(canvas, log_id, fmt, immutable=None):
+        resolved.append(log_id)
+
+    monkeypatch.setattr(canvas_api, "_get_canvas_at", capture)
+    await canvas_api.get_canvas_at_time(datetime.utcnow() + timedelta(seconds=1), canvas=get_canvas_config())
+    await replica.dispose()
+    assert resolved == [ids[-1]]
+
+
+async def test_pixel_authors_are_not_read_from_a_lagging_replica(backend, tmp_path, monkeypatch):
+    replica = await _replica(tmp_path, monkeypatch)
+    async with get_redis_connection() as redis_conn:
+        store = CanvasStore(redis_conn)
+        await store.initialize_canvas()
+        ids = []
+        for user_id in ("alice", "bob"):
+            async with deps.get_db_session() as db:
+                ids.append(await CanvasService(store, db).process_pixel_update(
+                    PixelUpdateEvent(x=1, y=1, color="#000000", user_id=user_id, timestamp=datetime.utcnow())
+                ))
+
+    # 副本只应用了第一次落子，落后的日志数仍在允许范围内
+    async with replica.begin() as conn:
+        await conn.execute(PixelLog.__table__.insert().values(
+            id=ids[0], canvas_id="default", x=1, y=1, color="#000000", user_id="alice", created_at=datetime.utcnow()
+        ))
+
+    async def replica_log_id():
+        return ids[0]
+
+    monkeypatch.setattr(deps, "_get_replica_log_id", replica_log_id)
+    info = await get_pixel_info(1, 1)
+    region = await get_region_info(0, 0, 2, 2)
+    await replica.dispose()
+    assert (info["log_id"], info["user_id"]) == (ids[1], "bob")
+    assert region["logs"][ids[1]]["user_id"] == "bob"
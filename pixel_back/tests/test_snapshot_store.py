@@ -0,0 +1,34 @@
+import os
+import time
+from datetime import datetime
+
+import numpy as np
+
+from app.deps import get_db_session
+from app.services.history_service import blank_frame
+from app.services.snapshot_store import SnapshotStore, collect_snapshot_garbage, mark_keyframe_live
+
+
+def _age(store, filename, seconds):
+    past = time.time() - seconds
+    os.utime(store.path(filename), (past, past))
+
+
+async def test_gc_keeps_keyframes_live_in_other_workers(backend):
+    # 另一个 worker 的存储：其内存中的关键帧对本 worker 的GC不可见
+    other_worker = SnapshotStore(directory=os.path.join(backend["data"], "snapshots"))
+    frame = blank_frame(64, 48)
+    live = other_worker.save(frame, datetime.utcnow())
+    frame[0, 0] = (1, 2, 3)
+    stale = other_worker.save(frame, datetime(2000, 1, 1))
+    delta = other_worker.save(frame, datetime(2000, 1, 1, 0, 30))
+    for filename in (live, stale, delta):
+        _age(other_worker, filename, 3600)
+
+    await mark_keyframe_live(live)
+    await mark_keyframe_live(stale, at=time.time() - 10 * 24 * 3600)
+    async with get_db_session() as db:
+        assert await collect_snapshot_garbage(db) == (0, 2)
+    assert other_worker.exists(live)
+    assert not os.path.exists(other_worker.path(stale))
+    assert np.array_equal(other_worker.load_frame(live), blank_frame(64, 48))
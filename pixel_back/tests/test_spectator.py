@@ -0,0 +1,32 @@
+import asyncio
+import json
+
+from app.services.spectator_service import RETRY_FRAME, SpectatorHub
+
+
+def _place(hub: SpectatorHub, x: int):
+    hub.handle_message("default", json.dumps({"type": "pixel_update", "data": {"x": x, "y": 0, "color": "#000000"}}))
+    feed = hub.feeds["default"]
+    for sequence, frame in hub._encode(feed):
+        hub._publish(feed, frame, sequence)
+
+
+async def test_reconnect_replays_each_missed_frame_once():
+    hub = SpectatorHub()
+    watching = hub.subscribe("default")
+    assert await watching.__anext__() == RETRY_FRAME
+    _place(hub, 1)
+
+    stream = hub.subscribe("default", f"{hub.token}-1")
+    assert await stream.__anext__() == RETRY_FRAME
+    # 队列已注册、尚未计算补发时到达的更新：既在积压中也在队列中
+    _place(hub, 2)
+    assert b'"x":2' in await stream.__anext__()
+    pending = asyncio.ensure_future(stream.__anext__())
+    done, _ = await asyncio.wait({pending}, timeout=0.05)
+    assert not done
+
+    _place(hub, 3)
+    assert b'"x":3' in await pending
+    await stream.aclose()
+    await watching.aclose()
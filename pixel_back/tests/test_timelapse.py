@@ -0,0 +1,58 @@
+from contextlib import asynccontextmanager
+
+import numpy as np
+from PIL import Image
+
+from app.db.crud import create_pixel_logs
+from app.deps import get_db_session
+from app.schemas.events import PixelUpdateEvent
+from app.schemas.timelapse import TimelapseRequest
+from app.services import log_archive, timelapse_service
+from app.services.timelapse_service import TimelapseExporter
+
+PALETTE = ["#000000", "#FF0000", "#00FF00", "#0000FF", "#FFFF00", "#FFFFFF"]
+
+
+async def _place(count):
+    rng = np.random.default_rng(7)
+    events = [
+        PixelUpdateEvent(x=int(x), y=int(y), color=PALETTE[int(c)])
+        for x, y, c in zip(rng.integers(0, 64, count), rng.integers(0, 48, count), rng.integers(0, len(PALETTE), count))
+    ]
+    async with get_db_session() as db:
+        await create_pixel_logs(db, events)
+    return events
+
+
+async def test_gif_export_is_a_valid_looping_gif89a(backend, tmp_path, monkeypatch):
+    events = await _place(200)
+    monkeypatch.setattr(timelapse_service, "HISTORY_LOG_CHUNK_SIZE", 30)
+    sessions = []
+    read_session = log_archive.get_read_db_session
+
+    @asynccontextmanager
+    async def counting_read_session(min_log_id=None):
+        sessions.append(min_log_id)
+        async with read_session(min_log_id) as db:
+            yield db
+
+    monkeypatch.setattr(log_archive, "get_read_db_session", counting_read_session)
+
+    path = tmp_path / "timelapse.gif"
+    request = TimelapseRequest(step_logs=50, end_log_id=200, frame_duration_ms=80)
+    frames = await TimelapseExporter(request, str(path)).run()
+
+    assert frames == 5
+    assert path.read_bytes()[:6] == b"GIF89a"
+    # 每批日志各用一个短事务读取
+    assert len(sessions) == 7
+    with Image.open(path) as gif:
+        assert gif.n_frames == 5
+        assert gif.info["loop"] == 0
+        assert gif.info["duration"] == 80
+        gif.seek(4)
+        last = np.array(gif.convert("RGB"))
+    expected = np.full((48, 64, 3), 255, dtype=np.uint8)
+    for event in events:
+        expected[event.y, event.x] = list(bytes.fromhex(event.color[1:]))
+    assert np.array_equal(last, expected)
@@ -0,0 +1,66 @@
+from collections import Counter
+from datetime import datetime
+
+from app.db.crud import create_pixel_logs
+from app.deps import get_db_session, get_redis_connection
+from app.redis_store.user_stats import UserStatsStore, decode_cursor, encode_cursor
+from app.schemas.events import PixelUpdateEvent
+from app.services import user_stats_service
+from app.services.user_stats_service import rebuild_user_stats
+
+
+async def _place(store, users):
+    events = [PixelUpdateEvent(x=i % 64, y=i % 48, color="#123456", user_id=user) for i, user in enumerate(users)]
+    async with get_db_session() as db:
+        ids = await create_pixel_logs(db, events)
+    await store.record_many([(event.user_id, log_id, datetime.utcnow()) for event, log_id in zip(events, ids)])
+
+
+async def test_rebuild_counts_placements_during_rebuild_once(backend, monkeypatch):
+    async with get_redis_connection() as redis_conn:
+        store = UserStatsStore(redis_conn)
+        await _place(store, ["alice"] * 3 + ["bob"] * 2)
+        # 统计被破坏，需要重建
+        await redis_conn.zadd(store.placements_key, {"alice": 100})
+
+        aggregate = user_stats_service._aggregate_logs
+
+        async def aggregate_with_live_placements(*args, **kwargs):
+            result = await aggregate(*args, **kwargs)
+            if not kwargs.get("primary"):
+                # 重建读完日志之后、换入之前的实时落子
+                await _place(store, ["alice", "carol", "carol"])
+            return result
+
+        monkeypatch.setattr(user_stats_service, "_aggregate_logs", aggregate_with_live_placements)
+        assert await rebuild_user_stats() == 2
+
+        await _place(store, ["bob"])
+        assert (await store.get_user("alice"))[0] == 4
+        assert (await store.get_user("bob"))[0] == 3
+        assert (await store.get_user("carol"))[0] == 2
+        # 下限以下的重复记录被跳过
+        await store.record("carol", 7, datetime.utcnow())
+        assert (await store.get_user("carol"))[0] == 2
+
+
+async def test_leaderboard_cursor_is_stable_across_ties_and_moves(backend):
+    async with get_redis_connection() as redis_conn:
+        store = UserStatsStore(redis_conn)
+        counts = Counter({f"user{i:02d}": 5 for i in range(10)})
+        counts.update({"top": 9, "low": 1})
+        await redis_conn.zadd(store.placements_key, dict(counts))
+
+        first = await store.leaderboard(None, 4)
+        assert [user for _, user, _, _ in first] == ["top", "user09", "user08", "user07"]
+        cursor = encode_cursor(first[-1][2], first[-1][1])
+        assert decode_cursor(cursor) == (5, "user07")
+
+        # 游标用户在翻页之间上升，后续页不受影响
+        await redis_conn.zincrby(store.placements_key, 10, "user07")
+        second = await store.leaderboard(decode_cursor(cursor), 4)
+        assert [user for _, user, _, _ in second] == ["user06", "user05", "user04", "user03"]
+        assert [rank for rank, _, _, _ in second] == [4, 5, 6, 7]
+
+        third = await store.leaderboard((second[-1][2], second[-1][1]), 10)
+        assert [user for _, user, _, _ in third] == ["user02", "user01", "user00", "low"]
@@ -0,0 +1,205 @@
+import asyncio
+import json
+import os
+import resource
+import socket
+import subprocess
+import sys
+import time
+
+import pytest
+import websockets
+from fastapi import FastAPI, WebSocket, WebSocketDisconnect
+
+import app.deps as deps
+from app.deps import get_redis_connection
+from app.redis_store.canvas import CanvasStore
+from app.websocket import endpoints
+from app.websocket import manager as manager_module
+from app.websocket.manager import ConnectionManager
+
+# 内存测试的空闲连接数；客户端与服务器进程各需同样多的文件描述符
+IDLE_CONNECTIONS = int(os.getenv("WS_MEMORY_TEST_CONNECTIONS", 20000))
+
+# 内存测试中以子进程运行的应用：只接受连接并读取消息
+idle_app = FastAPI()
+idle_manager = ConnectionManager()
+idle_manager.subscribed = True
+
+
+@idle_app.websocket("/ws")
+async def idle_socket(websocket: WebSocket):
+    connection_id = await idle_manager.connect(websocket)
+    try:
+        while True:
+            await websocket.receive_text()
+            idle_manager.touch(connection_id)
+    except WebSocketDisconnect:
+        idle_manager.disconnect(connection_id)
+
+
+class FakeWebSocket:
+    client = None
+
+    def __init__(self):
+        self.closed = False
+
+    async def accept(self):
+        pass
+
+    async def send_text(self, message):
+        await asyncio.sleep(3600)
+
+    async def close(self, code=None):
+        self.closed = True
+
+
+async def test_heartbeat_reaps_only_clients_that_answer_pings(monkeypatch):
+    monkeypatch.setattr(manager_module, "WS_MAX_CONNECTIONS_PER_IP", 0)
+    manager = ConnectionManager()
+    manager.subscribed = True
+    legacy, current = FakeWebSocket(), FakeWebSocket()
+    legacy_id = await manager.connect(legacy)
+    current_id = await manager.connect(current)
+    manager.touch(current_id, pong=True)
+
+    for connection in manager.active_connections.values():
+        connection.last_seen -= manager_module.WS_IDLE_TIMEOUT + 1
+    await manager.heartbeat()
+    assert list(manager.active_connections) == [legacy_id]
+    assert current.closed and not legacy.closed
+    manager.disconnect(legacy_id)
+
+
+class ScriptedWebSocket:
+    """Client sending the given messages, then disconnecting once its replies are written."""
+    client = None
+
+    def __init__(self, messages):
+        self.messages = [json.dumps(message) for message in messages]
+        self.sent = []
+
+    async def accept(self):
+        pass
+
+    async def receive_text(self):
+        if self.messages:
+            return self.messages.pop(0)
+        for _ in range(20):
+            await asyncio.sleep(0)
+        raise WebSocketDisconnect()
+
+    async def send_text(self, message):
+        self.sent.append(json.loads(message))
+
+    async def close(self, code=None):
+        pass
+
+    def replies(self):
+        """Get the (type, seq) of the acks, rejects and batch results, in order."""
+        return [(message["type"], message.get("seq")) for message in self.sent
+                if message["type"] in ("ack", "reject", "pixel_batch_result")]
+
+
+@pytest.fixture
+async def socket_session(backend, monkeypatch):
+    monkeypatch.setattr(endpoints.manager, "subscribed", True)
+    async with get_redis_connection() as redis_conn:
+        await CanvasStore(redis_conn).initialize_canvas()
+
+    async def run(messages):
+        websocket = ScriptedWebSocket(messages)
+        await endpoints.canvas_websocket(websocket)
+        return websocket
+
+    return run
+
+
+async def test_invalid_messages_are_rejected_before_any_io(socket_session, monkeypatch):
+    def no_io(*args, **kwargs):
+        raise AssertionError("invalid message reached the database or Redis")
+
+    monkeypatch.setattr(deps, "get_db_session", no_io)
+    monkeypatch.setattr(CanvasStore, "set_pixel", no_io)
+    websocket = await socket_session([
+        {"type": "pixel_update", "seq": 1, "data": {"x": 64, "y": 0, "color": "#000000"}},
+        {"type": "pixel_update", "seq": 2, "data": {"x": 0, "y": 0, "color": "red"}},
+        {"type": "pixel_batch", "seq": 3, "data": {"pixels": []}},
+        {"type": "unknown", "seq": 4},
+    ])
+    assert websocket.replies() == [("reject", 1), ("reject", 2), ("reject", 3), ("reject", 4)]
+
+
+async def test_every_placement_is_acknowledged_once(socket_session):
+    websocket = await socket_session([
+        {"type": "pixel_update", "seq": seq, "data": {"x": seq, "y": 0, "color": "#000000"}}
+        for seq in range(1, 4)
+    ] + [{"type": "pixel_batch", "seq": 4, "data": {"pixels": [{"x": 5, "y": 5, "color": "#000000"}]}}])
+    assert websocket.replies() == [("ack", 1), ("ack", 2), ("ack", 3), ("pixel_batch_result", 4)]
+    assert [message["log_id"] for message in websocket.sent if message["type"] == "ack"] == [1, 2, 3]
+
+
+async def test_failures_after_commit_do_not_reject_acknowledged_placements(socket_session, monkeypatch):
+    async def fail(*args, **kwargs):
+        raise RuntimeError("Redis is down")
+
+    monkeypatch.setattr(endpoints, "track_placements", fail)
+    monkeypatch.setattr(endpoints.manager, "broadcast", fail)
+    websocket = await socket_session([
+        {"type": "pixel_update", "seq": 1, "data": {"x": 1, "y": 1, "color": "#000000"}},
+        {"type": "pixel_batch", "seq": 2, "data": {"pixels": [{"x": 2, "y": 2, "color": "#000000"}]}},
+    ])
+    assert websocket.replies() == [("ack", 1), ("pixel_batch_result", 2)]
+
+
+def _rss(pid: int) -> int:
+    with open(f"/proc/{pid}/status") as f:
+        for line in f:
+            if line.startswith("VmRSS:"):
+                return int(line.split()[1]) * 1024
+    raise AssertionError("VmRSS missing")
+
+
+async def _open(port: int, count: int, sockets: list):
+    for start in range(0, count, 500):
+        sockets.extend(await asyncio.gather(*(
+            websockets.connect(f"ws://127.0.0.1:{port}/ws", compression=None, ping_interval=None)
+            for _ in range(start, min(start + 500, count))
+        )))
+
+
+@pytest.mark.slow
+async def test_memory_per_idle_connection():
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if hard < IDLE_CONNECTIONS + 1000:
+        pytest.skip(f"needs {IDLE_CONNECTIONS + 1000} file descriptors")
+    resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        port = s.getsockname()[1]
+    server = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "tests.test_websocket:idle_app", "--port", str(port),
+         "--ws", "websockets", "--ws-per-message-deflate", "false", "--log-level", "warning"],
+        env={**os.environ, "WS_MAX_CONNECTIONS_PER_IP": "0"},
+        cwd=os.path.dirname(os.path.dirname(__file__)),
+    )
+    sockets = []
+    try:
+        for _ in range(100):
+            try:
+                socket.create_connection(("127.0.0.1", port)).close()
+                break
+            except OSError:
+                time.sleep(0.1)
+        # 预热后再计量，排除首批连接触发的导入和分配
+        await _open(port, 1000, sockets)
+        await asyncio.sleep(1)
+        before = _rss(server.pid)
+        await _open(port, IDLE_CONNECTIONS, sockets)
+        await asyncio.sleep(1)
+        per_connection = (_rss(server.pid) - before) / IDLE_CONNECTIONS
+        assert per_connection < 64 * 1024, f"{per_connection:.0f} bytes per idle connection"
+    finally:
+        await asyncio.gather(*(ws.close() for ws in sockets), return_exceptions=True)
+        server.terminate()
+        server.wait()
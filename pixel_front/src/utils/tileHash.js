@@ -0,0 +1,155 @@
+// 画布方块哈希，与后端 tile_hashes / root_hash 的算法一致：
+// 方块哈希为方块内按行排列的 RGB 字节的 CRC32，
+// 根哈希为按行排列的大端方块哈希的 64 位 BLAKE2b（16 个十六进制字符）
+
+const CRC_TABLE = (() => {
+  const table = new Uint32Array(256);
+  for (let n = 0; n < 256; n++) {
+    let c = n;
+    for (let k = 0; k < 8; k++) {
+      c = c & 1 ? 0xEDB88320 ^ (c >>> 1) : c >>> 1;
+    }
+    table[n] = c >>> 0;
+  }
+  return table;
+})();
+
+/**
+ * 计算字节序列的 CRC32
+ * @param {Uint8Array} bytes - 字节序列
+ * @returns {number} 无符号 32 位 CRC
+ */
+export function crc32(bytes) {
+  let crc = 0xFFFFFFFF;
+  for (let i = 0; i < bytes.length; i++) {
+    crc = CRC_TABLE[(crc ^ bytes[i]) & 0xFF] ^ (crc >>> 8);
+  }
+  return (crc ^ 0xFFFFFFFF) >>> 0;
+}
+
+const MASK_64 = (1n << 64n) - 1n;
+
+const BLAKE2B_IV = [
+  0x6a09e667f3bcc908n, 0xbb67ae8584caa73bn, 0x3c6ef372fe94f82bn, 0xa54ff53a5f1d36f1n,
+  0x510e527fade682d1n, 0x9b05688c2b3e6c1fn, 0x1f83d9abfb41bd6bn, 0x5be0cd19137e2179n,
+];
+
+const BLAKE2B_SIGMA = [
+  [0, 1, 2, 3, 4, 5, 6, 7, 8, 9, 10, 11, 12, 13, 14, 15],
+  [14, 10, 4, 8, 9, 15, 13, 6, 1, 12, 0, 2, 11, 7, 5, 3],
+  [11, 8, 12, 0, 5, 2, 15, 13, 10, 14, 3, 6, 7, 1, 9, 4],
+  [7, 9, 3, 1, 13, 12, 11, 14, 2, 6, 5, 10, 4, 0, 15, 8],
+  [9, 0, 5, 7, 2, 4, 10, 15, 14, 1, 11, 12, 6, 8, 3, 13],
+  [2, 12, 6, 10, 0, 11, 8, 3, 4, 13, 7, 5, 15, 14, 1, 9],
+  [12, 5, 1, 15, 14, 13, 4, 10, 0, 7, 6, 3, 9, 2, 8, 11],
+  [13, 11, 7, 14, 12, 1, 3, 9, 5, 0, 15, 4, 8, 6, 2, 10],
+  [6, 15, 14, 9, 11, 3, 0, 8, 12, 2, 13, 7, 1, 4, 10, 5],
+  [10, 2, 8, 4, 7, 6, 1, 5, 15, 11, 9, 14, 3, 12, 13, 0],
+];
+
+function rotr64(x, n) {
+  return ((x >> n) | (x << (64n - n))) & MASK_64;
+}
+
+function blake2bMix(v, a, b, c, d, x, y) {
+  v[a] = (v[a] + v[b] + x) & MASK_64;
+  v[d] = rotr64(v[d] ^ v[a], 32n);
+  v[c] = (v[c] + v[d]) & MASK_64;
+  v[b] = rotr64(v[b] ^ v[c], 24n);
+  v[a] = (v[a] + v[b] + y) & MASK_64;
+  v[d] = rotr64(v[d] ^ v[a], 16n);
+  v[c] = (v[c] + v[d]) & MASK_64;
+  v[b] = rotr64(v[b] ^ v[c], 63n);
+}
+
+function blake2bCompress(h, block, length, last) {
+  const v = h.concat(BLAKE2B_IV);
+  v[12] ^= BigInt(length) & MASK_64;
+  if (last) v[14] ^= MASK_64;
+  const view = new DataView(block.buffer, block.byteOffset, 128);
+  const m = [];
+  for (let i = 0; i < 16; i++) m.push(view.getBigUint64(i * 8, true));
+  for (let round = 0; round < 12; round++) {
+    const s = BLAKE2B_SIGMA[round % 10];
+    blake2bMix(v, 0, 4, 8, 12, m[s[0]], m[s[1]]);
+    blake2bMix(v, 1, 5, 9, 13, m[s[2]], m[s[3]]);
+    blake2bMix(v, 2, 6, 10, 14, m[s[4]], m[s[5]]);
+    blake2bMix(v, 3, 7, 11, 15, m[s[6]], m[s[7]]);
+    blake2bMix(v, 0, 5, 10, 15, m[s[8]], m[s[9]]);
+    blake2bMix(v, 1, 6, 11, 12, m[s[10]], m[s[11]]);
+    blake2bMix(v, 2, 7, 8, 13, m[s[12]], m[s[13]]);
+    blake2bMix(v, 3, 4, 9, 14, m[s[14]], m[s[15]]);
+  }
+  for (let i = 0; i < 8; i++) h[i] ^= v[i] ^ v[i + 8];
+}
+
+/**
+ * 计算字节序列的 BLAKE2b（无密钥），与 Python 的 hashlib.blake2b 一致
+ * @param {Uint8Array} bytes - 字节序列
+ * @param {number} digestSize - 摘要字节数（1 到 64）
+ * @returns {string} 十六进制摘要
+ */
+export function blake2bHex(bytes, digestSize) {
+  const h = BLAKE2B_IV.slice();
+  h[0] ^= 0x01010000n ^ BigInt(digestSize);
+  // 最后一个块（可能为空输入的全零块）带结束标志压缩
+  const blocks = Math.max(1, Math.ceil(bytes.length / 128));
+  for (let i = 0; i < blocks; i++) {
+    const block = new Uint8Array(128);
+    block.set(bytes.subarray(i * 128, (i + 1) * 128));
+    const last = i === blocks - 1;
+    blake2bCompress(h, block, last ? bytes.length : (i + 1) * 128, last);
+  }
+  const out = new Uint8Array(64);
+  const view = new DataView(out.buffer);
+  h.forEach((word, i) => view.setBigUint64(i * 8, word, true));
+  return Array.from(out.subarray(0, digestSize), byte => byte.toString(16).padStart(2, '0')).join('');
+}
+
+/**
+ * 计算画布每个方块的哈希
+ * 透明像素（尚未绘制）按白色处理。
+ * @param {ImageData} imageData - 整个 canvas 元素的像素数据
+ * @param {number} width - 画布宽度（像素格）
+ * @param {number} height - 画布高度（像素格）
+ * @param {number} pixelSize - 每个像素格在 canvas 上的边长
+ * @param {number} tileSize - 方块边长（像素格）
+ * @returns {number[]} 按行排列的方块哈希
+ */
+export function computeTileHashes(imageData, width, height, pixelSize, tileSize) {
+  const data = imageData.data;
+  const stride = imageData.width;
+  const hashes = [];
+  for (let y0 = 0; y0 < height; y0 += tileSize) {
+    for (let x0 = 0; x0 < width; x0 += tileSize) {
+      const tileWidth = Math.min(tileSize, width - x0);
+      const tileHeight = Math.min(tileSize, height - y0);
+      const bytes = new Uint8Array(tileWidth * tileHeight * 3);
+      let offset = 0;
+      for (let y = y0; y < y0 + tileHeight; y++) {
+        for (let x = x0; x < x0 + tileWidth; x++) {
+          // 取每个像素格左上角的物理像素
+          const i = ((y * pixelSize) * stride + x * pixelSize) * 4;
+          const opaque = data[i + 3] > 0;
+          bytes[offset++] = opaque ? data[i] : 255;
+          bytes[offset++] = opaque ? data[i + 1] : 255;
+          bytes[offset++] = opaque ? data[i + 2] : 255;
+        }
+      }
+      hashes.push(crc32(bytes));
+    }
+  }
+  return hashes;
+}
+
+/**
+ * 将方块哈希汇总为根哈希
+ * @param {number[]} hashes - 按行排列的方块哈希
+ * @returns {string} 根哈希，16 个十六进制字符
+ */
+export function rootHash(hashes) {
+  const bytes = new Uint8Array(hashes.length * 4);
+  const view = new DataView(bytes.buffer);
+  hashes.forEach((hash, i) => view.setUint32(i * 4, hash, false));
+  return blake2bHex(bytes, 8);
+}
@@ -6,6 +6,10 @@ class WSClient {
     this.reconnectInterval = 5000; // 5秒重连间隔
     this.maxReconnectAttempts = 5;
     this.reconnectAttempts = 0;
+    // 客户端分配的序号，以及等待服务器确认的请求
+    this.nextSeq = 1;
+    this.pending = new Map();
+    this.ackTimeout = 10000; // 10秒未确认视为失败
   }
 
   /**
@@ -26,10 +30,28 @@ class WSClient {
       try {
         const message = JSON.parse(event.data);
         // 根据后端API调整消息类型映射
-        if (message.type === "initial_canvas") {
+        if (message.type === "ping") {
+          // 服务器心跳：回复 pong，长时间无响应的连接会被服务器关闭
+          this.ws.send(JSON.stringify({ type: "pong" }));
+        } else if (message.type === "initial_canvas") {
           this.emit('initial_canvas', message.data);
         } else if (message.type === "pixel_update") {
           this.emit('pixel_update', message.data);
+        } else if (message.type === "pixel_batch") {
+          // 批量落子以一条消息广播，逐个像素分发给现有监听器
+          message.data.pixels.forEach(pixel => this.emit('pixel_update', pixel));
+        } else if (message.type === "region_update") {
+          this.emit('region_update', message.data);
+        } else if (message.type === "canvas_resize") {
+          // 画布被扩展：data 包含新旧尺寸
+          this.emit('canvas_resize', message.data);
+        } else if (message.type === "pixel_batch_result") {
+          this.settle(message.seq, null, message.data);
+          this.emit('pixel_batch_result', message.data);
+        } else if (message.type === "ack") {
+          this.settle(message.seq, null, { logId: message.log_id });
+        } else if (message.type === "reject") {
+          this.settle(message.seq, new Error(message.error));
         }
       } catch (error) {
         console.error('解析WebSocket消息失败:', error);
@@ -38,6 +60,8 @@ class WSClient {
     
     this.ws.onclose = (event) => {
       console.log('WebSocket连接已关闭', event);
+      // 连接断开后无法再收到确认，未确认的落子结果未知
+      this.rejectPending(new Error('WebSocket连接已关闭'));
       this.emit('close', event);
       
       // 尝试重连
@@ -54,10 +78,75 @@ class WSClient {
     };
   }
 
+  /**
+   * 以只读观众身份通过 Server-Sent Events 订阅画布更新
+   *
+   * 服务器按时间间隔合并更新后推送；浏览器断线后会带 Last-Event-ID 自动重连并补发错过的更新，
+   * 补发不了时收到 resync 事件。观众无法落子。
+   * @param {string} url - 订阅地址，如 /api/v1/canvas/stream
+   */
+  spectate(url) {
+    this.eventSource = new EventSource(url);
+
+    const handlers = {
+      pixel_batch: data => data.pixels.forEach(pixel => this.emit('pixel_update', pixel)),
+      region_update: data => this.emit('region_update', data),
+      canvas_resize: data => this.emit('canvas_resize', data),
+      resync: data => this.emit('resync', data),
+    };
+    Object.entries(handlers).forEach(([type, handler]) => {
+      this.eventSource.addEventListener(type, (event) => {
+        try {
+          handler(JSON.parse(event.data));
+        } catch (error) {
+          console.error('解析观众模式消息失败:', error);
+        }
+      });
+    });
+
+    this.eventSource.onerror = (error) => {
+      // EventSource 会自动重连，这里只记录
+      console.error('观众模式连接错误:', error);
+      this.emit('error', error);
+    };
+  }
+
+  /**
+   * 完成一个等待确认的请求
+   * @param {number} seq - 请求序号
+   * @param {Error|null} error - 被拒绝时的错误
+   * @param {any} result - 确认结果
+   */
+  settle(seq, error, result) {
+    const entry = this.pending.get(seq);
+    if (!entry) return;
+    this.pending.delete(seq);
+    clearTimeout(entry.timer);
+    if (error) {
+      entry.reject(error);
+    } else {
+      entry.resolve(result);
+    }
+  }
+
+  /**
+   * 以同一错误拒绝所有等待确认的请求
+   * @param {Error} error - 错误
+   */
+  rejectPending(error) {
+    for (const seq of [...this.pending.keys()]) {
+      this.settle(seq, error);
+    }
+  }
+
   /**
    * 发送消息到服务器
+   *
+   * 落子请求带有客户端序号，可以同时有多个在途请求，
+   * 返回的Promise在服务器确认时以 { logId } 完成（批量落子为逐像素结果），被拒绝时失败。
    * @param {string} type - 消息类型
    * @param {Object} data - 消息数据
+   * @returns {Promise<Object>|undefined} 落子请求的确认结果
    */
   send(type, data) {
     if (this.isMockMode) {
@@ -66,7 +155,7 @@ class WSClient {
         case 'pixel_place':
           // 模拟服务器确认像素放置
           this.emit('pixel_update', data);
-          break;
+          return Promise.resolve({ logId: null });
       }
       return;
     }
@@ -83,12 +172,35 @@ class WSClient {
             color: data.color
           }
         };
+      } else if (type === 'pixel_batch') {
+        message = {
+          type: "pixel_batch",
+          data: {
+            pixels: data.pixels.map(({ x, y, color }) => ({ x, y, color }))
+          }
+        };
       } else {
         message = { type, data };
       }
+      if (type === 'pixel_place' || type === 'pixel_batch') {
+        const seq = this.nextSeq++;
+        message.seq = seq;
+        const result = new Promise((resolve, reject) => {
+          const timer = setTimeout(
+            () => this.settle(seq, new Error('等待服务器确认超时')),
+            this.ackTimeout
+          );
+          this.pending.set(seq, { resolve, reject, timer });
+        });
+        this.ws.send(JSON.stringify(message));
+        return result;
+      }
       this.ws.send(JSON.stringify(message));
     } else {
       console.warn('WebSocket未连接，无法发送消息');
+      if (type === 'pixel_place' || type === 'pixel_batch') {
+        return Promise.reject(new Error('WebSocket未连接'));
+      }
     }
   }
 
@@ -139,6 +251,9 @@ class WSClient {
     if (this.ws) {
       this.ws.close();
     }
+    if (this.eventSource) {
+      this.eventSource.close();
+    }
   }
 }
 